@@ -0,0 +1,365 @@
+"""
+Timing benchmarks against the local LIFX simulator in tests/lifx_simulator.py. No bulbs or LAN access are needed.
+
+python -m benchmarks.simulated --output benchmark.json
+python -m benchmarks.simulated --quick --baseline benchmark.json
+
+Reports, per breathing mode, the phase-timing error (how far apart consecutive set_waveform packets arrive compared
+with the requested phase duration) and the packets each breathing cycle costs; discovery latency from an empty
+LifxManager to a full inventory at N = 1, 10 and 100 bulbs; and the event loop CPU time and Python heap each
+breathing session adds, next to the process RSS; and startup latency, from asking the engine to start a session to
+the bulb receiving its first colour change, next to the import time of the command line entry point. With --baseline the run exits non-zero if a metric is worse than the
+baseline by more than --tolerance, so CI can catch regressions.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+import argparse
+import asyncio
+import dataclasses
+import json
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+import logging
+
+logger = logging.getLogger("benchmarks")
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to debug
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+
+# create formatter
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+# add formatter to ch
+ch.setFormatter(formatter)
+
+# add ch to logger
+logger.addHandler(ch)
+# -----------------------------------------------------------------------------
+
+from lifxlan import LifxLAN
+from lifxlan.message import Message
+
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.lifx import BreathingMode, run_session
+from lifx_breathing.lifx_manager import LifxLightWrapper, LifxManager
+from lifx_breathing.protocol import AsyncLight, LifxTransport
+from tests.lifx_simulator import LifxSimulator, SET_WAVEFORM_MESSAGE_TYPE
+
+# The engine and manager log every packet at DEBUG, which would dominate the timings.
+QUIET_LOGGERS: Sequence[str] = (
+    "lifx_breathing",
+    "breathing_engine",
+    "lifx_manager",
+    "inventory_refresher",
+    "lifx_protocol",
+    "supervisor",
+)
+
+# Metrics where a higher value is a regression. Everything else in the report is informational.
+REGRESSION_METRICS: Sequence[str] = (
+    "phase_error_ms_mean",
+    "phase_error_ms_p95",
+    "packets_per_cycle",
+    "discovery_seconds",
+    "cpu_ms_per_session_second",
+    "heap_kib_per_session",
+    "first_color_ms_median",
+)
+
+# Absolute slack added to every baseline value so that tiny baselines do not fail on scheduler noise.
+REGRESSION_SLACK: Dict[str, float] = {
+    "phase_error_ms_mean": 10.0,
+    "phase_error_ms_p95": 20.0,
+    "packets_per_cycle": 1.0,
+    "discovery_seconds": 0.25,
+    "cpu_ms_per_session_second": 1.0,
+    "heap_kib_per_session": 4.0,
+    "first_color_ms_median": 10.0,
+}
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class BenchmarkSettings:
+    phase_duration_ms: int = 1000
+    cycles: int = 5
+    latency_seconds: float = 0.005
+    loss_rate: float = 0.0
+    fade_lag_seconds: float = 0.02
+    discovery_bulb_counts: Sequence[int] = (1, 10, 100)
+    resource_session_count: int = 20
+    resource_seconds: float = 10.0
+    startup_trials: int = 10
+
+
+QUICK_SETTINGS: BenchmarkSettings = BenchmarkSettings(
+    cycles=3, resource_session_count=10, resource_seconds=4.0, startup_trials=5
+)
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    ordered: List[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize_phase_errors(arrival_times: Sequence[float], phase_duration_ms: int) -> Dict[str, float]:
+    """Compare the gaps between consecutive phase starts with the requested phase duration."""
+    errors: List[float] = [
+        abs((later - earlier) * 1000 - phase_duration_ms) for (earlier, later) in zip(arrival_times, arrival_times[1:])
+    ]
+    if not errors:
+        return {"phase_error_ms_mean": float("nan"), "phase_error_ms_p95": float("nan"), "phase_error_ms_max": 0.0}
+    return {
+        "phase_error_ms_mean": round(statistics.mean(errors), 2),
+        "phase_error_ms_p95": round(percentile(errors, 0.95), 2),
+        "phase_error_ms_max": round(max(errors), 2),
+    }
+
+
+async def _breathe(simulator: LifxSimulator, mode: BreathingMode, settings: BenchmarkSettings) -> None:
+    transport: LifxTransport = await LifxTransport.create()
+    try:
+        light: AsyncLight = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+        duration_ms: int = settings.phase_duration_ms
+        task: "asyncio.Task[None]" = asyncio.ensure_future(run_session(light, duration_ms, duration_ms, mode))
+        # Run for the requested cycles plus half a phase so the last set_waveform is always seen.
+        await asyncio.sleep(settings.cycles * 2 * duration_ms / 1000 + duration_ms / 2000)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    finally:
+        transport.close()
+
+
+def benchmark_breathing(mode: BreathingMode, settings: BenchmarkSettings) -> Dict[str, Any]:
+    logger.info(f"benchmark_breathing: {mode.value}")
+    with LifxSimulator(
+        bulb_count=1,
+        latency_seconds=settings.latency_seconds,
+        loss_rate=settings.loss_rate,
+        fade_lag_seconds=settings.fade_lag_seconds,
+        record_history=True,
+    ) as simulator:
+        asyncio.run(_breathe(simulator, mode, settings))
+        history: List[Message] = [message for (_, message) in simulator.history]
+        phase_starts: List[float] = [
+            arrived_at
+            for (arrived_at, message) in simulator.history
+            if message.message_type == SET_WAVEFORM_MESSAGE_TYPE
+        ]
+    cycles: float = max(len(phase_starts) / 2, 1)
+    result: Dict[str, Any] = summarize_phase_errors(phase_starts, settings.phase_duration_ms)
+    result["phases"] = len(phase_starts)
+    result["packets_per_cycle"] = round(len(history) / cycles, 2)
+    result["packets_by_type"] = dict(sorted(_count_types(history).items()))
+    return result
+
+
+def _count_types(messages: Iterable[Message]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for message in messages:
+        name: str = type(message).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def benchmark_discovery(bulb_count: int, settings: BenchmarkSettings, timeout_seconds: float = 60.0) -> Dict[str, Any]:
+    """
+    Time from constructing an empty LifxManager until every simulated bulb is in its inventory.
+
+    LifxLAN is told how many bulbs to expect so that its broadcast returns as soon as they have all answered instead of
+    listening for its fixed window; what is left is our own describe and merge path.
+    """
+    logger.info(f"benchmark_discovery: {bulb_count} bulbs")
+    with LifxSimulator(bulb_count=bulb_count, latency_seconds=settings.latency_seconds) as simulator:
+        with simulator.redirect_broadcasts():
+            started_at: float = time.perf_counter()
+            manager: LifxManager = LifxManager(lan=LifxLAN(num_lights=bulb_count))
+            try:
+                while len(manager.lights) < bulb_count and time.perf_counter() - started_at < timeout_seconds:
+                    time.sleep(0.005)
+                elapsed: float = time.perf_counter() - started_at
+                found: int = len(manager.lights)
+            finally:
+                manager.close()
+    return {"bulbs": bulb_count, "found": found, "discovery_seconds": round(elapsed, 3)}
+
+
+def resident_set_kib() -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def _measure_sessions(simulator: LifxSimulator, settings: BenchmarkSettings) -> Dict[str, Any]:
+    transport: LifxTransport = await LifxTransport.create()
+    try:
+        lights: List[AsyncLight] = [
+            AsyncLight(transport, bulb.mac_address, "127.0.0.1", simulator.port) for bulb in simulator.bulbs
+        ]
+        tracemalloc.start()
+        heap_before: int = tracemalloc.get_traced_memory()[0]
+        duration_ms: int = settings.phase_duration_ms
+        tasks: List["asyncio.Task[None]"] = [
+            asyncio.ensure_future(run_session(light, duration_ms, duration_ms)) for light in lights
+        ]
+        # Let every session read its bulb's state and settle into its first phase before measuring.
+        await asyncio.sleep(duration_ms / 1000)
+        heap_bytes: int = tracemalloc.get_traced_memory()[0] - heap_before
+        tracemalloc.stop()
+        cpu_before: float = time.thread_time()
+        await asyncio.sleep(settings.resource_seconds)
+        cpu_seconds: float = time.thread_time() - cpu_before
+        rss: Optional[int] = resident_set_kib()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        transport.close()
+
+    session_count: int = len(lights)
+    result: Dict[str, Any] = {
+        "sessions": session_count,
+        # CPU time of the event loop thread only; the simulator runs in its own threads.
+        "cpu_ms_per_session_second": round(cpu_seconds * 1000 / session_count / settings.resource_seconds, 3),
+        # Python heap allocated by starting the sessions; process RSS moves in pages and is too coarse to divide.
+        "heap_kib_per_session": round(heap_bytes / 1024 / session_count, 1),
+        "rss_kib": rss,
+    }
+    return result
+
+
+def benchmark_session_resources(settings: BenchmarkSettings) -> Dict[str, Any]:
+    logger.info(f"benchmark_session_resources: {settings.resource_session_count} sessions")
+    with LifxSimulator(bulb_count=settings.resource_session_count, latency_seconds=settings.latency_seconds) as simulator:
+        return asyncio.run(_measure_sessions(simulator, settings))
+
+
+def benchmark_startup(settings: BenchmarkSettings) -> Dict[str, Any]:
+    """
+    Time from BreathingEngine.start_nowait to the simulated bulb receiving its first colour change, on an engine that
+    is already running, as the web app's is. The import time of lifx_breathing.lifx is measured in a fresh interpreter
+    because that is what a command line session pays before it can send anything.
+    """
+    logger.info(f"benchmark_startup: {settings.startup_trials} trials")
+    first_color_ms: List[float] = []
+    with LifxSimulator(latency_seconds=settings.latency_seconds, record_history=True) as simulator:
+        bulb = simulator.bulbs[0]
+        light: LifxLightWrapper = LifxLightWrapper("Simulated", bulb.label, "127.0.0.1", bulb.mac_address)
+        engine: BreathingEngine = BreathingEngine(port=simulator.port)
+        try:
+            for _ in range(settings.startup_trials):
+                simulator.history.clear()
+                started_at: float = time.monotonic()
+                engine.start_nowait(light, settings.phase_duration_ms, settings.phase_duration_ms)
+                deadline: float = started_at + 2.0
+                while time.monotonic() < deadline:
+                    arrivals: List[float] = [
+                        arrived_at
+                        for (arrived_at, message) in list(simulator.history)
+                        if type(message).__name__ == "LightSetColor"
+                        or message.message_type == SET_WAVEFORM_MESSAGE_TYPE
+                    ]
+                    if arrivals:
+                        first_color_ms.append((arrivals[0] - started_at) * 1000)
+                        break
+                    time.sleep(0.001)
+                engine.stop(light)
+        finally:
+            engine.close()
+
+    import_seconds: List[float] = []
+    for _ in range(3):
+        output: str = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import time; t = time.perf_counter(); import lifx_breathing.lifx; print(time.perf_counter() - t)",
+            ],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        import_seconds.append(float(output))
+    return {
+        "first_color_ms_median": round(statistics.median(first_color_ms), 2) if first_color_ms else None,
+        "first_color_ms_max": round(max(first_color_ms), 2) if first_color_ms else None,
+        "cli_import_ms": round(min(import_seconds) * 1000, 1),
+    }
+
+
+def run_benchmarks(settings: BenchmarkSettings) -> Dict[str, Any]:
+    return {
+        "settings": dataclasses.asdict(settings),
+        "breathing": {mode.value: benchmark_breathing(mode, settings) for mode in BreathingMode},
+        "discovery": {str(count): benchmark_discovery(count, settings) for count in settings.discovery_bulb_counts},
+        "session_resources": benchmark_session_resources(settings),
+        "startup": benchmark_startup(settings),
+    }
+
+
+def _flatten(report: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    flat: Dict[str, Any] = {}
+    for (key, value) in report.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def find_regressions(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    current: Dict[str, Any] = _flatten(report)
+    regressions: List[str] = []
+    for (name, baseline_value) in _flatten(baseline).items():
+        metric: str = name.rsplit(".", 1)[-1]
+        value: Any = current.get(name)
+        if metric not in REGRESSION_METRICS or not isinstance(value, (int, float)) or baseline_value is None:
+            continue
+        limit: float = baseline_value * (1 + tolerance) + REGRESSION_SLACK[metric]
+        if value > limit:
+            regressions.append(f"{name}: {value} > {limit:.3f} (baseline {baseline_value})")
+    return regressions
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark lifx_breathing against simulated bulbs.")
+    parser.add_argument("--quick", action="store_true", help="Fewer cycles and a shorter resource window, for CI.")
+    parser.add_argument("--output", help="Write the JSON report to this file as well as stdout.")
+    parser.add_argument("--baseline", help="Fail if any metric is worse than this earlier JSON report.")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed relative regression (default: 0.5).")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args: argparse.Namespace = get_args()
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    report: Dict[str, Any] = run_benchmarks(QUICK_SETTINGS if args.quick else BenchmarkSettings())
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions: List[str] = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.error(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
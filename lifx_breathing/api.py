@@ -0,0 +1,196 @@
+"""
+JSON control API.
+
+A blueprint mounted under /api/v1 that starts, stops and reports on many lights in one request. Handlers only hand
+work to the BreathingEngine's event loop, or to a ShardedSessionHost's workers, and return 202 straight away; they
+never wait for a session to stop or for a bulb's original colour to be restored.
+
+curl -s localhost:5000/api/v1/lights
+curl -s -X POST localhost:5000/api/v1/sessions/start -H 'Content-Type: application/json' \
+    -d '{"lights": [{"location": "Office", "label": "Desk"}], "inhale_seconds": 4, "exhale_seconds": 6}'
+curl -s -X POST localhost:5000/api/v1/sessions/start -H 'Content-Type: application/json' \
+    -d '{"lights": [{"mac_address": "d0:73:d5:00:00:01"}], "inhale_seconds": 4, "profile": "box"}'
+curl -s -X POST localhost:5000/api/v1/sessions/stop -H 'Content-Type: application/json' -d '{"all": true}'
+
+A light is selected by {"mac_address": ...} or by {"location": ..., "label": ...}. Lights that are not in the
+inventory are reported per light in "not_found" instead of failing the whole batch. A start request may name a profile
+("classic", "box" or "4-7-8") or give its own "phases", each {"name", "seconds", "color": [h, s, b, k], "fade"}, and
+may pick the phase transition "cue" ("flash", "dip" or "pulse"). With "group": true the lights breathe in lockstep.
+Sessions run in polling mode unless the request asks for "mode": "scheduled"; profiles, custom phases and groups
+only run scheduled, and default to it.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import dataclasses
+import math
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("api")
+# -----------------------------------------------------------------------------
+
+from flask import Blueprint, jsonify, request
+
+from .lifx import BreathingMode, DEFAULT_BREATHING_MODE, DEFAULT_TRANSITION_CUE, TransitionCue
+from .lifx_manager import LifxLightWrapper, LifxManager, LightInventory
+from .profiles import MAX_PHASE_DURATION_MS, BreathingPhase, BreathingProfile, named_profile
+from .session_host import SessionController
+
+DEFAULT_PHASE_SECONDS: float = 5.0
+MINIMUM_PHASE_SECONDS: float = 1.0
+MAXIMUM_PHASE_SECONDS: float = MAX_PHASE_DURATION_MS / 1000.0
+
+
+class ApiError(Exception):
+    status_code: int = 400
+
+
+def _phase_duration_ms(body: Dict[str, Any], key: str) -> int:
+    value: Any = body.get(key, DEFAULT_PHASE_SECONDS)
+    # Flask's JSON parser accepts NaN and Infinity, which int() below would raise on.
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ApiError(f"{key} must be a number of seconds")
+    if value > MAXIMUM_PHASE_SECONDS:
+        raise ApiError(f"{key} must be at most {MAXIMUM_PHASE_SECONDS:g} seconds")
+    return int(max(value, MINIMUM_PHASE_SECONDS) * 1000)
+
+
+def _profile(body: Dict[str, Any], inhale_duration_ms: int, exhale_duration_ms: int) -> Optional[BreathingProfile]:
+    try:
+        if "phases" in body:
+            phases: Any = body["phases"]
+            if not isinstance(phases, list):
+                raise ApiError("phases must be a list")
+            return BreathingProfile(
+                str(body.get("profile", "custom")),
+                tuple(
+                    BreathingPhase(
+                        str(phase.get("name", "phase")),
+                        _phase_duration_ms(phase, "seconds"),
+                        tuple(phase["color"]),
+                        bool(phase.get("fade", True)),
+                    )
+                    for phase in phases
+                ),
+            )
+        if "profile" in body:
+            return named_profile(str(body["profile"]), inhale_duration_ms, exhale_duration_ms)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ApiError(f"invalid profile: {e}")
+    return None
+
+
+def _light_json(light: LifxLightWrapper, engine: SessionController) -> Dict[str, Any]:
+    light_json: Dict[str, Any] = dataclasses.asdict(light)
+    light_json["is_running"] = engine.is_running(light)
+    light_json["state"] = engine.session_state(light).value
+    return light_json
+
+
+def _resolve_lights(
+    inventory: LightInventory, selectors: Any
+) -> Tuple[List[LifxLightWrapper], List[Dict[str, Any]]]:
+    if not isinstance(selectors, list):
+        raise ApiError("lights must be a list")
+    found: List[LifxLightWrapper] = []
+    not_found: List[Dict[str, Any]] = []
+    for selector in selectors:
+        if not isinstance(selector, dict):
+            raise ApiError("each light must be an object")
+        light: Optional[LifxLightWrapper]
+        if "mac_address" in selector:
+            if not isinstance(selector["mac_address"], str):
+                raise ApiError("mac_address must be a string")
+            light = inventory.get_by_mac_address(selector["mac_address"].lower())
+        elif "location" in selector and "label" in selector:
+            if not isinstance(selector["location"], str) or not isinstance(selector["label"], str):
+                raise ApiError("location and label must be strings")
+            light = inventory.get(selector["location"], selector["label"])
+        else:
+            raise ApiError("each light needs a mac_address or a location and label")
+        if light is None:
+            not_found.append(selector)
+        elif light not in found:
+            found.append(light)
+    return found, not_found
+
+
+def create_api_blueprint(manager: LifxManager, engine: SessionController) -> Blueprint:
+    api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+    def request_body() -> Dict[str, Any]:
+        body: Any = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise ApiError("request body must be a JSON object")
+        return body
+
+    @api.errorhandler(ApiError)
+    def handle_api_error(error: ApiError) -> Any:
+        return jsonify(error=str(error)), error.status_code
+
+    @api.route("/lights", methods=["GET"])
+    def lights() -> Any:
+        return jsonify(lights=[_light_json(light, engine) for light in manager.inventory])
+
+    @api.route("/sessions", methods=["GET"])
+    def sessions() -> Any:
+        return jsonify(lights=[_light_json(light, engine) for light in engine.running_lights])
+
+    @api.route("/sessions/status", methods=["POST"])
+    def sessions_status() -> Any:
+        found, not_found = _resolve_lights(manager.inventory, request_body().get("lights"))
+        return jsonify(lights=[_light_json(light, engine) for light in found], not_found=not_found)
+
+    @api.route("/sessions/start", methods=["POST"])
+    def sessions_start() -> Any:
+        body: Dict[str, Any] = request_body()
+        inhale_duration_ms: int = _phase_duration_ms(body, "inhale_seconds")
+        exhale_duration_ms: int = _phase_duration_ms(body, "exhale_seconds")
+        # Profiles and groups only run scheduled, so a request for either that does not name a mode gets that one.
+        default_mode: BreathingMode = (
+            BreathingMode.SCHEDULED
+            if "profile" in body or "phases" in body or body.get("group")
+            else DEFAULT_BREATHING_MODE
+        )
+        try:
+            mode: BreathingMode = BreathingMode(body.get("mode", default_mode.value))
+        except ValueError:
+            raise ApiError(f"mode must be one of {[mode.value for mode in BreathingMode]}")
+        profile: Optional[BreathingProfile] = _profile(body, inhale_duration_ms, exhale_duration_ms)
+        if profile is not None and mode is not BreathingMode.SCHEDULED:
+            raise ApiError("profiles need scheduled mode")
+        try:
+            cue: TransitionCue = TransitionCue(body.get("cue", DEFAULT_TRANSITION_CUE.value))
+        except ValueError:
+            raise ApiError(f"cue must be one of {[cue.value for cue in TransitionCue]}")
+        if body.get("group") and mode is not BreathingMode.SCHEDULED:
+            raise ApiError("group sessions need scheduled mode")
+        found, not_found = _resolve_lights(manager.inventory, body.get("lights"))
+        logger.info(f"sessions_start: {len(found)} lights, group: {bool(body.get('group'))}")
+
+        if body.get("group") and found:
+            engine.start_group_nowait(found, inhale_duration_ms, exhale_duration_ms, profile, cue)
+        else:
+            for light in found:
+                engine.start_nowait(light, inhale_duration_ms, exhale_duration_ms, mode, profile=profile, cue=cue)
+        return jsonify(starting=[dataclasses.asdict(light) for light in found], not_found=not_found), 202
+
+    @api.route("/sessions/stop", methods=["POST"])
+    def sessions_stop() -> Any:
+        body: Dict[str, Any] = request_body()
+        found: List[LifxLightWrapper]
+        not_found: List[Dict[str, Any]] = []
+        if body.get("all"):
+            found = engine.running_lights
+        else:
+            found, not_found = _resolve_lights(manager.inventory, body.get("lights"))
+        logger.info(f"sessions_stop: {len(found)} lights")
+
+        for light in found:
+            engine.stop_nowait(light)
+        return jsonify(stopping=[dataclasses.asdict(light) for light in found], not_found=not_found), 202
+
+    return api
@@ -0,0 +1,144 @@
+"""
+Discovery across several subnets and unicast IP ranges at once.
+
+lifxlan.LifxLAN broadcasts GetService on the networks it can see from the default interfaces. A host on several VLANs,
+or bulbs behind a router that does not forward broadcasts, needs discovery pointed at them explicitly. SubnetDiscovery
+takes a list of targets:
+
+- a subnet in CIDR notation, 192.168.10.0/24, reached through its directed broadcast address 192.168.10.255,
+- a unicast range, 10.0.5.10-10.0.5.60, or a single address, 10.0.5.7, each probed address by address,
+- "default", the broadcast addresses lifxlan finds on the local interfaces,
+
+each optionally followed by :port. One scan sends GetService to every target from one socket and then listens once
+for all of them, so a scan takes one response window however many subnets it covers. Replies are merged by MAC
+address, so a bulb that answers on two targets is found once.
+
+The web app reads its targets from LIFX_BREATHING_DISCOVERY, separated by commas. Without it LifxManager discovers
+through lifxlan as before.
+
+from lifx_breathing.discovery import SubnetDiscovery
+discovery = SubnetDiscovery.from_config("192.168.10.0/24,192.168.20.0/24,10.0.5.10-10.0.5.60")
+discovery.scan()  # {mac_address: (ip_address, port)}
+"""
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import dataclasses
+import ipaddress
+import random
+import socket
+import time
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("discovery")
+# -----------------------------------------------------------------------------
+
+from lifxlan.device import UDP_BROADCAST_IP_ADDRS, UDP_BROADCAST_PORT
+from lifxlan.message import BROADCAST_MAC, Message
+from lifxlan.msgtypes import GetService, StateService
+from lifxlan.unpack import unpack_lifx_message
+
+Address = Tuple[str, int]
+
+# A scan sends its GetService packets ATTEMPTS times, spread across one RESPONSE_WINDOW_SECONDS.
+RESPONSE_WINDOW_SECONDS: float = 1.0
+ATTEMPTS: int = 3
+
+# A unicast range larger than this is almost certainly a typo for a subnet.
+MAX_RANGE_ADDRESSES: int = 4096
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class DiscoveryTarget:
+    addresses: Tuple[str, ...]
+    port: int = UDP_BROADCAST_PORT
+
+    # Broadcast targets are sent every attempt; unicast addresses are skipped once they have answered.
+    broadcast: bool = False
+
+    @classmethod
+    def parse(cls, spec: str) -> "DiscoveryTarget":
+        spec = spec.strip()
+        port: int = UDP_BROADCAST_PORT
+        if spec.count(":") == 1:
+            (spec, port_spec) = spec.split(":")
+            port = int(port_spec)
+        if spec == "default":
+            return cls(tuple(UDP_BROADCAST_IP_ADDRS), port, broadcast=True)
+        if "/" in spec:
+            network: ipaddress.IPv4Network = ipaddress.IPv4Network(spec, strict=False)
+            return cls((str(network.broadcast_address),), port, broadcast=True)
+        (first, _, last) = spec.partition("-")
+        start: int = int(ipaddress.IPv4Address(first))
+        end: int = int(ipaddress.IPv4Address(last)) if last else start
+        if not 0 <= end - start < MAX_RANGE_ADDRESSES:
+            raise ValueError(f"discovery range {spec} must hold between 1 and {MAX_RANGE_ADDRESSES} addresses")
+        return cls(tuple(str(ipaddress.IPv4Address(address)) for address in range(start, end + 1)), port)
+
+
+class SubnetDiscovery:
+    targets: Tuple[DiscoveryTarget, ...]
+    _source_id: int
+
+    def __init__(self, targets: Iterable[DiscoveryTarget]) -> None:
+        self.targets = tuple(targets)
+        self._source_id = random.randrange(2, 1 << 32)
+
+    @classmethod
+    def from_config(cls, config: Optional[str]) -> Optional["SubnetDiscovery"]:
+        """Discovery over the comma-separated targets in config, or None when config is empty."""
+        specs: List[str] = [spec for spec in (config or "").split(",") if spec.strip()]
+        return cls(DiscoveryTarget.parse(spec) for spec in specs) if specs else None
+
+    def __repr__(self) -> str:
+        return f"SubnetDiscovery({len(self.targets)} targets)"
+
+    def scan(
+        self, attempts: int = ATTEMPTS, window_seconds: float = RESPONSE_WINDOW_SECONDS
+    ) -> Dict[str, Address]:
+        """Send GetService to every target at once and return the {MAC address: (IP address, port)} that answered."""
+        found: Dict[str, Address] = {}
+        answered: Set[str] = set()
+        message: Message = GetService(BROADCAST_MAC, self._source_id, 0, {}, False, True)
+        started_at: float = time.monotonic()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind(("", 0))
+            for attempt in range(attempts):
+                for target in self.targets:
+                    for ip_address in target.addresses:
+                        if not target.broadcast and ip_address in answered:
+                            continue
+                        try:
+                            sock.sendto(message.packed_message, (ip_address, target.port))
+                        except OSError as e:
+                            # An unreachable subnet must not stop the scan of the others.
+                            logger.debug("could not send discovery to %s: %s", ip_address, e)
+                self._receive(sock, started_at + window_seconds * (attempt + 1) / attempts, found, answered)
+        logger.info(f"discovery scan of {len(self.targets)} targets found {len(found)} bulbs")
+        return found
+
+    def _receive(self, sock: socket.socket, deadline: float, found: Dict[str, Address], answered: Set[str]) -> None:
+        while True:
+            remaining: float = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            sock.settimeout(remaining)
+            try:
+                data, (ip_address, _) = sock.recvfrom(1024)
+            except socket.timeout:
+                return
+            except OSError:
+                # An ICMP port unreachable from a unicast target surfaces here on some platforms.
+                continue
+            try:
+                response: Message = unpack_lifx_message(data)
+            except Exception:
+                continue
+            if not isinstance(response, StateService) or response.source_id != self._source_id:
+                continue
+            answered.add(ip_address)
+            found.setdefault(response.target_addr, (ip_address, response.port))
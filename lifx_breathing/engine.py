@@ -0,0 +1,412 @@
+"""
+In-process breathing engine.
+
+Every breathing session is an asyncio task on a single event loop that runs in a background thread, and every
+session shares one UDP socket. This replaces starting a separate `python lifx.py` interpreter per light. Sessions are
+wrapped in a SupervisedSession, which restarts crashed sessions with backoff and reports their lifecycle state.
+
+With a SessionJournal, the engine journals every session it starts and, when it is created, takes back the sessions
+a previous process left open: it restarts them with their recorded original state, or with resume_sessions=False
+only puts their bulbs back the way they were.
+
+With a StatusUpdates sink, every session publishes its state, phase and timing keyed by MAC address, which the web
+app streams to dashboards. With a TraceRecorder, every session records the timing of each of its phases.
+
+from lifx_breathing.engine import BreathingEngine
+engine = BreathingEngine()
+engine.start(light, inhale_duration_ms=5000, exhale_duration_ms=5000)
+engine.is_running(light)
+engine.session_state(light)
+engine.stop_nowait(light)
+engine.start_group([desk_lamp, floor_lamp], inhale_duration_ms=5000, exhale_duration_ms=5000)
+engine.start(light, 4000, 4000, profile=box_profile(count_ms=4000))
+engine.start(light, 5000, 5000, cue=TransitionCue.DIP)
+engine.close()
+engine = BreathingEngine(journal=SessionJournal())
+"""
+
+from typing import Any, Coroutine, Dict, List, Optional, Sequence, Tuple, TypeVar
+import asyncio
+import concurrent.futures
+import dataclasses
+import functools
+import threading
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("breathing_engine")
+# -----------------------------------------------------------------------------
+
+from . import metrics
+from .journal import JournaledSession, SessionJournal, SessionSpec
+from .latency import LatencyStore
+from .lifx import (
+    BreathingMode,
+    DEFAULT_BREATHING_MODE,
+    DEFAULT_TRANSITION_CUE,
+    OriginalState,
+    OriginalStateCallback,
+    StatusCallback,
+    TransitionCue,
+    run_group_session,
+    run_session,
+)
+from .lifx_manager import LifxLightWrapper
+from .pid import DEFAULT_PID_GAINS, PidGains
+from .profiles import BreathingProfile
+from .protocol import LIFX_PORT, AsyncLight, AsyncLightGroup, LifxTransport
+from .status_stream import StatusUpdates
+from .trace import TraceRecorder
+from .tuning import GainStore
+from .supervisor import DEFAULT_RESTART_POLICY, RestartPolicy, SessionFactory, SessionState, SupervisedSession
+
+T = TypeVar("T")
+
+
+def _call_both(
+    first: OriginalStateCallback, second: OriginalStateCallback, mac_address: str, original_state: OriginalState
+) -> None:
+    first(mac_address, original_state)
+    second(mac_address, original_state)
+
+
+class BreathingEngine:
+    STOP_TIMEOUT_SECONDS: float = 5.0
+
+    _loop: asyncio.AbstractEventLoop
+    _thread: threading.Thread
+    _transport: LifxTransport
+    _restart_policy: RestartPolicy
+    _latency_store: Optional[LatencyStore]
+    _journal: Optional[SessionJournal]
+    _status: Optional[StatusUpdates]
+    _trace_recorder: Optional[TraceRecorder]
+    _gain_store: Optional[GainStore]
+    _port: int
+
+    # Every light maps to the session that drives it: one light for a normal session, all members for a group
+    # session. A session stays here while it restores its lights after a stop, and after it has FAILED, so that its
+    # state can still be reported.
+    _sessions: Dict[LifxLightWrapper, SupervisedSession]
+
+    def __init__(
+        self,
+        restart_policy: RestartPolicy = DEFAULT_RESTART_POLICY,
+        latency_store: Optional[LatencyStore] = None,
+        port: int = LIFX_PORT,
+        journal: Optional[SessionJournal] = None,
+        resume_sessions: bool = True,
+        status: Optional[StatusUpdates] = None,
+        trace_recorder: Optional[TraceRecorder] = None,
+        gain_store: Optional[GainStore] = None,
+    ) -> None:
+        logger.info("__init__ entry")
+        self._loop = asyncio.new_event_loop()
+        self._restart_policy = restart_policy
+        self._latency_store = latency_store
+        self._journal = journal
+        self._status = status
+        self._trace_recorder = trace_recorder
+        self._gain_store = gain_store
+        self._port = port
+        self._sessions = {}
+        self._thread = threading.Thread(target=self._run_loop, name="breathing-engine", daemon=True)
+        self._thread.start()
+        self._transport = self._call(LifxTransport.create())
+        metrics.ACTIVE_SESSIONS.set_function(self._active_session_count)
+        if journal is not None and journal.open_sessions:
+            self._call(self._recover(journal.open_sessions, resume_sessions))
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _submit(self, coroutine: Coroutine[Any, Any, T]) -> "concurrent.futures.Future[T]":
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _call(self, coroutine: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        return self._submit(coroutine).result(timeout)
+
+    def start(
+        self,
+        light: LifxLightWrapper,
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        mode: BreathingMode = DEFAULT_BREATHING_MODE,
+        gains: Optional[PidGains] = None,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> None:
+        self.start_nowait(light, inhale_duration_ms, exhale_duration_ms, mode, gains, profile, cue).result()
+
+    def start_nowait(
+        self,
+        light: LifxLightWrapper,
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        mode: BreathingMode = DEFAULT_BREATHING_MODE,
+        gains: Optional[PidGains] = None,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> "concurrent.futures.Future[None]":
+        logger.info(
+            f"start entry: {light}, mode: {mode.value}, profile: {profile.name if profile else None}, cue: {cue.value}"
+        )
+        if profile is not None and mode is not BreathingMode.SCHEDULED:
+            # Fail here rather than inside the session, where the supervisor would keep restarting it.
+            raise ValueError("breathing profiles need scheduled mode")
+        return self._submit(self._start(light, inhale_duration_ms, exhale_duration_ms, mode, gains, profile, cue))
+
+    def start_group(
+        self,
+        lights: Sequence[LifxLightWrapper],
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> None:
+        """Breathe lights in lockstep from one shared phase clock. Stopping any member stops the whole group."""
+        self.start_group_nowait(lights, inhale_duration_ms, exhale_duration_ms, profile, cue).result()
+
+    def start_group_nowait(
+        self,
+        lights: Sequence[LifxLightWrapper],
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> "concurrent.futures.Future[None]":
+        logger.info(f"start_group entry: {list(lights)}, profile: {profile.name if profile else None}")
+        return self._submit(self._start_group(tuple(lights), inhale_duration_ms, exhale_duration_ms, profile, cue))
+
+    def start_spec_nowait(
+        self,
+        spec: SessionSpec,
+        original_states: Optional[Dict[str, OriginalState]] = None,
+        on_original_state: Optional[OriginalStateCallback] = None,
+    ) -> "concurrent.futures.Future[None]":
+        """
+        Start the session spec describes. Lights in original_states are restored to that state rather than to the one
+        read at start, and on_original_state is called with each light's state as soon as it has been read.
+        """
+        logger.info(f"start_spec entry: {list(spec.lights)}, group: {spec.group}")
+        if spec.profile is not None and spec.mode is not BreathingMode.SCHEDULED:
+            raise ValueError("breathing profiles need scheduled mode")
+        return self._submit(self._start_spec(spec, original_states, on_original_state))
+
+    def stop(self, light: LifxLightWrapper) -> None:
+        self.stop_nowait(light).result()
+
+    def stop_nowait(self, light: LifxLightWrapper) -> "concurrent.futures.Future[None]":
+        """Cancel the light's session and return at once; the original colour is restored in the background."""
+        logger.info(f"stop entry: {light}")
+        return self._submit(self._stop(light))
+
+    def is_running(self, light: LifxLightWrapper) -> bool:
+        session: Optional[SupervisedSession] = self._sessions.get(light)
+        return session is not None and session.is_active
+
+    def session_state(self, light: LifxLightWrapper) -> SessionState:
+        session: Optional[SupervisedSession] = self._sessions.get(light)
+        return session.state if session is not None else SessionState.STOPPED
+
+    def session_states(self) -> Dict[LifxLightWrapper, SessionState]:
+        """Every light that has a session, including sessions that are stopping or FAILED, and its state."""
+        return {light: session.state for (light, session) in list(self._sessions.items())}
+
+    def _active_session_count(self) -> int:
+        # A group session drives several lights, so count sessions rather than lights.
+        return len({id(session) for session in list(self._sessions.values()) if session.is_active})
+
+    @property
+    def running_lights(self) -> List[LifxLightWrapper]:
+        return [light for light in list(self._sessions) if self.is_running(light)]
+
+    def close(self) -> None:
+        logger.info("close entry")
+        self._call(self._close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        if self._journal is not None:
+            self._journal.flush()
+
+    async def _start(
+        self,
+        light: LifxLightWrapper,
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        mode: BreathingMode,
+        gains: Optional[PidGains],
+        profile: Optional[BreathingProfile],
+        cue: TransitionCue,
+    ) -> None:
+        await self._start_spec(SessionSpec((light,), inhale_duration_ms, exhale_duration_ms, mode, gains, profile, cue))
+
+    async def _start_group(
+        self,
+        lights: Tuple[LifxLightWrapper, ...],
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        profile: Optional[BreathingProfile],
+        cue: TransitionCue,
+    ) -> None:
+        await self._start_spec(
+            SessionSpec(
+                lights,
+                inhale_duration_ms,
+                exhale_duration_ms,
+                BreathingMode.SCHEDULED,
+                profile=profile,
+                cue=cue,
+                group=True,
+            )
+        )
+
+    async def _start_spec(
+        self,
+        spec: SessionSpec,
+        original_states: Optional[Dict[str, OriginalState]] = None,
+        on_original_state: Optional[OriginalStateCallback] = None,
+    ) -> None:
+        await asyncio.gather(*(self._stop(light) for light in spec.lights))
+        if spec.mode is BreathingMode.POLLING and spec.gains is None:
+            # Look up the tuned gains once, here, so that the journal records the gains the session runs with and a
+            # resumed session keeps them even if the light has been retuned since.
+            gains: PidGains = (
+                self._gain_store.get(spec.lights[0].mac_address) if self._gain_store is not None else DEFAULT_PID_GAINS
+            )
+            spec = dataclasses.replace(spec, gains=gains)
+        # Shared by every restart of the session, so that a restart restores the colour from before the first start.
+        session_original_states: Dict[str, OriginalState] = dict(original_states or {})
+        session_id: Optional[str] = None
+        if self._journal is not None:
+            session_id = self._journal.record_start(spec, session_original_states)
+            record_original_state: OriginalStateCallback = functools.partial(
+                self._journal.record_original_state, session_id
+            )
+            on_original_state = (
+                record_original_state
+                if on_original_state is None
+                else functools.partial(_call_both, record_original_state, on_original_state)
+            )
+        on_status: Optional[StatusCallback] = (
+            functools.partial(self._publish_status, spec.lights) if self._status is not None else None
+        )
+
+        factory: SessionFactory
+        if spec.group:
+            group: AsyncLightGroup = AsyncLightGroup(
+                self._transport,
+                [AsyncLight(self._transport, light.mac_address, light.ip_address, self._port) for light in spec.lights],
+            )
+            factory = lambda: run_group_session(
+                group,
+                spec.inhale_duration_ms,
+                spec.exhale_duration_ms,
+                spec.profile,
+                spec.cue,
+                session_original_states,
+                on_original_state,
+                on_status,
+                self._trace_recorder,
+            )
+        else:
+            light: LifxLightWrapper = spec.lights[0]
+            async_light: AsyncLight = AsyncLight(self._transport, light.mac_address, light.ip_address, self._port)
+            factory = lambda: run_session(
+                async_light,
+                spec.inhale_duration_ms,
+                spec.exhale_duration_ms,
+                spec.mode,
+                spec.gains,
+                spec.profile,
+                self._latency_store,
+                spec.cue,
+                session_original_states,
+                on_original_state,
+                on_status,
+                self._trace_recorder,
+            )
+        self._add_session(spec.lights, factory, session_id)
+
+    def _add_session(
+        self, lights: Tuple[LifxLightWrapper, ...], factory: SessionFactory, session_id: Optional[str]
+    ) -> None:
+        session: SupervisedSession = SupervisedSession(
+            lights,
+            factory,
+            self._restart_policy,
+            (lambda state: self._publish_status(lights, {"state": state.value})) if self._status is not None else None,
+        )
+        session.start(self._loop).add_done_callback(lambda _: self._on_session_done(session, session_id))
+        for light in lights:
+            self._sessions[light] = session
+
+    def _publish_status(self, lights: Tuple[LifxLightWrapper, ...], fields: Dict[str, Any]) -> None:
+        assert self._status is not None
+        for light in lights:
+            self._status.publish(light.mac_address, fields)
+
+    async def _recover(self, journaled_sessions: List[JournaledSession], resume_sessions: bool) -> None:
+        """Take back the sessions a previous process left open in the journal."""
+        assert self._journal is not None
+        for journaled in journaled_sessions:
+            logger.info(
+                f"{'resuming' if resume_sessions else 'restoring lights of'} journaled session for "
+                f"{list(journaled.spec.lights)}"
+            )
+            if resume_sessions:
+                await self._start_spec(journaled.spec, journaled.original_states)
+        if not resume_sessions:
+            await asyncio.gather(*(self._restore(journaled) for journaled in journaled_sessions))
+        for journaled in journaled_sessions:
+            self._journal.record_stop(journaled.session_id)
+
+    async def _restore(self, journaled: JournaledSession) -> None:
+        lights: List[AsyncLight] = [
+            AsyncLight(self._transport, light.mac_address, light.ip_address, self._port)
+            for light in journaled.spec.lights
+            if light.mac_address in journaled.original_states
+        ]
+        results: List[Any] = await asyncio.gather(
+            *(light.set_color(journaled.original_states[light.mac_address][0], rapid=False) for light in lights),
+            *(light.set_power(journaled.original_states[light.mac_address][1], rapid=False) for light in lights),
+            return_exceptions=True,
+        )
+        for error in (result for result in results if isinstance(result, BaseException)):
+            logger.warning(f"failed to restore a light of journaled session {journaled.session_id}: {error!r}")
+
+    async def _stop(self, light: LifxLightWrapper) -> None:
+        session: Optional[SupervisedSession] = self._sessions.get(light)
+        if session is None:
+            return
+        session.stop()
+        # Wait for run_session to restore the original colour, but never forever.
+        (_, pending) = await asyncio.wait([session.task], timeout=self.STOP_TIMEOUT_SECONDS)
+        if pending:
+            # Interrupt the restore rather than leave a session running that the engine no longer tracks.
+            logger.warning(f"session for {list(session.lights)} did not stop within {self.STOP_TIMEOUT_SECONDS} s")
+            session.task.cancel()
+        self._forget(session)
+
+    async def _close(self) -> None:
+        await asyncio.gather(*(self._stop(light) for light in list(self._sessions)))
+        self._transport.close()
+
+    def _forget(self, session: SupervisedSession) -> None:
+        for light in session.lights:
+            if self._sessions.get(light) is session:
+                del self._sessions[light]
+
+    def _on_session_done(self, session: SupervisedSession, session_id: Optional[str]) -> None:
+        # Every run of the session restores its lights on the way out, so even a FAILED session has nothing left to
+        # take back.
+        if self._journal is not None and session_id is not None:
+            self._journal.record_stop(session_id)
+        if session.state is SessionState.FAILED:
+            logger.error(f"session for {list(session.lights)} failed: {session.last_error!r}")
+        else:
+            self._forget(session)
@@ -11,48 +11,43 @@ cd /Users/asimi/Dropbox/Private/Programming/lifx-breathing
 mkdir -p /tmp/lifx_breathing_logs/
 FLASK_SECRET_KEY=secret_key supervisord --configuration supervisord.conf --nodaemon
 
+### Sharding sessions across worker processes
+
+LIFX_BREATHING_WORKERS=auto FLASK_APP=lifx_breathing/flask_app.py FLASK_SECRET_KEY=secret_key flask run
+
 """
 
 import dataclasses
 import os
-import os.path
-import signal
-import subprocess
-import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Sequence
 
 # -----------------------------------------------------------------------------
 # create logger
 # -----------------------------------------------------------------------------
-import logging
-
-logger = logging.getLogger("flask_app")
-logger.setLevel(logging.DEBUG)
-
-# create console handler and set level to debug
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-
-# create formatter
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+from .log_queue import get_logger
 
-# add formatter to ch
-ch.setFormatter(formatter)
-
-# add ch to logger
-logger.addHandler(ch)
+logger = get_logger("flask_app")
 # -----------------------------------------------------------------------------
 
-from .lifx_manager import LifxManager, LifxLightWrapper
-
-script_path: str = os.path.dirname(os.path.realpath(__file__))
-lifx_path: str = os.path.join(script_path, "lifx.py")
-processes: Dict[LifxLightWrapper, Any] = {}
-
-manager = LifxManager()
-first_load: bool = True
-
-from flask import Flask, render_template, redirect, url_for
+from .api import create_api_blueprint
+from .discovery import SubnetDiscovery
+from .metrics import REGISTRY
+from .profiles import MAX_PHASE_DURATION_MS
+from .lifx_manager import DeviceCache, LifxManager, LifxLightWrapper
+from .session_host import SessionController, create_session_controller
+from .status_stream import StatusBroadcaster
+from .supervisor import SessionState
+
+# LIFX_BREATHING_DISCOVERY lists the subnets and IP ranges to discover lights on, separated by commas, for example
+# "192.168.10.0/24,10.0.5.10-10.0.5.60"; unset discovers on the local interfaces through lifxlan.
+manager = LifxManager(
+    cache=DeviceCache(), discovery=SubnetDiscovery.from_config(os.getenv("LIFX_BREATHING_DISCOVERY"))
+)
+status = StatusBroadcaster()
+# LIFX_BREATHING_WORKERS=N (or "auto", one per core) shards sessions across worker processes; unset runs them here.
+engine: SessionController = create_session_controller(os.getenv("LIFX_BREATHING_WORKERS"), status)
+
+from flask import Flask, Response, render_template, redirect, url_for
 from flask_wtf import FlaskForm
 from wtforms import HiddenField, TextField
 from flask_wtf.csrf import CSRFProtect
@@ -60,6 +55,7 @@ from flask_wtf.csrf import CSRFProtect
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
 csrf = CSRFProtect(app)
+app.register_blueprint(csrf.exempt(create_api_blueprint(manager, engine)))
 
 
 class UpdateLightsForm(FlaskForm):
@@ -88,22 +84,19 @@ class LightAndForms:
     start_form: StartLightForm
     stop_form: StopLightForm
     is_running: bool
+    state: SessionState
 
 
 @app.route("/", methods=["GET"])
 def index() -> Any:
-    global first_load
-    if first_load:
-        manager.update_lights()
-        first_load = False
-    trim_processes()
-    lights: List[LifxLightWrapper] = manager.lights
+    lights: Sequence[LifxLightWrapper] = manager.lights
     lights_and_forms = [
         LightAndForms(
             light=light,
             start_form=StartLightForm(location=light.location, label=light.label),
             stop_form=StopLightForm(location=light.location, label=light.label),
-            is_running=light in processes,
+            is_running=engine.is_running(light),
+            state=engine.session_state(light),
         )
         for light in lights
     ]
@@ -115,10 +108,25 @@ def index() -> Any:
 
 @app.route("/update_lights", methods=["POST"])
 def update_lights() -> Any:
-    manager.update_lights()
+    manager.update_lights_in_background()
     return redirect(url_for("index"))
 
 
+@app.route("/status", methods=["GET"])
+def status_stream() -> Any:
+    # Every open dashboard shares the frames the broadcaster has already encoded; nothing is rendered per client.
+    return Response(
+        status.stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics() -> Any:
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/favicon.ico", methods=["GET"])
 def favicon() -> Any:
     return app.send_static_file("favicon.ico")
@@ -139,17 +147,17 @@ def start_light() -> Any:
     inhale_seconds_ms: int = 5000
     inhale_seconds_input: str = data["inhale_seconds"]
     if inhale_seconds_input.isdigit():
-        inhale_seconds_ms = max(int(inhale_seconds_input) * 1000, 1000)
+        inhale_seconds_ms = min(max(int(inhale_seconds_input) * 1000, 1000), MAX_PHASE_DURATION_MS)
 
     exhale_seconds_ms: int = 5000
     exhale_seconds_input: str = data["exhale_seconds"]
     if exhale_seconds_input.isdigit():
-        exhale_seconds_ms = max(int(exhale_seconds_input) * 1000, 1000)
+        exhale_seconds_ms = min(max(int(exhale_seconds_input) * 1000, 1000), MAX_PHASE_DURATION_MS)
 
     light: Optional[LifxLightWrapper] = manager.get_light(location, label)
     if light is None:
         raise LightNotFoundError
-    start_process(light, inhale_seconds_ms, exhale_seconds_ms)
+    engine.start(light, inhale_seconds_ms, exhale_seconds_ms)
     return redirect(url_for("index"))
 
 
@@ -162,49 +170,6 @@ def stop_light() -> Any:
     light: Optional[LifxLightWrapper] = manager.get_light(location, label)
     if light is None:
         raise LightNotFoundError
-    stop_process(light)
+    engine.stop_nowait(light)
     return redirect(url_for("index"))
 
-
-def start_process(light: LifxLightWrapper, inhale_seconds_ms: int, exhale_seconds_ms: int) -> None:
-    global processes
-    if light in processes:
-        stop_process(light)
-
-    command: List[str] = [
-        "python",
-        lifx_path,
-        "--ip-address",
-        light.ip_address,
-        "--mac-address",
-        light.mac_address,
-        "--inhale-duration-ms",
-        str(inhale_seconds_ms),
-        "--exhale-duration-ms",
-        str(exhale_seconds_ms),
-    ]
-    process = subprocess.Popen(command)
-    processes[light] = process
-
-
-def stop_process(light: LifxLightWrapper) -> None:
-    global processes
-    process: subprocess.Popen[Any] = processes[light]
-    if process.poll() is None:
-        process.terminate()
-        start: float = time.perf_counter()
-        while process.poll() is None:
-            time.sleep(0.1)
-            if time.perf_counter() - start > 5.0:
-                process.kill()
-                break
-    del processes[light]
-
-
-def trim_processes() -> None:
-    lights_to_stop: List[LifxLightWrapper] = [
-        light for (light, process) in processes.items() if process.poll() is not None
-    ]
-    for light in lights_to_stop:
-        logger.info(f"trim_processes is stopping light: {light}")
-        stop_process(light)
@@ -0,0 +1,181 @@
+"""
+Incremental refresh of the LifxManager inventory.
+
+Instead of rediscovering every bulb on a fixed interval, the refresher broadcasts a single GetService packet every
+SWEEP_INTERVAL_SECONDS and listens for the StateService replies (and any other LIFX state packets that reach its
+socket). Only bulbs that look stale are re-probed for their label and location:
+
+- a MAC address that is not in the inventory (a new bulb),
+- a MAC address that answers from a different IP address (a bulb that moved),
+- a bulb whose label and location have not been confirmed for DESCRIPTION_MAX_AGE_SECONDS.
+
+A bulb that misses MISSED_SWEEPS_BEFORE_REMOVAL sweeps in a row is removed. When the manager discovers through a
+SubnetDiscovery, each sweep is one scan of its subnets and ranges instead.
+"""
+
+from typing import Any, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+import dataclasses
+import random
+import socket
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("inventory_refresher")
+# -----------------------------------------------------------------------------
+
+from lifxlan.device import UDP_BROADCAST_IP_ADDRS, UDP_BROADCAST_PORT
+from lifxlan.message import BROADCAST_MAC, Message
+from lifxlan.msgtypes import GetService
+from lifxlan.unpack import unpack_lifx_message
+
+if TYPE_CHECKING:
+    from .discovery import SubnetDiscovery
+    from .lifx_manager import LifxLightWrapper, LifxManager, LightInventory
+
+Address = Tuple[str, int]
+
+
+def _astuple_or_none(light: Optional["LifxLightWrapper"]) -> Optional[Tuple[Any, ...]]:
+    return dataclasses.astuple(light) if light is not None else None
+
+
+class InventoryRefresher:
+    SWEEP_INTERVAL_SECONDS: float = 5.0
+    SWEEP_RESPONSE_WINDOW_SECONDS: float = 0.5
+    MISSED_SWEEPS_BEFORE_REMOVAL: int = 3
+    DESCRIPTION_MAX_AGE_SECONDS: float = 15 * 60
+    MAX_AGED_PROBES_PER_SWEEP: int = 4
+
+    _manager: "LifxManager"
+    _broadcast_addresses: List[Address]
+    _discovery: Optional["SubnetDiscovery"]
+    _source_id: int
+    _stop_event: threading.Event
+    _thread: Optional[threading.Thread]
+    _missed_sweeps: Dict[str, int]
+    _described_at: Dict[str, float]
+
+    def __init__(
+        self,
+        manager: "LifxManager",
+        broadcast_addresses: Optional[List[Address]] = None,
+        discovery: Optional["SubnetDiscovery"] = None,
+    ) -> None:
+        self._manager = manager
+        self._discovery = discovery
+        self._broadcast_addresses = (
+            broadcast_addresses
+            if broadcast_addresses is not None
+            else [(ip_address, UDP_BROADCAST_PORT) for ip_address in UDP_BROADCAST_IP_ADDRS]
+        )
+        self._source_id = random.randrange(2, 1 << 32)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._missed_sweeps = {}
+        now: float = time.monotonic()
+        self._described_at = {light.mac_address: now for light in manager.inventory}
+
+    def start(self) -> None:
+        logger.info("start entry")
+        self._thread = threading.Thread(target=self._run, name="lifx-inventory-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        logger.info("stop entry")
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.SWEEP_INTERVAL_SECONDS):
+            if self._manager.is_updating:
+                continue
+            try:
+                self.refresh_once()
+            except Exception:
+                logger.exception("error while refreshing inventory")
+
+    def refresh_once(self) -> None:
+        seen: Dict[str, str] = self.sweep()
+        self.reconcile(seen)
+
+    def sweep(self) -> Dict[str, str]:
+        """Broadcast one GetService and return the {MAC address: IP address} of every bulb that answered."""
+        if self._discovery is not None:
+            found: Dict[str, Address] = self._discovery.scan(1, self.SWEEP_RESPONSE_WINDOW_SECONDS)
+            return {mac_address: ip_address for (mac_address, (ip_address, _)) in found.items()}
+        seen: Dict[str, str] = {}
+        message: Message = GetService(BROADCAST_MAC, self._source_id, 0, {}, False, True)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind(("", 0))
+            for address in self._broadcast_addresses:
+                sock.sendto(message.packed_message, address)
+            deadline: float = time.monotonic() + self.SWEEP_RESPONSE_WINDOW_SECONDS
+            while True:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, (ip_address, _) = sock.recvfrom(1024)
+                except socket.timeout:
+                    break
+                try:
+                    response: Message = unpack_lifx_message(data)
+                except Exception:
+                    continue
+                if response.target_addr != BROADCAST_MAC:
+                    seen[response.target_addr] = ip_address
+        return seen
+
+    def reconcile(self, seen: Dict[str, str]) -> None:
+        """Re-probe stale bulbs from one sweep and publish added, moved and removed bulbs to the manager."""
+        inventory: "LightInventory" = self._manager.inventory
+        now: float = time.monotonic()
+
+        stale: Dict[str, str] = {}
+        aged: List[Tuple[float, str]] = []
+        for (mac_address, ip_address) in seen.items():
+            self._missed_sweeps.pop(mac_address, None)
+            light: Optional["LifxLightWrapper"] = inventory.get_by_mac_address(mac_address)
+            if light is None or light.ip_address != ip_address:
+                stale[mac_address] = ip_address
+            elif now - self._described_at.get(mac_address, 0.0) > self.DESCRIPTION_MAX_AGE_SECONDS:
+                aged.append((self._described_at.get(mac_address, 0.0), mac_address))
+        for (_, mac_address) in sorted(aged)[: self.MAX_AGED_PROBES_PER_SWEEP]:
+            stale[mac_address] = seen[mac_address]
+
+        removed: Set[str] = set()
+        for light in inventory:
+            if light.mac_address in seen:
+                continue
+            missed: int = self._missed_sweeps.get(light.mac_address, 0) + 1
+            self._missed_sweeps[light.mac_address] = missed
+            if missed >= self.MISSED_SWEEPS_BEFORE_REMOVAL:
+                removed.add(light.mac_address)
+        self._manager.mark_lights_seen(seen)
+
+        if not stale and not removed:
+            return
+
+        described: Dict[str, "LifxLightWrapper"] = self._manager.probe_lights(stale) if stale else {}
+        for mac_address in described:
+            self._described_at[mac_address] = now
+        for mac_address in removed:
+            self._missed_sweeps.pop(mac_address, None)
+            self._described_at.pop(mac_address, None)
+
+        changed: List["LifxLightWrapper"] = [
+            light
+            for light in described.values()
+            if dataclasses.astuple(light) != _astuple_or_none(inventory.get_by_mac_address(light.mac_address))
+        ]
+        if changed or removed:
+            logger.info(f"inventory refresh: {len(changed)} added or updated, {len(removed)} removed")
+            self._manager.apply_inventory_changes(changed, removed)
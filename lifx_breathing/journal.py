@@ -0,0 +1,271 @@
+"""
+Append-only journal of breathing sessions, so that a restarted web app can take its bulbs back.
+
+Sessions live in the web process. If supervisord restarts it, every session dies without running its `finally` block,
+and the bulbs are left mid-breath, possibly switched off by a flash. The engine therefore journals each session's
+start with its parameters, each light's original colour and power as soon as it has been read, and the session's stop
+once the lights have been restored. On the next start the journal is replayed, and any session without a stop is
+either restarted with its recorded original state or has its bulbs put back the way they were.
+
+Records are JSON lines. Appending only queues a record; a writer thread writes whatever has queued every
+flush_interval_seconds and fsyncs once per batch, so journaling costs the event loop a list append. A torn last line
+from a crash is skipped on replay, and replay rewrites the file with just the open sessions so it never grows without
+bound.
+
+from lifx_breathing.journal import SessionJournal
+journal = SessionJournal()
+for session in journal.open_sessions:
+    print(session.spec.lights, session.original_states)
+session_id = journal.record_start(spec)
+journal.record_original_state(session_id, "d0:73:d5:00:00:01", ((0, 0, 65535, 3500), 65535))
+journal.record_stop(session_id)
+journal.close()
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import dataclasses
+import json
+import os
+import threading
+import uuid
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("journal")
+# -----------------------------------------------------------------------------
+
+from .lifx import BreathingMode, DEFAULT_BREATHING_MODE, DEFAULT_TRANSITION_CUE, OriginalState, TransitionCue
+from .lifx_manager import LifxLightWrapper
+from .pid import PidGains
+from .profiles import BreathingPhase, BreathingProfile
+
+DEFAULT_FLUSH_INTERVAL_SECONDS: float = 0.05
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class SessionSpec:
+    """Everything needed to start a session again: in another worker process, or after a restart."""
+
+    lights: Tuple[LifxLightWrapper, ...]
+    inhale_duration_ms: int
+    exhale_duration_ms: int
+    mode: BreathingMode = DEFAULT_BREATHING_MODE
+
+    # None to use the light's tuned gains, if it has any, and DEFAULT_PID_GAINS otherwise. The engine journals the
+    # gains it looked up, so a resumed session keeps them.
+    gains: Optional[PidGains] = None
+    profile: Optional[BreathingProfile] = None
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE
+    group: bool = False
+
+    @property
+    def shard_key(self) -> str:
+        # A group breathes from one phase clock, so all of it lives with its first member.
+        return self.lights[0].mac_address.lower()
+
+
+def spec_to_json(spec: SessionSpec) -> Dict[str, Any]:
+    return {
+        "lights": [dataclasses.asdict(light) for light in spec.lights],
+        "inhale_duration_ms": spec.inhale_duration_ms,
+        "exhale_duration_ms": spec.exhale_duration_ms,
+        "mode": spec.mode.value,
+        "gains": dataclasses.asdict(spec.gains) if spec.gains is not None else None,
+        "profile": dataclasses.asdict(spec.profile) if spec.profile is not None else None,
+        "cue": spec.cue.value,
+        "group": spec.group,
+    }
+
+
+def spec_from_json(data: Dict[str, Any]) -> SessionSpec:
+    profile: Optional[Dict[str, Any]] = data["profile"]
+    return SessionSpec(
+        lights=tuple(LifxLightWrapper(**light) for light in data["lights"]),
+        inhale_duration_ms=data["inhale_duration_ms"],
+        exhale_duration_ms=data["exhale_duration_ms"],
+        mode=BreathingMode(data["mode"]),
+        gains=PidGains(**data["gains"]) if data["gains"] is not None else None,
+        profile=(
+            BreathingProfile(profile["name"], tuple(BreathingPhase(**phase) for phase in profile["phases"]))
+            if profile is not None
+            else None
+        ),
+        cue=TransitionCue(data["cue"]),
+        group=data["group"],
+    )
+
+
+@dataclasses.dataclass
+class JournaledSession:
+    session_id: str
+    spec: SessionSpec
+
+    # Keyed by MAC address. A light is missing if the process died before its state was read.
+    original_states: Dict[str, OriginalState]
+
+
+class SessionJournal:
+    path: str
+    flush_interval_seconds: float
+
+    # Sessions that were still open when the journal was opened, in the order they started.
+    open_sessions: List[JournaledSession]
+
+    _queue: List[str]
+    _condition: threading.Condition
+    _closed: bool
+
+    # Records appended and records on disk, counted since the journal was opened.
+    _appended: int
+    _synced: int
+    _file: Any
+    _writer: threading.Thread
+
+    def __init__(
+        self, path: Optional[str] = None, flush_interval_seconds: float = DEFAULT_FLUSH_INTERVAL_SECONDS
+    ) -> None:
+        if path is None:
+            from .lifx_manager import default_cache_directory
+
+            path = os.path.join(default_cache_directory(), "sessions.journal")
+        self.path = path
+        self.flush_interval_seconds = flush_interval_seconds
+        self.open_sessions = self._replay()
+        self._compact()
+        self._queue = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._appended = 0
+        self._synced = 0
+        self._file = open(self.path, "a")
+        self._writer = threading.Thread(target=self._write_batches, name="session-journal", daemon=True)
+        self._writer.start()
+
+    def _replay(self) -> List[JournaledSession]:
+        sessions: Dict[str, JournaledSession] = {}
+        try:
+            with open(self.path, "r") as f:
+                lines: List[str] = f.readlines()
+        except FileNotFoundError:
+            return []
+        except OSError:
+            logger.exception(f"ignoring unreadable session journal {self.path}")
+            return []
+        for (number, line) in enumerate(lines, start=1):
+            try:
+                record: Dict[str, Any] = json.loads(line)
+                session_id: str = record["session"]
+                if record["op"] == "start":
+                    sessions[session_id] = JournaledSession(
+                        session_id,
+                        spec_from_json(record["spec"]),
+                        {
+                            mac_address: (tuple(color), power)  # type: ignore
+                            for (mac_address, (color, power)) in record.get("original_states", {}).items()
+                        },
+                    )
+                elif record["op"] == "original_state" and session_id in sessions:
+                    sessions[session_id].original_states[record["mac_address"]] = (
+                        tuple(record["color"]),  # type: ignore
+                        record["power"],
+                    )
+                elif record["op"] == "stop":
+                    sessions.pop(session_id, None)
+            except (ValueError, KeyError, TypeError):
+                # Most likely the last line, torn by a crash in the middle of a write.
+                logger.warning(f"skipping unreadable record on line {number} of {self.path}")
+        logger.info(f"replayed {len(lines)} journal records, {len(sessions)} sessions still open")
+        return list(sessions.values())
+
+    def _compact(self) -> None:
+        directory: str = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path: str = f"{self.path}.tmp"
+        with open(temporary_path, "w") as f:
+            for session in self.open_sessions:
+                f.write(self._start_record(session.session_id, session.spec, session.original_states) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+    @staticmethod
+    def _start_record(session_id: str, spec: SessionSpec, original_states: Dict[str, OriginalState]) -> str:
+        return json.dumps(
+            {
+                "op": "start",
+                "session": session_id,
+                "spec": spec_to_json(spec),
+                "original_states": {
+                    mac_address: [list(color), power] for (mac_address, (color, power)) in original_states.items()
+                },
+            },
+            separators=(",", ":"),
+        )
+
+    def _append(self, line: str) -> None:
+        with self._condition:
+            if self._closed:
+                logger.warning(f"session journal is closed, dropping {line}")
+                return
+            self._queue.append(line)
+            self._appended += 1
+            self._condition.notify_all()
+
+    def record_start(self, spec: SessionSpec, original_states: Optional[Dict[str, OriginalState]] = None) -> str:
+        session_id: str = uuid.uuid4().hex
+        self._append(self._start_record(session_id, spec, original_states or {}))
+        return session_id
+
+    def record_original_state(self, session_id: str, mac_address: str, original_state: OriginalState) -> None:
+        (color, power) = original_state
+        record: Dict[str, Any] = {
+            "op": "original_state",
+            "session": session_id,
+            "mac_address": mac_address,
+            "color": list(color),
+            "power": power,
+        }
+        self._append(json.dumps(record, separators=(",", ":")))
+
+    def record_stop(self, session_id: str) -> None:
+        self._append(json.dumps({"op": "stop", "session": session_id}, separators=(",", ":")))
+
+    def _write_batches(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if not self._closed:
+                    # Let the records of a burst of starts and stops gather so that they share one fsync.
+                    self._condition.wait_for(lambda: self._closed, timeout=self.flush_interval_seconds)
+                batch: List[str] = self._queue
+                self._queue = []
+                closed: bool = self._closed
+            if batch:
+                try:
+                    self._file.write("".join(line + "\n" for line in batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                except OSError:
+                    logger.exception(f"failed to write {len(batch)} records to {self.path}")
+            with self._condition:
+                self._synced += len(batch)
+                self._condition.notify_all()
+            if closed:
+                return
+
+    def flush(self) -> None:
+        """Block until every record appended so far is on disk."""
+        with self._condition:
+            target: int = self._appended
+            self._condition.wait_for(lambda: self._synced >= target or not self._writer.is_alive())
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        self._file.close()
@@ -0,0 +1,141 @@
+"""
+Per-bulb latency model used to pre-compensate breathing phase durations.
+
+Each bulb keeps an exponentially weighted moving average of the round-trip time of its requests and of its fade lag,
+the time from when a fade should have finished until the bulb is seen at the destination colour. Estimates are saved
+by MAC address next to the device cache, so a new session starts from what earlier sessions learned instead of from
+zero.
+
+from lifx_breathing.latency import LatencyStore
+store = LatencyStore()
+latency = store.get("d0:73:d5:00:00:01")
+latency.observe_rtt(12.5)
+duration_ms = target_duration_ms - latency.phase_overhead_ms(flash_duration_ms=200)
+store.save()
+"""
+
+from typing import Any, ClassVar, Dict, List, Optional
+import dataclasses
+import fcntl
+import json
+import os
+import tempfile
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("latency")
+# -----------------------------------------------------------------------------
+
+# Starting guesses for a bulb that has never been measured: a quiet Wi-Fi LAN and half a 100 ms poll interval.
+DEFAULT_RTT_MS: float = 20.0
+DEFAULT_FADE_LAG_MS: float = 50.0
+
+
+@dataclasses.dataclass
+class BulbLatency:
+    # Weight of the newest sample. 0.25 follows a change in the network within a few phases without jumping on one
+    # slow reply.
+    ALPHA: ClassVar[float] = 0.25
+
+    rtt_ms: float = DEFAULT_RTT_MS
+    fade_lag_ms: float = DEFAULT_FADE_LAG_MS
+    rtt_samples: int = 0
+    fade_lag_samples: int = 0
+
+    def observe_rtt(self, rtt_ms: float) -> None:
+        self.rtt_ms = rtt_ms if self.rtt_samples == 0 else self.rtt_ms + self.ALPHA * (rtt_ms - self.rtt_ms)
+        self.rtt_samples += 1
+
+    def observe_fade_lag(self, fade_lag_ms: float) -> None:
+        fade_lag_ms = max(fade_lag_ms, 0.0)
+        self.fade_lag_ms = (
+            fade_lag_ms
+            if self.fade_lag_samples == 0
+            else self.fade_lag_ms + self.ALPHA * (fade_lag_ms - self.fade_lag_ms)
+        )
+        self.fade_lag_samples += 1
+
+    def phase_overhead_ms(self, flash_duration_ms: int, cue_round_trips: int = 1) -> int:
+        """
+        How much longer than its requested duration a polled phase is expected to take.
+
+        go_to_color waits for the set_waveform ack, the fade (half of a period of 2 * duration - flash), the fade lag,
+        then the cue, which lasts the flash plus cue_round_trips acknowledgements: one for the pipelined power flash,
+        none for a waveform cue.
+        """
+        return int((1 + cue_round_trips) * self.rtt_ms + self.fade_lag_ms + flash_duration_ms / 2)
+
+
+class LatencyStore:
+    """BulbLatency estimates keyed by MAC address, saved as compact JSON rows of [mac, rtt_ms, fade_lag_ms]."""
+
+    FORMAT_VERSION: int = 1
+
+    path: str
+    _bulbs: Dict[str, BulbLatency]
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        if path is None:
+            # Imported here so that the command line session, which never discovers lights, does not load the manager.
+            from .lifx_manager import default_cache_directory
+
+            path = os.path.join(default_cache_directory(), "latency.json")
+        self.path = path
+        self._bulbs = self._load()
+
+    def _load(self) -> Dict[str, BulbLatency]:
+        try:
+            with open(self.path, "r") as f:
+                data: Dict[str, Any] = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.exception(f"ignoring unreadable latency store {self.path}")
+            return {}
+        if data.get("version") != self.FORMAT_VERSION:
+            return {}
+        # A seeded estimate counts as one sample, so the first measurement of a new session is averaged into it.
+        return {
+            mac_address: BulbLatency(rtt_ms=rtt_ms, fade_lag_ms=fade_lag_ms, rtt_samples=1, fade_lag_samples=1)
+            for (mac_address, rtt_ms, fade_lag_ms) in data.get("bulbs", [])
+        }
+
+    def get(self, mac_address: str) -> BulbLatency:
+        return self._bulbs.setdefault(mac_address.lower(), BulbLatency())
+
+    def save(self) -> None:
+        # Worker processes of a ShardedSessionHost share one file, so keep what the others saved for bulbs this store
+        # has not measured. The lock file serializes their read-merge-write cycles, and each writes its own temporary
+        # file, so no save is lost or torn.
+        directory: str = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                bulbs: Dict[str, BulbLatency] = self._load()
+                bulbs.update(
+                    (mac_address, latency)
+                    for (mac_address, latency) in self._bulbs.items()
+                    if latency.rtt_samples > 0 or latency.fade_lag_samples > 0
+                )
+                rows: List[List[Any]] = [
+                    [mac_address, round(latency.rtt_ms, 2), round(latency.fade_lag_ms, 2)]
+                    for (mac_address, latency) in bulbs.items()
+                ]
+                data: Dict[str, Any] = {"version": self.FORMAT_VERSION, "bulbs": rows}
+                (descriptor, temporary_path) = tempfile.mkstemp(
+                    prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", dir=directory or os.curdir
+                )
+                try:
+                    with os.fdopen(descriptor, "w") as f:
+                        json.dump(data, f, separators=(",", ":"))
+                    os.replace(temporary_path, self.path)
+                except BaseException:
+                    os.unlink(temporary_path)
+                    raise
+        except OSError:
+            logger.exception(f"could not write latency store {self.path}")
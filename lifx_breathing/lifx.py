@@ -1,162 +1,690 @@
+"""
+
+### Running a single session from the command line
+
+python -m lifx_breathing.lifx --ip-address 192.168.1.10 --mac-address d0:73:d5:00:00:01 \
+    --inhale-duration-ms 5000 --exhale-duration-ms 5000 --mode scheduled
+python -m lifx_breathing.lifx --ip-address 192.168.1.10 --mac-address d0:73:d5:00:00:01 \
+    --inhale-duration-ms 4000 --exhale-duration-ms 4000 --profile box
+python -m lifx_breathing.lifx --ip-address 192.168.1.10 --mac-address d0:73:d5:00:00:01 \
+    --inhale-duration-ms 5000 --exhale-duration-ms 5000 --cue dip
+
+"""
+
 from dataclasses import dataclass
-from typing import Any, List, Tuple
-import argparse
-import logging
-import signal
-import sys
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+import asyncio
+import enum
 import time
-import types
 
 import lifxlan
-from lifxlan import LifxLAN, Light, Device
-
-global_light: Light = None
-global_halt: bool = False
 
 # -----------------------------------------------------------------------------
 # create logger
 # -----------------------------------------------------------------------------
-logger = logging.getLogger("lifx_breathing")
-logger.setLevel(logging.DEBUG)
+from .log_queue import get_logger
 
-# create console handler and set level to debug
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
+logger = get_logger("lifx_breathing")
+# -----------------------------------------------------------------------------
 
-# create formatter
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+from . import metrics
+from .latency import BulbLatency, LatencyStore
+from .pid import DEFAULT_PID_GAINS, PidController, PidGains
+from .profiles import (
+    BLUE,
+    NAMED_PROFILES,
+    RED,
+    BreathingProfile,
+    KeyframeTable,
+    classic_profile,
+    compile_profile,
+    named_profile,
+)
+from .protocol import AsyncLight, AsyncLightGroup, LifxTransport
+from .trace import SessionTrace, TraceRecorder
+from .tuning import GainStore
 
-# add formatter to ch
-ch.setFormatter(formatter)
+# A scheduled breathing cycle can drive one light or a group of lights from the same phase clock.
+BreathingTarget = Union[AsyncLight, AsyncLightGroup]
 
-# add ch to logger
-logger.addHandler(ch)
-# -----------------------------------------------------------------------------
+# A light's colour and power level from before its session started, restored when the session ends.
+OriginalState = Tuple[Tuple[int, int, int, int], int]
+
+# Called with a light's MAC address and original state as soon as the state has been read.
+OriginalStateCallback = Callable[[str, OriginalState], None]
+
+# Called with the fields of a session's live status that changed: phase, cycle, measured durations, corrections.
+StatusCallback = Callable[[Dict[str, Any]], None]
 
 
 class LifxDeviceNotFoundException(Exception):
     pass
 
 
-def go_to_color(
-    light: Light, destination_color: Tuple[int, int, int, int], duration_ms: int, flash_duration_ms: int,
+class BreathingMode(enum.Enum):
+    # Closed loop: poll get_color every 100 ms until the bulb reports the target, then correct drift with a PID loop.
+    POLLING = "polling"
+
+    # Open loop: send one set_waveform per phase at a precomputed monotonic deadline and only check the bulb's state
+    # every STATE_CHECK_INTERVAL_CYCLES cycles, after the fade has finished.
+    SCHEDULED = "scheduled"
+
+
+DEFAULT_BREATHING_MODE: BreathingMode = BreathingMode.POLLING
+
+
+class TransitionCue(enum.Enum):
+    # Switch the bulb off for the flash and back on: two set_power packets per phase boundary.
+    FLASH = "flash"
+
+    # One transient sine waveform that eases the brightness down to 0 and back up across the flash.
+    DIP = "dip"
+
+    # One transient pulse waveform that cuts the brightness to 0 for half of the flash.
+    PULSE = "pulse"
+
+
+DEFAULT_TRANSITION_CUE: TransitionCue = TransitionCue.FLASH
+STATE_CHECK_INTERVAL_CYCLES: int = 10
+
+# How far, per HSBK component, a checked bulb may be from the phase's colour before it is resent. The check samples
+# after the fade, but a bulb that finishes its fade a little late still reports a colour a few steps short of it.
+STATE_CHECK_TOLERANCE: int = 512
+STATE_CHECK_KELVIN_TOLERANCE: int = 50
+
+POLLING_PHASE_ERROR_MS: metrics.Histogram = metrics.PHASE_ERROR_MS.labels(mode=BreathingMode.POLLING.value)
+SCHEDULED_PHASE_ERROR_MS: metrics.Histogram = metrics.PHASE_ERROR_MS.labels(mode=BreathingMode.SCHEDULED.value)
+GET_COLOR_RETRIES: metrics.Counter = metrics.WORKFLOW_EXCEPTION_RETRIES.labels(operation="get_color")
+SET_WAVEFORM_RETRIES: metrics.Counter = metrics.WORKFLOW_EXCEPTION_RETRIES.labels(operation="set_waveform")
+
+# LIFX SetWaveform waveform numbers.
+WAVEFORM_SINE: int = 1
+WAVEFORM_TRIANGLE: int = 3
+WAVEFORM_PULSE: int = 4
+
+# Each get_color already retransmits under the transport's retry budget; a bulb that still fails this many polls in a
+# row is treated as gone, and the session supervisor restarts the session after a backoff.
+MAX_CONSECUTIVE_POLL_FAILURES: int = 10
+
+
+def cue_color(color: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+    (hue, saturation, _, kelvin) = color
+    return (hue, saturation, 0, kelvin)
+
+
+async def send_waveform_cue(
+    light: BreathingTarget, color: Tuple[int, int, int, int], flash_duration_ms: int, cue: TransitionCue
+) -> None:
+    """
+    Send a DIP or PULSE cue as a single unacknowledged transient waveform.
+
+    The bulb runs one cycle from color towards its dark version and returns to color by itself, so the cue needs no
+    second packet and no round trip.
+    """
+    is_transient: int = 1
+    cycles: float = 1.0
+    duty_cycle: int = 0
+    waveform: int = WAVEFORM_SINE if cue is TransitionCue.DIP else WAVEFORM_PULSE
+    await light.set_waveform(
+        is_transient, cue_color(color), flash_duration_ms, cycles, duty_cycle, waveform, rapid=True
+    )
+
+
+async def flash(light: AsyncLight, flash_duration_ms: int) -> None:
+    """
+    Switch the light off for flash_duration_ms and back on, pipelining the two acknowledged power changes.
+
+    The power-off ack is collected during the flash rather than before it, so the pair costs one round trip on top of
+    the flash instead of two. An unacknowledged power-off is abandoned before the power-on goes out, so that a late
+    retransmission can never leave the bulb dark.
+    """
+    power_off: asyncio.Future[None] = asyncio.ensure_future(light.set_power(False, rapid=False))
+    await asyncio.sleep(flash_duration_ms / 1000.0)
+    if not power_off.done():
+        power_off.cancel()
+    await asyncio.gather(power_off, return_exceptions=True)
+    await light.set_power(True, rapid=False)
+
+
+async def go_to_color(
+    light: AsyncLight,
+    destination_color: Tuple[int, int, int, int],
+    duration_ms: int,
+    flash_duration_ms: int,
+    latency: Optional[BulbLatency] = None,
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE,
 ) -> int:
+    """Fade to destination_color, poll until the bulb gets there, cue the next phase, and return how long that took."""
     is_transient: int = 0
     cycles: float = 0.5
     duty_cycle: int = 0
-    waveform: int = 3
+    waveform: int = WAVEFORM_TRIANGLE
     period_ms: int = duration_ms * 2 - flash_duration_ms
 
     start: float = time.perf_counter()
-    light.set_waveform(is_transient, destination_color, period_ms, cycles, duty_cycle, waveform, rapid=False)
+    await light.set_waveform(is_transient, destination_color, period_ms, cycles, duty_cycle, waveform, rapid=False)
+    if latency is not None:
+        latency.observe_rtt((time.perf_counter() - start) * 1000)
+    poll_failures: int = 0
     while True:
-        if global_halt:
-            return 0
-        time.sleep(1e-1)
+        await asyncio.sleep(1e-1)
+        poll_start: float = time.perf_counter()
         try:
-            current_color: Tuple[int, int, int, int] = light.get_color()
+            current_color: Tuple[int, int, int, int] = await light.get_color()
         except lifxlan.errors.WorkflowException:
-            logger.warning("exception while getting color")
+            poll_failures += 1
+            logger.warning("exception while getting color (%d in a row)", poll_failures)
+            if poll_failures >= MAX_CONSECUTIVE_POLL_FAILURES:
+                raise
+            GET_COLOR_RETRIES.inc()
             continue
+        poll_failures = 0
+        if latency is not None:
+            latency.observe_rtt((time.perf_counter() - poll_start) * 1000)
         if current_color == destination_color:
             break
-    light.set_power(False, rapid=False)
-    time.sleep(flash_duration_ms / 1000.0)
-    light.set_power(True, rapid=False)
+    if latency is not None:
+        # Everything between the set_waveform round trip plus the fade itself and seeing the colour is fade lag.
+        fade_ms: float = period_ms * cycles
+        latency.observe_fade_lag((time.perf_counter() - start) * 1000 - latency.rtt_ms - fade_ms)
+    if cue is TransitionCue.FLASH:
+        await flash(light, flash_duration_ms)
+    else:
+        await send_waveform_cue(light, destination_color, flash_duration_ms, cue)
+        await asyncio.sleep(flash_duration_ms / 1000.0)
 
     end: float = time.perf_counter()
     return int((end - start) * 1000)
 
 
-def run_breathing_cycle(light: Light, inhale_duration_ms: int, exhale_duration_ms: int) -> None:
-    # Colors are HSBK: [hue (0-65535), saturation (0-65535), brightness (0-65535), Kelvin (2500-9000)]
-    red: Tuple[int, int, int, int] = (0, 65535, 65535, 3500)
-    blue: Tuple[int, int, int, int] = (36044, 65535, 65535, 3500)
+def compensated_duration_ms(
+    duration_ms: int, flash_duration_ms: int, latency: BulbLatency, cue: TransitionCue = DEFAULT_TRANSITION_CUE
+) -> int:
+    # Only the power flash waits on an acknowledgement; waveform cues are sent without one.
+    cue_round_trips: int = 1 if cue is TransitionCue.FLASH else 0
+    return max(duration_ms - latency.phase_overhead_ms(flash_duration_ms, cue_round_trips), flash_duration_ms)
+
+
+async def run_breathing_cycle(
+    light: AsyncLight,
+    inhale_duration_ms: int,
+    exhale_duration_ms: int,
+    gains: PidGains = DEFAULT_PID_GAINS,
+    latency: Optional[BulbLatency] = None,
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    on_status: Optional[StatusCallback] = None,
+    trace: Optional[SessionTrace] = None,
+) -> None:
+    """
+    Closed-loop breathing. Each phase asks for its target duration minus the latency model's expected overhead, so
+    the first breath is already close to cadence and the PID loop only corrects what the model does not predict.
+    """
+    red: Tuple[int, int, int, int] = RED
+    blue: Tuple[int, int, int, int] = BLUE
 
     target_inhale_duration_ms: int = inhale_duration_ms
     target_exhale_duration_ms: int = exhale_duration_ms
     flash_duration_ms: int = 200
+    if latency is None:
+        latency = BulbLatency()
 
     current_inhale_duration_ms: int = target_inhale_duration_ms
     current_exhale_duration_ms: int = target_exhale_duration_ms
-    inhale_errors: List[int] = []
-    exhale_errors: List[int] = []
-    inhale_cumulative_error_ms: int = 0
-    exhale_cumulative_error_ms: int = 0
-    inhale_derivative_error_ms: int = 0
-    exhale_derivative_error_ms: int = 0
-
-    light.set_color(red, rapid=False)
+    inhale_controller: PidController = PidController(gains)
+    exhale_controller: PidController = PidController(gains)
+
+    await light.set_color(red, rapid=False)
     cnt: int = 0
     while True:
-        actual_inhale_duration_ms: int = go_to_color(
-            light, blue, current_inhale_duration_ms, flash_duration_ms
+        if on_status is not None:
+            on_status({"phase": "inhale", "cycle": cnt})
+        inhale_request_ms: int = compensated_duration_ms(current_inhale_duration_ms, flash_duration_ms, latency, cue)
+        actual_inhale_duration_ms: int = await go_to_color(
+            light, blue, inhale_request_ms, flash_duration_ms, latency, cue
         )
-        if global_halt:
-            return
-        actual_exhale_duration_ms: int = go_to_color(
-            light, red, current_exhale_duration_ms, flash_duration_ms
+        if on_status is not None:
+            on_status({"phase": "exhale", "measured_inhale_ms": actual_inhale_duration_ms})
+        exhale_request_ms: int = compensated_duration_ms(current_exhale_duration_ms, flash_duration_ms, latency, cue)
+        actual_exhale_duration_ms: int = await go_to_color(
+            light, red, exhale_request_ms, flash_duration_ms, latency, cue
         )
-        if global_halt:
-            return
+        POLLING_PHASE_ERROR_MS.observe(abs(actual_inhale_duration_ms - target_inhale_duration_ms))
+        POLLING_PHASE_ERROR_MS.observe(abs(actual_exhale_duration_ms - target_exhale_duration_ms))
+
+        inhale_correction_ms: int = inhale_controller.update(target_inhale_duration_ms - actual_inhale_duration_ms)
+        exhale_correction_ms: int = exhale_controller.update(target_exhale_duration_ms - actual_exhale_duration_ms)
+        if trace is not None:
+            trace.phase(
+                0,
+                cnt,
+                target_inhale_duration_ms,
+                current_inhale_duration_ms,
+                inhale_request_ms,
+                actual_inhale_duration_ms,
+                error_ms=inhale_controller.error_ms,
+                integral_ms=inhale_controller.cumulative_error_ms,
+                derivative_ms=inhale_controller.derivative_error_ms,
+                correction_ms=inhale_correction_ms,
+                rtt_ms=latency.rtt_ms,
+                fade_lag_ms=latency.fade_lag_ms,
+            )
+            trace.phase(
+                1,
+                cnt,
+                target_exhale_duration_ms,
+                current_exhale_duration_ms,
+                exhale_request_ms,
+                actual_exhale_duration_ms,
+                error_ms=exhale_controller.error_ms,
+                integral_ms=exhale_controller.cumulative_error_ms,
+                derivative_ms=exhale_controller.derivative_error_ms,
+                correction_ms=exhale_correction_ms,
+                rtt_ms=latency.rtt_ms,
+                fade_lag_ms=latency.fade_lag_ms,
+            )
+        current_inhale_duration_ms += inhale_correction_ms
+        current_exhale_duration_ms += exhale_correction_ms
+
+        # Lazy %-style arguments: the log writer thread builds these messages, not the breathing loop.
         logger.info(
-            f"actual_inhale_duration_ms: {actual_inhale_duration_ms}, actual_exhale_duration_ms: {actual_exhale_duration_ms}"
+            "actual_inhale_duration_ms: %d, actual_exhale_duration_ms: %d, "
+            "current_inhale_duration_ms is now %d, current_exhale_duration_ms is now %d",
+            actual_inhale_duration_ms,
+            actual_exhale_duration_ms,
+            current_inhale_duration_ms,
+            current_exhale_duration_ms,
+            extra={
+                "session_event": {
+                    "event": "polling_cycle",
+                    "light": light.mac_address,
+                    "cycle": cnt,
+                    "measured_inhale_ms": actual_inhale_duration_ms,
+                    "measured_exhale_ms": actual_exhale_duration_ms,
+                    "inhale_correction_ms": inhale_correction_ms,
+                    "exhale_correction_ms": exhale_correction_ms,
+                    "rtt_ms": latency.rtt_ms,
+                    "fade_lag_ms": latency.fade_lag_ms,
+                }
+            },
         )
-
+        logger.debug(
+            "rtt_ms: %.1f, fade_lag_ms: %.1f, inhale_error_ms: %d, inhale_cumulative_error_ms: %d, "
+            "inhale_derivative_error_ms: %d, exhale_error_ms: %d, exhale_cumulative_error_ms: %d, "
+            "exhale_derivative_error_ms: %d",
+            latency.rtt_ms,
+            latency.fade_lag_ms,
+            inhale_controller.error_ms,
+            inhale_controller.cumulative_error_ms,
+            inhale_controller.derivative_error_ms,
+            exhale_controller.error_ms,
+            exhale_controller.cumulative_error_ms,
+            exhale_controller.derivative_error_ms,
+        )
+        if on_status is not None:
+            on_status(
+                {
+                    "measured_exhale_ms": actual_exhale_duration_ms,
+                    "inhale_correction_ms": inhale_correction_ms,
+                    "exhale_correction_ms": exhale_correction_ms,
+                    "rtt_ms": round(latency.rtt_ms, 1),
+                }
+            )
         cnt += 1
-        if cnt <= 1:
-            logger.info("skip duration adjustment for first iteration")
-            continue
 
-        k_p: float = 1.0
-        k_i: float = 0.05
-        k_d: float = 0.03
-        history_window_size: int = 10
 
-        inhale_error_ms = target_inhale_duration_ms - actual_inhale_duration_ms
-        inhale_errors = (inhale_errors + [inhale_error_ms])[-history_window_size:]
-        inhale_cumulative_error_ms = sum(inhale_errors)
-        if len(inhale_errors) <= 1:
-            inhale_derivative_error_ms = 0
-        else:
-            inhale_derivative_error_ms = inhale_errors[-1] - inhale_errors[-2]
-        inhale_correction_ms: int = int(k_p * inhale_error_ms) + int(k_i * inhale_cumulative_error_ms) + int(
-            k_d * inhale_derivative_error_ms
+async def sleep_until(deadline: float) -> None:
+    delay: float = deadline - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def target_members(target: BreathingTarget) -> Sequence[AsyncLight]:
+    return target.lights if isinstance(target, AsyncLightGroup) else [target]
+
+
+def colors_match(
+    actual: Tuple[int, int, int, int],
+    expected: Tuple[int, int, int, int],
+    compare_brightness: bool = True,
+) -> bool:
+    """Whether actual is within the state check's tolerance of expected; hue wraps around from 65535 to 0."""
+    hue_difference: int = abs(actual[0] - expected[0]) % 65536
+    if min(hue_difference, 65536 - hue_difference) > STATE_CHECK_TOLERANCE:
+        return False
+    if abs(actual[1] - expected[1]) > STATE_CHECK_TOLERANCE:
+        return False
+    if compare_brightness and abs(actual[2] - expected[2]) > STATE_CHECK_TOLERANCE:
+        return False
+    return abs(actual[3] - expected[3]) <= STATE_CHECK_KELVIN_TOLERANCE
+
+
+async def check_colors(
+    target: BreathingTarget, destination_color: Tuple[int, int, int, int], compare_brightness: bool = True
+) -> None:
+    """
+    Read every member's colour once and resend the destination to members that drifted.
+
+    Without compare_brightness only hue, saturation and kelvin are checked, for when a waveform cue is dimming the bulb.
+    """
+    members: Sequence[AsyncLight] = target_members(target)
+    colors: List[Any] = await asyncio.gather(*(light.get_color() for light in members), return_exceptions=True)
+    for (light, current_color) in zip(members, colors):
+        if isinstance(current_color, lifxlan.errors.WorkflowException):
+            logger.warning("exception while checking color of %s", light)
+            GET_COLOR_RETRIES.inc()
+        elif isinstance(current_color, BaseException):
+            raise current_color
+        elif not colors_match(current_color, destination_color, compare_brightness):
+            logger.warning("%s is at %s instead of %s, resending color", light, current_color, destination_color)
+            await light.set_color(destination_color, rapid=True)
+
+
+async def check_colors_at(
+    deadline: float,
+    target: BreathingTarget,
+    destination_color: Tuple[int, int, int, int],
+    compare_brightness: bool,
+) -> None:
+    await sleep_until(deadline)
+    await check_colors(target, destination_color, compare_brightness)
+
+
+async def run_scheduled_phase(
+    light: BreathingTarget,
+    destination_color: Tuple[int, int, int, int],
+    phase_start: float,
+    duration_ms: int,
+    fade_duration_ms: int,
+    flash_duration_ms: int,
+    send_color: bool,
+    check_state: bool,
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+) -> float:
+    """
+    Send one colour change at phase_start and cue the next phase at the end of it without waiting on the bulb.
+
+    Timing comes from the host's monotonic clock rather than from polling, so lost or late replies never push the phase
+    boundary back. Returns how late the phase started, in milliseconds.
+
+    With check_state the bulb's colour is read once its fade is over, and a check that has not finished by the end of
+    the phase is abandoned rather than delaying the next one. A phase that fades right up to its end is not checked.
+    """
+    is_transient: int = 0
+    cycles: float = 0.5
+    duty_cycle: int = 0
+    waveform: int = WAVEFORM_TRIANGLE
+    period_ms: int = fade_duration_ms * 2
+    flash_start: float = phase_start + (duration_ms - flash_duration_ms) / 1000.0
+    phase_end: float = phase_start + duration_ms / 1000.0
+
+    await sleep_until(phase_start)
+    start_error_ms: float = (time.monotonic() - phase_start) * 1000
+    SCHEDULED_PHASE_ERROR_MS.observe(start_error_ms)
+    if send_color:
+        try:
+            if fade_duration_ms > 0:
+                await light.set_waveform(
+                    is_transient, destination_color, period_ms, cycles, duty_cycle, waveform, rapid=False
+                )
+            else:
+                await light.set_color(destination_color, rapid=False)
+        except lifxlan.errors.WorkflowException:
+            logger.warning("exception while setting waveform")
+            SET_WAVEFORM_RETRIES.inc()
+
+    # The check samples halfway between the end of the fade and the end of the phase. A waveform cue may be dimming
+    # the bulb by then, so only its hue, saturation and kelvin are compared.
+    settled_at: float = phase_start + fade_duration_ms / 1000.0
+    check: Optional["asyncio.Future[None]"] = None
+    if check_state and settled_at < phase_end:
+        check = asyncio.ensure_future(
+            check_colors_at(
+                (settled_at + phase_end) / 2,
+                light,
+                destination_color,
+                cue is TransitionCue.FLASH or flash_duration_ms == 0,
+            )
         )
-        logger.debug(
-            f"inhale_error_ms: {inhale_error_ms}, inhale_cumulative_error_ms: {inhale_cumulative_error_ms}, inhale_derivative_error_ms: {inhale_derivative_error_ms}"
+    try:
+        if flash_duration_ms > 0:
+            await sleep_until(flash_start)
+            if cue is TransitionCue.FLASH:
+                await light.set_power(False, rapid=True)
+                await sleep_until(phase_end)
+                await light.set_power(True, rapid=True)
+            else:
+                await send_waveform_cue(light, destination_color, flash_duration_ms, cue)
+        if check is not None:
+            try:
+                await asyncio.wait_for(check, max(phase_end - time.monotonic(), 0.0))
+            except asyncio.TimeoutError:
+                logger.debug("state check of %s did not finish before the end of the phase", light)
+    finally:
+        if check is not None and not check.done():
+            check.cancel()
+    return start_error_ms
+
+
+async def run_scheduled_breathing_cycle(
+    light: BreathingTarget,
+    table: KeyframeTable,
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    on_status: Optional[StatusCallback] = None,
+    trace: Optional[SessionTrace] = None,
+) -> None:
+    """
+    Replay a compiled keyframe table forever, starting from the colour the cycle ends on.
+
+    A phase's trace record is written once the next phase has started, because its actual length is the time between
+    the two starts.
+    """
+    colors: Tuple[Tuple[int, int, int, int], ...] = table.colors
+    durations_ms = table.durations_ms
+    fade_durations_ms = table.fade_durations_ms
+    flash_durations_ms = table.flash_durations_ms
+    send_color = table.send_color
+
+    mac_addresses: List[str] = [member.mac_address for member in target_members(light)]
+
+    await light.set_color(colors[-1], rapid=False)
+    phase_start: float = time.monotonic()
+    cnt: int = 0
+    # (phase, cycle, duration, start error) of the phase whose trace record waits for the next phase's start.
+    unrecorded: Optional[Tuple[int, int, int, float]] = None
+    while True:
+        check_state: bool = cnt % STATE_CHECK_INTERVAL_CYCLES == STATE_CHECK_INTERVAL_CYCLES - 1
+        for i in range(len(colors)):
+            if on_status is not None:
+                on_status({"phase": table.phase_names[i], "cycle": cnt})
+            start_error_ms: float = await run_scheduled_phase(
+                light,
+                colors[i],
+                phase_start,
+                durations_ms[i],
+                fade_durations_ms[i],
+                flash_durations_ms[i],
+                bool(send_color[i]),
+                check_state and bool(send_color[i]),
+                cue,
+            )
+            if trace is not None:
+                if unrecorded is not None:
+                    (phase, cycle, duration_ms, previous_start_error_ms) = unrecorded
+                    actual_ms: int = round(duration_ms + start_error_ms - previous_start_error_ms)
+                    trace.phase(
+                        phase,
+                        cycle,
+                        duration_ms,
+                        duration_ms,
+                        duration_ms,
+                        actual_ms,
+                        start_error_ms=round(previous_start_error_ms),
+                    )
+                unrecorded = (i, cnt, durations_ms[i], start_error_ms)
+            phase_start += durations_ms[i] / 1000.0
+
+        cnt += 1
+        lateness_ms: int = int((time.monotonic() - phase_start) * 1000)
+        logger.info(
+            "%s cycle %d finished %d ms after its deadline",
+            table.name,
+            cnt,
+            lateness_ms,
+            extra={
+                "session_event": {
+                    "event": "scheduled_cycle",
+                    "lights": mac_addresses,
+                    "profile": table.name,
+                    "cycle": cnt,
+                    "lateness_ms": lateness_ms,
+                }
+            },
         )
-        current_inhale_duration_ms += inhale_correction_ms
+        if on_status is not None:
+            on_status({"lateness_ms": lateness_ms})
+
+
+def session_keyframes(
+    inhale_duration_ms: int, exhale_duration_ms: int, profile: Optional[BreathingProfile]
+) -> KeyframeTable:
+    return compile_profile(profile if profile is not None else classic_profile(inhale_duration_ms, exhale_duration_ms))
+
+
+async def read_original_state(
+    light: AsyncLight,
+    original_states: Optional[Dict[str, OriginalState]],
+    on_original_state: Optional[OriginalStateCallback],
+) -> OriginalState:
+    if original_states is not None and light.mac_address in original_states:
+        return original_states[light.mac_address]
+    # Both reads go out together, so the first breath waits for one round trip rather than two.
+    (color, power) = await asyncio.gather(light.get_color(), light.get_power())
+    original_state: OriginalState = (tuple(color), power)  # type: ignore
+    if original_states is not None:
+        original_states[light.mac_address] = original_state
+    if on_original_state is not None:
+        on_original_state(light.mac_address, original_state)
+    return original_state
+
+
+async def run_session(
+    light: AsyncLight,
+    inhale_duration_ms: int,
+    exhale_duration_ms: int,
+    mode: BreathingMode = DEFAULT_BREATHING_MODE,
+    gains: Optional[PidGains] = None,
+    profile: Optional[BreathingProfile] = None,
+    latency_store: Optional[LatencyStore] = None,
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    original_states: Optional[Dict[str, OriginalState]] = None,
+    on_original_state: Optional[OriginalStateCallback] = None,
+    on_status: Optional[StatusCallback] = None,
+    trace_recorder: Optional[TraceRecorder] = None,
+    gain_store: Optional[GainStore] = None,
+) -> None:
+    """
+    Run the breathing cycle until cancelled, then put the light back the way we found it.
+
+    A profile replaces the plain inhale and exhale phases. Profiles are replayed open loop, so they need scheduled mode.
+    Polling mode seeds its latency model from latency_store and saves what it learned when the session ends. Unless
+    gains are given, it uses the light's tuned gains from gain_store, or DEFAULT_PID_GAINS without one.
+
+    original_states, keyed by MAC address, carries the light's original state across restarts of the session: a
+    restarted session must not read the bulb mid-breath and take that for the colour to restore. The state is read
+    and stored there only if it is missing, and on_original_state is told about it. on_status is told the phase and
+    timing of the session as they change, for the live status stream. trace_recorder, if given, gets a record of every
+    phase.
+    """
+    if profile is not None and mode is not BreathingMode.SCHEDULED:
+        raise ValueError("breathing profiles need scheduled mode")
+    original_state: OriginalState = await read_original_state(light, original_states, on_original_state)
+    (original_color, original_power) = original_state
+    trace: Optional[SessionTrace] = (
+        trace_recorder.session(light.mac_address, mode.value) if trace_recorder is not None else None
+    )
 
-        exhale_error_ms = target_exhale_duration_ms - actual_exhale_duration_ms
-        exhale_errors = (exhale_errors + [exhale_error_ms])[-history_window_size:]
-        exhale_cumulative_error_ms = sum(exhale_errors)
-        if len(exhale_errors) <= 1:
-            exhale_derivative_error_ms = 0
+    try:
+        if mode is BreathingMode.SCHEDULED:
+            await run_scheduled_breathing_cycle(
+                light, session_keyframes(inhale_duration_ms, exhale_duration_ms, profile), cue, on_status, trace
+            )
         else:
-            exhale_derivative_error_ms = exhale_errors[-1] - exhale_errors[-2]
-        exhale_correction_ms: int = int(k_p * exhale_error_ms) + int(k_i * exhale_cumulative_error_ms) + int(
-            k_d * exhale_derivative_error_ms
+            latency: Optional[BulbLatency] = (
+                latency_store.get(light.mac_address) if latency_store is not None else None
+            )
+            if gains is None:
+                gains = gain_store.get(light.mac_address) if gain_store is not None else DEFAULT_PID_GAINS
+            await run_breathing_cycle(
+                light, inhale_duration_ms, exhale_duration_ms, gains, latency, cue, on_status, trace
+            )
+    except asyncio.CancelledError:
+        logger.info(f"breathing cancelled for {light}")
+        raise
+    except:
+        logger.exception("exception in run_session")
+        raise
+    finally:
+        if latency_store is not None and mode is BreathingMode.POLLING:
+            latency_store.save()
+        # A failed restore is logged rather than raised, so that it never hides why the session ended.
+        try:
+            await light.set_color(original_color, rapid=False)
+            await light.set_power(original_power, rapid=False)
+        except Exception as e:
+            logger.warning(f"failed to restore the original state of {light}: {e!r}")
+
+
+async def run_group_session(
+    group: AsyncLightGroup,
+    inhale_duration_ms: int,
+    exhale_duration_ms: int,
+    profile: Optional[BreathingProfile] = None,
+    cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    original_states: Optional[Dict[str, OriginalState]] = None,
+    on_original_state: Optional[OriginalStateCallback] = None,
+    on_status: Optional[StatusCallback] = None,
+    trace_recorder: Optional[TraceRecorder] = None,
+) -> None:
+    """
+    Breathe every light in group from one shared phase clock, then restore each light's original state.
+
+    Each phase is a single burst of set_waveform packets to all members, so members stay in phase to within the time
+    it takes to write the burst to the socket. original_states, on_original_state, on_status and
+    trace_recorder work as in run_session; the group's phases are traced under its first member.
+    """
+    members: Sequence[AsyncLight] = group.lights
+    member_states: List[OriginalState] = await asyncio.gather(
+        *(read_original_state(light, original_states, on_original_state) for light in members)
+    )
+    original_colors: List[Tuple[int, int, int, int]] = [color for (color, _) in member_states]
+    original_powers: List[int] = [power for (_, power) in member_states]
+    trace: Optional[SessionTrace] = (
+        trace_recorder.session(members[0].mac_address, BreathingMode.SCHEDULED.value)
+        if trace_recorder is not None
+        else None
+    )
+
+    try:
+        await run_scheduled_breathing_cycle(
+            group, session_keyframes(inhale_duration_ms, exhale_duration_ms, profile), cue, on_status, trace
         )
-        logger.debug(
-            f"exhale_error_ms: {exhale_error_ms}, exhale_cumulative_error_ms: {exhale_cumulative_error_ms}, exhale_derivative_error_ms: {exhale_derivative_error_ms}"
+    except asyncio.CancelledError:
+        logger.info(f"breathing cancelled for {group}")
+        raise
+    except:
+        logger.exception("exception in run_group_session")
+        raise
+    finally:
+        restored: List[Any] = await asyncio.gather(
+            *(light.set_color(color, rapid=False) for (light, color) in zip(members, original_colors)),
+            return_exceptions=True,
         )
-        current_exhale_duration_ms += exhale_correction_ms
-
-        logger.info(
-            f"current_inhale_duration_ms is now {current_inhale_duration_ms}, current_exhale_duration_ms is now {current_exhale_duration_ms}"
+        restored += await asyncio.gather(
+            *(light.set_power(power, rapid=False) for (light, power) in zip(members, original_powers)),
+            return_exceptions=True,
         )
-
-
-def handler(signum: int, frame: types.FrameType) -> None:
-    global global_light
-    global global_halt
-
-    logger.info("signal handler")
-    if global_light is None:
-        return
-    logger.info("signal handler setting global halt flag")
-    global_halt = True
+        for error in (result for result in restored if isinstance(result, Exception)):
+            logger.warning(f"failed to restore a member of {group}: {error!r}")
 
 
 @dataclass
@@ -165,43 +693,101 @@ class ProgramArguments:
     mac_address: str
     inhale_duration_ms: int
     exhale_duration_ms: int
+    mode: BreathingMode
+
+    # None unless a gain was given on the command line, so that the light's tuned gains apply.
+    gains: Optional[PidGains]
+    profile: Optional[BreathingProfile]
+    cue: TransitionCue
 
 
 def get_args() -> ProgramArguments:
+    # argparse and signal are only needed when run from the command line, so importing the module for the engine or
+    # the session host does not pay for them.
+    import argparse
+
     parser = argparse.ArgumentParser(description="Run LIFX breathing process.")
     parser.add_argument("--ip-address", help="IP address of LIFX device", required=True)
     parser.add_argument("--mac-address", help="MAC address of LIFX device", required=True)
     parser.add_argument("--inhale-duration-ms", type=int, help="Inhale duration milliseconds", required=True)
     parser.add_argument("--exhale-duration-ms", type=int, help="Exhale duration milliseconds", required=True)
-    args: argparse.Namespace = parser.parse_args()
+    parser.add_argument(
+        "--mode",
+        choices=[mode.value for mode in BreathingMode],
+        default=DEFAULT_BREATHING_MODE.value,
+        help="Polling (closed loop) or scheduled (open loop) breathing",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(NAMED_PROFILES),
+        help="Breathing pattern for scheduled mode, sized from the inhale and exhale durations",
+    )
+    parser.add_argument(
+        "--cue",
+        choices=[cue.value for cue in TransitionCue],
+        default=DEFAULT_TRANSITION_CUE.value,
+        help="How the end of each phase is shown: power flash, brightness dip or brightness pulse",
+    )
+    # Without any of these the light's tuned gains are used; a gain that is left out takes its default.
+    parser.add_argument("--k-p", type=float, help=f"PID proportional gain (default {DEFAULT_PID_GAINS.k_p})")
+    parser.add_argument("--k-i", type=float, help=f"PID integral gain (default {DEFAULT_PID_GAINS.k_i})")
+    parser.add_argument("--k-d", type=float, help=f"PID derivative gain (default {DEFAULT_PID_GAINS.k_d})")
+    args: "argparse.Namespace" = parser.parse_args()
+    gains: Optional[PidGains] = None
+    if (args.k_p, args.k_i, args.k_d) != (None, None, None):
+        gains = PidGains(
+            k_p=DEFAULT_PID_GAINS.k_p if args.k_p is None else args.k_p,
+            k_i=DEFAULT_PID_GAINS.k_i if args.k_i is None else args.k_i,
+            k_d=DEFAULT_PID_GAINS.k_d if args.k_d is None else args.k_d,
+        )
     return ProgramArguments(
         ip_address=args.ip_address,
         mac_address=args.mac_address,
         inhale_duration_ms=args.inhale_duration_ms,
         exhale_duration_ms=args.exhale_duration_ms,
+        mode=BreathingMode(args.mode),
+        gains=gains,
+        profile=(
+            named_profile(args.profile, args.inhale_duration_ms, args.exhale_duration_ms)
+            if args.profile is not None
+            else None
+        ),
+        cue=TransitionCue(args.cue),
     )
 
 
-def main() -> None:
-    args: ProgramArguments = get_args()
-    logger.info(f"Getting light...")
-    light: Light = Light(args.mac_address, args.ip_address)
-
-    global global_light
-    global_light = light
-    signal.signal(signal.SIGTERM, handler)
-
-    original_color: Tuple[int, int, int, int] = light.get_color()
-    original_power: int = light.get_power()
+async def async_main(args: ProgramArguments) -> None:
+    import signal
 
+    transport: LifxTransport = await LifxTransport.create()
+    logger.info(f"Getting light...")
+    light: AsyncLight = AsyncLight(transport, args.mac_address, args.ip_address)
+
+    session: asyncio.Task[None] = asyncio.ensure_future(
+        run_session(
+            light,
+            args.inhale_duration_ms,
+            args.exhale_duration_ms,
+            args.mode,
+            args.gains,
+            args.profile,
+            LatencyStore(),
+            args.cue,
+            gain_store=GainStore(),
+        )
+    )
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, session.cancel)
     try:
-        run_breathing_cycle(light, args.inhale_duration_ms, args.exhale_duration_ms)
-    except:
-        logger.exception("exception in main")
-        raise
+        await session
+    except asyncio.CancelledError:
+        logger.info("session stopped")
     finally:
-        light.set_color(original_color, rapid=False)
-        light.set_power(original_power, rapid=False)
+        transport.close()
+
+
+def main() -> None:
+    args: ProgramArguments = get_args()
+    asyncio.run(async_main(args))
 
 
 if __name__ == "__main__":
@@ -8,36 +8,32 @@ light = manager.get_light(location='Office', label='Office Lamp')
 """
 
 from pprint import pprint
-from typing import List, Set, FrozenSet, Optional, Any
+from typing import Callable, Dict, Iterable, Iterator, List, Set, FrozenSet, Optional, Any, Sequence, Tuple
+import concurrent.futures
 import dataclasses
-import logging
+import json
+import math
+import os
 import threading
 import time
 
 # -----------------------------------------------------------------------------
 # create logger
 # -----------------------------------------------------------------------------
-logger = logging.getLogger("lifx_manager")
-logger.setLevel(logging.DEBUG)
+from .log_queue import get_logger
 
-# create console handler and set level to debug
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-
-# create formatter
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-
-# add formatter to ch
-ch.setFormatter(formatter)
-
-# add ch to logger
-logger.addHandler(ch)
+logger = get_logger("lifx_manager")
 # -----------------------------------------------------------------------------
 
 
 from lifxlan import LifxLAN, Light, Device
 import lifxlan
 
+from . import metrics
+from .discovery import Address, SubnetDiscovery
+from .inventory_refresher import InventoryRefresher
+from .scheduler import CommandPriority, PacketScheduler, default_scheduler
+
 
 @dataclasses.dataclass(eq=True, frozen=True)
 class LifxLightWrapper:
@@ -47,70 +43,397 @@ class LifxLightWrapper:
     mac_address: str = dataclasses.field(compare=False, hash=False)
 
 
+class LightInventory:
+    """
+    Immutable snapshot of the known lights with hash indexes by (location, label), MAC address and IP address.
+
+    LifxManager never changes a published inventory. Refreshes build a new one and swap the reference, so a reader
+    holding an inventory always sees one consistent set of lights.
+    """
+
+    __slots__ = ("lights", "_by_name", "_by_mac_address", "_by_ip_address")
+
+    lights: Tuple[LifxLightWrapper, ...]
+    _by_name: Dict[Tuple[str, str], LifxLightWrapper]
+    _by_mac_address: Dict[str, LifxLightWrapper]
+    _by_ip_address: Dict[str, LifxLightWrapper]
+
+    def __init__(self, lights: Iterable[LifxLightWrapper] = ()) -> None:
+        by_mac_address: Dict[str, LifxLightWrapper] = {light.mac_address: light for light in lights}
+        self.lights = tuple(sorted(by_mac_address.values(), key=lambda x: (x.location, x.label)))
+        self._by_mac_address = by_mac_address
+        self._by_name = {(light.location, light.label): light for light in self.lights}
+        self._by_ip_address = {light.ip_address: light for light in self.lights}
+
+    def __len__(self) -> int:
+        return len(self.lights)
+
+    def __iter__(self) -> Iterator[LifxLightWrapper]:
+        return iter(self.lights)
+
+    def get(self, location: str, label: str) -> Optional[LifxLightWrapper]:
+        return self._by_name.get((location, label))
+
+    def get_by_mac_address(self, mac_address: str) -> Optional[LifxLightWrapper]:
+        return self._by_mac_address.get(mac_address)
+
+    def get_by_ip_address(self, ip_address: str) -> Optional[LifxLightWrapper]:
+        return self._by_ip_address.get(ip_address)
+
+    def with_light(self, light: LifxLightWrapper) -> "LightInventory":
+        """Return a new inventory with light added, replacing any light with the same MAC address."""
+        return LightInventory(list(self._by_mac_address.values()) + [light])
+
+    def with_changes(
+        self, updated: Iterable[LifxLightWrapper], removed_mac_addresses: Iterable[str]
+    ) -> "LightInventory":
+        """Return a new inventory with updated lights added or replaced and removed MAC addresses dropped."""
+        by_mac_address: Dict[str, LifxLightWrapper] = dict(self._by_mac_address)
+        for mac_address in removed_mac_addresses:
+            by_mac_address.pop(mac_address, None)
+        for light in updated:
+            by_mac_address[light.mac_address] = light
+        return LightInventory(by_mac_address.values())
+
+
+def default_cache_directory() -> str:
+    return os.getenv("LIFX_BREATHING_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lifx_breathing"))
+
+
+def _is_cache_row(row: Any) -> bool:
+    return (
+        isinstance(row, list)
+        and len(row) == 5
+        and all(isinstance(field, str) for field in row[:4])
+        and isinstance(row[4], (int, float))
+        and not isinstance(row[4], bool)
+        and math.isfinite(row[4])
+    )
+
+
+class DeviceCache:
+    """
+    On-disk copy of the light inventory so the app can serve lights immediately after a restart.
+
+    Entries are keyed by MAC address and stored as compact JSON rows of [location, label, ip, mac, seen_at], where
+    seen_at is when the light last answered. Entries not seen for ttl_seconds are ignored on load, malformed rows are
+    skipped, and an entry is dropped as soon as its MAC stops answering at the cached IP.
+    """
+
+    FORMAT_VERSION: int = 1
+    DEFAULT_TTL_SECONDS: float = 7 * 24 * 60 * 60
+    # How stale a last-seen time may get on disk before a light that is still answering causes a rewrite.
+    SEEN_AT_RESOLUTION_SECONDS: float = 60 * 60
+
+    path: str
+    ttl_seconds: float
+
+    # When each cached light last answered, by MAC address.
+    _seen_at: Dict[str, float]
+
+    def __init__(self, path: Optional[str] = None, ttl_seconds: float = DEFAULT_TTL_SECONDS) -> None:
+        self.path = path if path is not None else os.path.join(default_cache_directory(), "devices.json")
+        self.ttl_seconds = ttl_seconds
+        self._seen_at = {}
+
+    def load(self) -> List[LifxLightWrapper]:
+        try:
+            with open(self.path, "r") as f:
+                data: Any = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError):
+            logger.exception(f"ignoring unreadable device cache {self.path}")
+            return []
+        if not isinstance(data, dict):
+            logger.warning(f"ignoring device cache {self.path} that is not a JSON object")
+            return []
+        if data.get("version") != self.FORMAT_VERSION:
+            return []
+        rows: Any = data.get("lights", [])
+        if not isinstance(rows, list):
+            logger.warning(f"ignoring device cache {self.path} whose lights are not a list")
+            return []
+        oldest_seen_at: float = time.time() - self.ttl_seconds
+        lights: List[LifxLightWrapper] = []
+        for row in rows:
+            if not _is_cache_row(row):
+                logger.warning(f"skipping malformed device cache row {row!r}")
+                continue
+            (location, label, ip_address, mac_address, seen_at) = row
+            if seen_at < oldest_seen_at:
+                continue
+            self._seen_at[mac_address] = seen_at
+            lights.append(
+                LifxLightWrapper(location=location, label=label, ip_address=ip_address, mac_address=mac_address)
+            )
+        return lights
+
+    def is_out_of_date(self, mac_addresses: Iterable[str]) -> bool:
+        oldest_seen_at: float = time.time() - self.SEEN_AT_RESOLUTION_SECONDS
+        return any(self._seen_at.get(mac_address, 0.0) < oldest_seen_at for mac_address in mac_addresses)
+
+    def save(self, lights: Iterable[LifxLightWrapper], seen_mac_addresses: Optional[Iterable[str]] = None) -> None:
+        """
+        Write lights to the cache. The lights in seen_mac_addresses, or all of them when it is None, are stamped as
+        seen now; the others keep the time they were last seen, so they still expire.
+        """
+        lights = list(lights)
+        now: float = time.time()
+        seen: Set[str] = (
+            {light.mac_address for light in lights} if seen_mac_addresses is None else set(seen_mac_addresses)
+        )
+        for light in lights:
+            if light.mac_address in seen or light.mac_address not in self._seen_at:
+                self._seen_at[light.mac_address] = now
+        rows: Dict[str, List[Any]] = {
+            light.mac_address: [
+                light.location,
+                light.label,
+                light.ip_address,
+                light.mac_address,
+                self._seen_at[light.mac_address],
+            ]
+            for light in lights
+        }
+        data: Dict[str, Any] = {"version": self.FORMAT_VERSION, "lights": list(rows.values())}
+        directory: str = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path: str = f"{self.path}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(temporary_path, self.path)
+        except OSError:
+            logger.exception(f"could not write device cache {self.path}")
+
+
 class LifxManager:
     UPDATE_LIGHTS_ITERATIONS: int = 3
     UPDATE_LIGHTS_SLEEP_INTERVAL_SECONDS: float = 0.017
-    BACKGROUND_LIGHTS_UPDATE_INTERVAL_SECONDS: float = 15 * 60
+    DISCOVERY_MAX_WORKERS: int = 16
+    DISCOVERY_ROUND_TIMEOUT_SECONDS: float = 5.0
+    LIFX_PORT: int = 56700
 
     _lan: LifxLAN
-    _lights: List[LifxLightWrapper]
-    _updater_thread: threading.Timer
+    _inventory: LightInventory
+    _refresher: Optional["InventoryRefresher"]
+    _update_lock: threading.Lock
+    _publish_lock: threading.Lock
+    _cache: Optional[DeviceCache]
+    _scheduler: PacketScheduler
+    _discovery: Optional[SubnetDiscovery]
+    _closed: bool
+
+    def __init__(
+        self,
+        lan: Optional[LifxLAN] = None,
+        cache: Optional[DeviceCache] = None,
+        scheduler: Optional[PacketScheduler] = None,
+        discovery: Optional[SubnetDiscovery] = None,
+    ) -> None:
+        """
+        Serve lights from the device cache straight away, then verify them and rediscover in the background.
 
-    def __init__(self) -> None:
+        The constructor never waits on the network. Without a cache the light list starts empty. With discovery,
+        lights are discovered on its subnets and ranges instead of by lan.
+        """
         logger.info("__init__ entry")
-        self._lan = LifxLAN()
-        self._lights = list()
+        self._lan = lan if lan is not None else LifxLAN()
+        self._cache = cache
+        self._scheduler = scheduler if scheduler is not None else default_scheduler()
+        self._discovery = discovery
+        self._inventory = LightInventory(self._cache.load() if self._cache is not None else [])
+        self._update_lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._closed = False
+        self._refresher = None
+        logger.info(f"loaded {len(self._inventory)} lights from the device cache")
+        threading.Thread(target=self._start_in_background, name="lifx-manager-startup", daemon=True).start()
+
+    def _start_in_background(self) -> None:
+        if len(self._inventory) > 0:
+            self.verify_cached_lights()
         self.update_lights_in_thread()
 
     @property
-    def lights(self) -> List[LifxLightWrapper]:
-        return self._lights
+    def is_updating(self) -> bool:
+        return self._update_lock.locked()
+
+    @property
+    def inventory(self) -> LightInventory:
+        return self._inventory
+
+    @property
+    def lights(self) -> Sequence[LifxLightWrapper]:
+        return self._inventory.lights
 
     def get_light(self, location: str, label: str) -> Optional[LifxLightWrapper]:
-        logger.info("get_light entry")
-        for light in self._lights:
-            if light.location == location and light.label == label:
-                return light
-        return None
+        return self._inventory.get(location, label)
+
+    def get_light_by_mac_address(self, mac_address: str) -> Optional[LifxLightWrapper]:
+        return self._inventory.get_by_mac_address(mac_address)
+
+    def get_light_by_ip_address(self, ip_address: str) -> Optional[LifxLightWrapper]:
+        return self._inventory.get_by_ip_address(ip_address)
+
+    def _publish(self, inventory: LightInventory) -> None:
+        # A single reference assignment is atomic, so readers see either the old or the new snapshot.
+        self._inventory = inventory
 
     def update_lights_in_thread(self) -> None:
+        """Run one full discovery, then keep the inventory current with the incremental InventoryRefresher."""
         self.update_lights()
-        self._updater_thread = threading.Timer(
-            self.BACKGROUND_LIGHTS_UPDATE_INTERVAL_SECONDS, self.update_lights_in_thread
-        )
-        self._updater_thread.start()
+        if self._closed or self._refresher is not None:
+            return
+        self._refresher = InventoryRefresher(self, discovery=self._discovery)
+        self._refresher.start()
+
+    def update_lights_in_background(self) -> None:
+        """Start a refresh without waiting for it. Does nothing if a refresh is already running."""
+        if self._update_lock.locked():
+            logger.info("update_lights_in_background skipped, update already running")
+            return
+        threading.Thread(target=self.update_lights, name="lifx-update-lights", daemon=True).start()
 
     def update_lights(self) -> None:
         logger.info("update_lights entry")
-        self._lights = self.get_new_lights()
+        with self._update_lock:
+            started_at: float = time.perf_counter()
+            new_lights: List[LifxLightWrapper] = self.get_new_lights(on_light_found=self._merge_light)
+            metrics.DISCOVERY_DURATION_SECONDS.observe(time.perf_counter() - started_at)
+            with self._publish_lock:
+                self._publish(LightInventory(new_lights))
+            if self._cache is not None:
+                self._cache.save(new_lights)
 
-    def get_new_lights(self) -> List[LifxLightWrapper]:
-        logger.info("get_new_lights entry")
-        seen_mac_addresses: Set[str] = set()
-        result: Set[LifxLightWrapper] = set()
-        for i in range(self.UPDATE_LIGHTS_ITERATIONS):
-            time.sleep(self.UPDATE_LIGHTS_SLEEP_INTERVAL_SECONDS)
-            devices: List[Device] = self._lan.get_devices()
-            current_lights: List[LifxLightWrapper] = []
-            for device in devices:
-                if device.get_mac_addr() in seen_mac_addresses:
-                    continue
+    def verify_cached_lights(self) -> None:
+        """Ask every cached light, by MAC, to describe itself at its cached IP and drop those that do not answer."""
+        logger.info("verify_cached_lights entry")
+        cached: LightInventory = self._inventory
+        with self._update_lock:
+            verified: Dict[str, LifxLightWrapper] = self.probe_lights(
+                {light.mac_address: light.ip_address for light in cached}
+            )
+            with self._publish_lock:
+                self._publish(LightInventory(verified.values()))
+            if self._cache is not None:
+                self._cache.save(verified.values())
+            logger.info(f"verified {len(verified)} of {len(cached)} cached lights")
+
+    def probe_lights(self, ip_addresses: Dict[str, str]) -> Dict[str, LifxLightWrapper]:
+        """Describe the lights at the given {MAC address: IP address}, returning those that answered."""
+        devices: List[Device] = [
+            Light(mac_address, ip_address, port=self.LIFX_PORT, source_id=self._lan.source_id)
+            for (mac_address, ip_address) in ip_addresses.items()
+        ]
+        return self._describe_devices(devices)
+
+    def apply_inventory_changes(
+        self, updated: Iterable[LifxLightWrapper], removed_mac_addresses: Iterable[str]
+    ) -> None:
+        updated = list(updated)
+        with self._publish_lock:
+            self._publish(self._inventory.with_changes(updated, removed_mac_addresses))
+        if self._cache is not None:
+            self._cache.save(self._inventory, seen_mac_addresses=[light.mac_address for light in updated])
+
+    def mark_lights_seen(self, mac_addresses: Iterable[str]) -> None:
+        """Record that these lights answered, rewriting the cache once their last-seen times are out of date."""
+        mac_addresses = list(mac_addresses)
+        if self._cache is not None and self._cache.is_out_of_date(mac_addresses):
+            self._cache.save(self._inventory, seen_mac_addresses=mac_addresses)
+
+    def _merge_light(self, light: LifxLightWrapper) -> None:
+        # Publish each light as soon as it is described.
+        with self._publish_lock:
+            self._publish(self._inventory.with_light(light))
+
+    def _describe_device(self, device: Device) -> LifxLightWrapper:
+        # Describing a device asks it for its location and its label. Both requests wait behind breathing traffic to
+        # the same bulb, so a refresh cannot throw off a session's timing.
+        for _ in range(2):
+            self._scheduler.acquire_blocking(device.get_mac_addr().lower(), CommandPriority.DISCOVERY)
+        return LifxLightWrapper(
+            location=device.get_location_label(),
+            label=device.get_label(),
+            ip_address=device.get_ip_addr(),
+            mac_address=device.get_mac_addr(),
+        )
+
+    def _describe_devices(
+        self,
+        devices: List[Device],
+        on_light_found: Optional[Callable[[LifxLightWrapper], None]] = None,
+        executor: Optional[concurrent.futures.ThreadPoolExecutor] = None,
+    ) -> Dict[str, LifxLightWrapper]:
+        """
+        Describe devices concurrently, waiting at most DISCOVERY_ROUND_TIMEOUT_SECONDS for all of them.
+
+        At most DISCOVERY_MAX_WORKERS devices are queried at once. Devices that fail or have not answered by the
+        timeout are left out of the result.
+        """
+        result: Dict[str, LifxLightWrapper] = {}
+        owns_executor: bool = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.DISCOVERY_MAX_WORKERS, thread_name_prefix="lifx-discovery"
+            )
+        futures: Set["concurrent.futures.Future[LifxLightWrapper]"] = {
+            executor.submit(self._describe_device, device) for device in devices
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=self.DISCOVERY_ROUND_TIMEOUT_SECONDS):
                 try:
-                    light: LifxLightWrapper = LifxLightWrapper(
-                        location=device.get_location_label(),
-                        label=device.get_label(),
-                        ip_address=device.get_ip_addr(),
-                        mac_address=device.get_mac_addr(),
-                    )
-                    current_lights.append(light)
+                    light: LifxLightWrapper = future.result()
                 except lifxlan.errors.WorkflowException:
                     logger.exception("error while updating lights")
+                    metrics.WORKFLOW_EXCEPTION_RETRIES.labels(operation="discovery").inc()
                     continue
-                seen_mac_addresses.add(device.get_mac_addr())
-            result.update(current_lights)
-        return sorted(result, key=lambda x: (x.location, x.label))
+                result[light.mac_address] = light
+                if on_light_found is not None:
+                    on_light_found(light)
+        except concurrent.futures.TimeoutError:
+            pending: int = sum(1 for future in futures if not future.cancel() and not future.done())
+            logger.warning(f"describing devices timed out with {pending} devices still answering")
+        finally:
+            if owns_executor:
+                executor.shutdown(wait=False)
+        return result
+
+    def _discover_devices(self) -> List[Device]:
+        if self._discovery is None:
+            return self._lan.get_devices()
+        found: Dict[str, Address] = self._discovery.scan()
+        return [
+            Light(mac_address, ip_address, port=port, source_id=self._lan.source_id)
+            for (mac_address, (ip_address, port)) in found.items()
+        ]
+
+    def get_new_lights(
+        self, on_light_found: Optional[Callable[[LifxLightWrapper], None]] = None
+    ) -> List[LifxLightWrapper]:
+        """Discover lights, describing every device of a discovery round concurrently."""
+        logger.info("get_new_lights entry")
+        result: Dict[str, LifxLightWrapper] = {}
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.DISCOVERY_MAX_WORKERS, thread_name_prefix="lifx-discovery"
+        )
+        try:
+            for i in range(self.UPDATE_LIGHTS_ITERATIONS):
+                time.sleep(self.UPDATE_LIGHTS_SLEEP_INTERVAL_SECONDS)
+                devices: List[Device] = [
+                    device for device in self._discover_devices() if device.get_mac_addr() not in result
+                ]
+                result.update(self._describe_devices(devices, on_light_found, executor))
+        finally:
+            executor.shutdown(wait=False)
+        return sorted(result.values(), key=lambda x: (x.location, x.label))
 
     def close(self) -> None:
         logger.info("close entry")
-        self._updater_thread.cancel()
+        self._closed = True
+        if self._refresher is not None:
+            self._refresher.stop()
 
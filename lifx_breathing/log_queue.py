@@ -0,0 +1,219 @@
+"""
+Queue-backed logging, so that writing a log line never holds up a breathing phase.
+
+Every module gets its logger from get_logger, which attaches the process's QueueLogHandler rather than a
+StreamHandler. The handler is a logging.handlers.QueueHandler that puts each record on a bounded queue as it is:
+nothing is formatted and nothing is written on the caller's thread. One LogWriter per process runs a QueueListener
+that takes records off the queue, formats them and writes each batch to stderr with one write and one flush. When the
+queue is full, because stderr is a supervisord pipe that is not being drained, records are dropped and counted instead
+of stalling the event loop, and the writer reports how many it lost.
+
+Hot-path callers pass %-style arguments instead of f-strings, so the message is only built on the writer thread, and
+attach structured fields with extra={"session_event": {...}}. With LIFX_BREATHING_LOG_FORMAT=json every record is
+written as one JSON object that includes those fields.
+
+from lifx_breathing.log_queue import get_logger
+logger = get_logger("engine")
+logger.info("cycle %d finished %d ms late", cnt, lateness_ms, extra={"session_event": {"cycle": cnt}})
+"""
+
+from typing import Any, Dict, List, Optional, TextIO
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+from . import metrics
+
+MAX_QUEUED_RECORDS: int = 10000
+MAX_BATCH_RECORDS: int = 512
+
+DEFAULT_FORMATTER: logging.Formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the fields of its session_event merged in."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "session_event", {}))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class _BatchHandler(logging.Handler):
+    """Formats the records a QueueListener hands it and writes them out a batch at a time."""
+
+    # None stands for whatever sys.stderr is at write time, like a StreamHandler created without a stream.
+    _stream: Optional[TextIO]
+    _lines: List[str]
+
+    def __init__(self, stream: Optional[TextIO], formatter: logging.Formatter) -> None:
+        super().__init__()
+        self._stream = stream
+        self._lines = []
+        self.setFormatter(formatter)
+
+    @property
+    def pending(self) -> int:
+        return len(self._lines)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._lines.append(self.format(record))
+        except Exception:
+            self._lines.append(f"unformattable log record from {record.name}: {record.msg!r} {record.args!r}")
+
+    def write_batch(self, dropped: int) -> None:
+        lines: List[str] = self._lines
+        self._lines = []
+        if dropped:
+            lines.insert(0, f"log queue was full, dropped {dropped} records")
+        if not lines:
+            return
+        try:
+            stream: TextIO = self._stream or sys.stderr
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except (OSError, ValueError):
+            # Nowhere left to write to, e.g. stderr closed at exit; keep draining so flush() cannot hang.
+            pass
+
+
+class _BatchingListener(logging.handlers.QueueListener):
+    _writer: "LogWriter"
+    _batch_handler: _BatchHandler
+
+    def __init__(self, writer: "LogWriter", batch_handler: _BatchHandler) -> None:
+        super().__init__(writer.queue, batch_handler)
+        self._writer = writer
+        self._batch_handler = batch_handler
+
+    def start(self) -> None:
+        super().start()
+        self._thread.name = "log-writer"  # type: ignore
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def handle(self, record: logging.LogRecord) -> None:
+        super().handle(record)
+        # The record is only marked done after this returns, so flush() cannot return before its batch is written.
+        if self.queue.empty() or self._batch_handler.pending >= MAX_BATCH_RECORDS:
+            self._batch_handler.write_batch(self._writer.take_dropped())
+
+    def enqueue_sentinel(self) -> None:
+        # Blocks rather than drops: the stop request must get through.
+        self.queue.put(self._sentinel)
+
+    def stop(self) -> None:
+        super().stop()
+        # Records handled while the stop request was already queued are still waiting to be written.
+        self._batch_handler.write_batch(self._writer.take_dropped())
+
+
+class LogWriter:
+    """A QueueListener that formats and writes queued log records on a background thread, a batch at a time."""
+
+    queue: "queue.Queue[Optional[logging.LogRecord]]"
+
+    # Records dropped since the writer last reported a drop. QueueLogHandlers on any thread add to it.
+    _dropped: int
+    _dropped_lock: threading.Lock
+    _listener: _BatchingListener
+
+    def __init__(
+        self,
+        stream: Optional[TextIO] = None,
+        max_queued_records: int = MAX_QUEUED_RECORDS,
+        json_lines: bool = False,
+        formatter: logging.Formatter = DEFAULT_FORMATTER,
+    ) -> None:
+        self.queue = queue.Queue(max_queued_records)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._listener = _BatchingListener(self, _BatchHandler(stream, JsonFormatter() if json_lines else formatter))
+        self._listener.start()
+
+    def count_dropped(self) -> None:
+        with self._dropped_lock:
+            self._dropped += 1
+        metrics.LOG_RECORDS_DROPPED.inc()
+
+    def take_dropped(self) -> int:
+        with self._dropped_lock:
+            (dropped, self._dropped) = (self._dropped, 0)
+        return dropped
+
+    def flush(self) -> None:
+        """Block until every record queued so far has been written."""
+        thread: Optional[threading.Thread] = self._listener._thread  # type: ignore
+        if thread is not None and thread.is_alive():
+            self.queue.join()
+
+    def close(self) -> None:
+        self._listener.stop()
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    _writer: LogWriter
+
+    def __init__(self, writer: LogWriter, level: int = logging.NOTSET) -> None:
+        super().__init__(writer.queue)
+        self.setLevel(level)
+        self._writer = writer
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # The queue is thread-safe, so skip the handler lock that Handler.handle takes around emit.
+        passed: bool = bool(self.filter(record))
+        if passed:
+            self.emit(record)
+        return passed
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Hand over the record as it is: its message and arguments are only formatted on the writer thread.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._writer.count_dropped()
+
+
+_default_writer: Optional[LogWriter] = None
+_default_handler: Optional[QueueLogHandler] = None
+_default_writer_lock: threading.Lock = threading.Lock()
+
+
+def default_writer() -> LogWriter:
+    """The process's shared writer, created on first use and flushed at exit."""
+    global _default_writer, _default_handler
+    if _default_writer is None:
+        with _default_writer_lock:
+            if _default_writer is None:
+                writer: LogWriter = LogWriter(json_lines=os.getenv("LIFX_BREATHING_LOG_FORMAT") == "json")
+                atexit.register(writer.flush)
+                _default_handler = QueueLogHandler(writer)
+                _default_writer = writer
+    return _default_writer
+
+
+def get_logger(name: str) -> logging.Logger:
+    """The named logger at DEBUG level, writing through the process's shared QueueLogHandler."""
+    default_writer()
+    logger: logging.Logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    if _default_handler not in logger.handlers:
+        logger.addHandler(_default_handler)  # type: ignore
+    return logger
@@ -0,0 +1,223 @@
+"""
+In-process counters, gauges and histograms, rendered in the Prometheus text format by flask_app's /metrics route.
+
+Recording is meant for the breathing hot path: a counter increment or histogram observation is a bisect over a short
+tuple of bucket bounds and a few integer additions under an uncontended lock, about a microsecond. Metrics are created
+once at import time or on first use, then looked up by reference.
+
+from lifx_breathing import metrics
+metrics.REQUEST_TIMEOUTS.inc()
+metrics.PHASE_ERROR_MS.labels(mode="scheduled").observe(3.2)
+print(metrics.REGISTRY.render())
+"""
+
+from typing import Any, Callable, Dict, FrozenSet, Generic, Iterator, List, Optional, Sequence, Tuple, TypeVar
+import bisect
+import threading
+
+LabelSet = FrozenSet[Tuple[str, str]]
+
+MILLISECOND_BUCKETS: Tuple[float, ...] = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+SECOND_BUCKETS: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels: LabelSet, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs: List[Tuple[str, str]] = sorted(labels)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for (key, value) in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    __slots__ = ("_lock", "value")
+
+    value: float
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: LabelSet) -> Iterator[str]:
+        yield f"{name}{_format_labels(labels)} {_format_value(self.value)}"
+
+
+class Gauge:
+    __slots__ = ("_function", "value")
+
+    value: float
+    _function: Optional[Callable[[], float]]
+
+    def __init__(self) -> None:
+        self.value = 0
+        self._function = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the value from function at render time instead of keeping it up to date on the hot path."""
+        self._function = function
+
+    def samples(self, name: str, labels: LabelSet) -> Iterator[str]:
+        value: float = self._function() if self._function is not None else self.value
+        yield f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class Histogram:
+    __slots__ = ("_lock", "bounds", "bucket_counts", "count", "sum")
+
+    bounds: Tuple[float, ...]
+    bucket_counts: List[int]
+    count: int
+    sum: float
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self._lock = threading.Lock()
+        self.bounds = tuple(sorted(bounds))
+        # One count per bucket plus the +Inf bucket; made cumulative only when rendered.
+        self.bucket_counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index: int = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: LabelSet) -> Iterator[str]:
+        with self._lock:
+            bucket_counts: List[int] = list(self.bucket_counts)
+            (count, total) = (self.count, self.sum)
+        cumulative: int = 0
+        for (bound, bucket_count) in zip(self.bounds + (float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            le: str = "+Inf" if bound == float("inf") else _format_value(bound)
+            yield f"{name}_bucket{_format_labels(labels, ('le', le))} {cumulative}"
+        yield f"{name}_sum{_format_labels(labels)} {_format_value(total)}"
+        yield f"{name}_count{_format_labels(labels)} {count}"
+
+
+M = TypeVar("M", Counter, Gauge, Histogram)
+
+
+class MetricFamily(Generic[M]):
+    """Every labelled child of one metric name. Calling a family without labels() records the unlabelled child."""
+
+    name: str
+    help: str
+    metric_type: str
+    _factory: Callable[[], M]
+    _children: Dict[LabelSet, M]
+    _lock: threading.Lock
+
+    def __init__(self, name: str, help: str, metric_type: str, factory: Callable[[], M]) -> None:
+        self.name = name
+        self.help = help
+        self.metric_type = metric_type
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels: str) -> M:
+        key: LabelSet = frozenset(labels.items())
+        child: Optional[M] = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._factory())
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)  # type: ignore
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)  # type: ignore
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.labels().set_function(function)  # type: ignore
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)  # type: ignore
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        for (labels, child) in sorted(self._children.items(), key=lambda item: sorted(item[0])):
+            yield from child.samples(self.name, labels)
+
+
+class Registry:
+    _families: Dict[str, MetricFamily[Any]]
+
+    def __init__(self) -> None:
+        self._families = {}
+
+    def _register(self, family: MetricFamily[M]) -> MetricFamily[M]:
+        return self._families.setdefault(family.name, family)
+
+    def counter(self, name: str, help: str) -> MetricFamily[Counter]:
+        return self._register(MetricFamily(name, help, "counter", Counter))
+
+    def gauge(self, name: str, help: str) -> MetricFamily[Gauge]:
+        return self._register(MetricFamily(name, help, "gauge", Gauge))
+
+    def histogram(
+        self, name: str, help: str, buckets: Sequence[float] = MILLISECOND_BUCKETS
+    ) -> MetricFamily[Histogram]:
+        return self._register(MetricFamily(name, help, "histogram", lambda: Histogram(buckets)))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name in sorted(self._families):
+            lines.extend(self._families[name].render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY: Registry = Registry()
+
+# Scheduled mode records how late each phase's first packet left; polling mode records |actual - target| duration.
+PHASE_ERROR_MS: MetricFamily[Histogram] = REGISTRY.histogram(
+    "lifx_breathing_phase_error_ms", "Absolute breathing phase timing error by mode."
+)
+REQUEST_RTT_MS: MetricFamily[Histogram] = REGISTRY.histogram(
+    "lifx_request_rtt_ms", "Round trip from sending a LIFX request to its reply or acknowledgement."
+)
+REQUEST_TIMEOUTS: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_request_timeouts_total", "LIFX requests that raised WorkflowException because no reply arrived in time."
+)
+REQUEST_RETRIES: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_request_retries_total", "LIFX requests retransmitted after an attempt went unanswered."
+)
+RETRY_BUDGET_EXHAUSTED: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_retry_budget_exhausted_total", "LIFX requests that gave up early because the bulb's retry budget was spent."
+)
+WORKFLOW_EXCEPTION_RETRIES: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_workflow_exception_retries_total", "WorkflowExceptions that were caught and retried or skipped."
+)
+DISCOVERY_DURATION_SECONDS: MetricFamily[Histogram] = REGISTRY.histogram(
+    "lifx_discovery_duration_seconds", "Duration of a full LifxManager.update_lights discovery.", SECOND_BUCKETS
+)
+ACTIVE_SESSIONS: MetricFamily[Gauge] = REGISTRY.gauge("lifx_breathing_active_sessions", "Breathing sessions that are active.")
+STATUS_STREAM_CLIENTS: MetricFamily[Gauge] = REGISTRY.gauge(
+    "lifx_breathing_status_stream_clients", "Dashboards connected to the live status stream."
+)
+COMMANDS_THROTTLED: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_commands_throttled_total", "LIFX packets that waited for their bulb's packet budget, by priority."
+)
+COMMANDS_COALESCED: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_commands_coalesced_total", "Colour and waveform commands dropped unsent because a newer one replaced them."
+)
+LOG_RECORDS_DROPPED: MetricFamily[Counter] = REGISTRY.counter(
+    "lifx_breathing_log_records_dropped_total", "Log records dropped because the log writer's queue was full."
+)
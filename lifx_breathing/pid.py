@@ -0,0 +1,90 @@
+"""
+PID controller used to correct breathing phase durations.
+
+Each controller keeps the last history_window_size errors in a fixed-size ring buffer together with their running
+sum, so an update is O(1) and allocates nothing. The engine runs one controller per breathing phase, and controllers
+for different phases share one immutable PidGains.
+
+from lifx_breathing.pid import PidController, PidGains
+controller = PidController(PidGains(k_p=1.0, k_i=0.05, k_d=0.03))
+correction_ms = controller.update(target_ms - actual_ms)
+"""
+
+from typing import List
+import dataclasses
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class PidGains:
+    k_p: float = 1.0
+    k_i: float = 0.05
+    k_d: float = 0.03
+    history_window_size: int = 10
+
+    # Anti-windup: the windowed sum of errors is clamped to +/- this many milliseconds before k_i is applied.
+    integral_limit_ms: int = 5000
+
+
+DEFAULT_PID_GAINS: PidGains = PidGains()
+
+
+class PidController:
+    __slots__ = (
+        "gains",
+        "_errors",
+        "_index",
+        "_count",
+        "_sum",
+        "error_ms",
+        "cumulative_error_ms",
+        "derivative_error_ms",
+    )
+
+    gains: PidGains
+    _errors: List[int]
+    _index: int
+    _count: int
+    _sum: int
+    error_ms: int
+    cumulative_error_ms: int
+    derivative_error_ms: int
+
+    def __init__(self, gains: PidGains = DEFAULT_PID_GAINS) -> None:
+        if gains.history_window_size < 1:
+            raise ValueError("history_window_size must be at least 1")
+        self.gains = gains
+        self._errors = [0] * gains.history_window_size
+        self.reset()
+
+    def reset(self) -> None:
+        for i in range(len(self._errors)):
+            self._errors[i] = 0
+        self._index = 0
+        self._count = 0
+        self._sum = 0
+        self.error_ms = 0
+        self.cumulative_error_ms = 0
+        self.derivative_error_ms = 0
+
+    def update(self, error_ms: int) -> int:
+        """Record the latest error and return the correction to add to the next duration."""
+        gains: PidGains = self.gains
+        window: int = len(self._errors)
+        if self._count == window:
+            self._sum -= self._errors[self._index]
+        else:
+            self._count += 1
+        self._errors[self._index] = error_ms
+        self._sum += error_ms
+        self._index = (self._index + 1) % window
+
+        self.derivative_error_ms = error_ms - self.error_ms if self._count > 1 else 0
+        self.error_ms = error_ms
+        limit: int = gains.integral_limit_ms
+        self.cumulative_error_ms = max(-limit, min(limit, self._sum))
+
+        return (
+            int(gains.k_p * error_ms)
+            + int(gains.k_i * self.cumulative_error_ms)
+            + int(gains.k_d * self.derivative_error_ms)
+        )
@@ -0,0 +1,176 @@
+"""
+Breathing profiles and their compiled keyframe tables.
+
+A BreathingProfile is an immutable list of phases (inhale, hold, exhale, ...) with a colour and duration each. The
+scheduled breathing cycle does not read a profile directly: compile_profile turns it into a KeyframeTable once, and an
+LRU cache keyed by the profile means every later session with an equal profile reuses the same table.
+
+from lifx_breathing.profiles import box_profile, compile_profile
+table = compile_profile(box_profile(count_ms=4000))
+table.colors[0], table.durations_ms[0]
+"""
+
+from typing import Callable, Dict, Tuple
+import array
+import dataclasses
+import functools
+
+Color = Tuple[int, int, int, int]
+
+# Colors are HSBK: [hue (0-65535), saturation (0-65535), brightness (0-65535), Kelvin (2500-9000)]
+RED: Color = (0, 65535, 65535, 3500)
+BLUE: Color = (36044, 65535, 65535, 3500)
+
+# Each phase ends with the bulb switched off for this long, which cues the start of the next phase.
+DEFAULT_FLASH_DURATION_MS: int = 200
+PROFILE_CACHE_SIZE: int = 64
+
+# Keyframe tables hold durations as unsigned 32-bit ints; nobody breathes in for longer than this anyway.
+MAX_PHASE_DURATION_MS: int = 300000
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class BreathingPhase:
+    name: str
+    duration_ms: int
+
+    # The colour the bulb shows at the end of the phase.
+    color: Color
+
+    # Fade into color across the phase (inhale, exhale) or switch to it at once and hold it (hold).
+    fade: bool = True
+    flash_duration_ms: int = DEFAULT_FLASH_DURATION_MS
+
+    def __post_init__(self) -> None:
+        if not 0 < self.duration_ms <= MAX_PHASE_DURATION_MS:
+            raise ValueError(f"phase {self.name} must last longer than 0 ms and at most {MAX_PHASE_DURATION_MS} ms")
+        if len(self.color) != 4 or not all(0 <= value <= 65535 for value in self.color):
+            raise ValueError(f"phase {self.name} color must be four HSBK values between 0 and 65535")
+        # Colours decoded from JSON arrive as lists; keep phases hashable so that they can key the cache.
+        object.__setattr__(self, "color", tuple(int(value) for value in self.color))
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class BreathingProfile:
+    name: str
+    phases: Tuple[BreathingPhase, ...]
+
+    def __post_init__(self) -> None:
+        if not self.phases:
+            raise ValueError(f"profile {self.name} has no phases")
+        object.__setattr__(self, "phases", tuple(self.phases))
+
+
+class KeyframeTable:
+    """
+    One breathing cycle as parallel per-keyframe arrays, ready to be replayed without touching the profile again.
+
+    colors holds the HSBK tuple each keyframe ends on. durations_ms, fade_durations_ms and flash_durations_ms are
+    unsigned int arrays; a fade duration of 0 switches colour at once. send_color is 0 for a keyframe whose colour is
+    the one the bulb already shows, so holds cost no colour packet.
+    """
+
+    __slots__ = (
+        "name",
+        "phase_names",
+        "colors",
+        "durations_ms",
+        "fade_durations_ms",
+        "flash_durations_ms",
+        "send_color",
+    )
+
+    name: str
+    phase_names: Tuple[str, ...]
+    colors: Tuple[Color, ...]
+    durations_ms: "array.array[int]"
+    fade_durations_ms: "array.array[int]"
+    flash_durations_ms: "array.array[int]"
+    send_color: "array.array[int]"
+
+    def __init__(self, profile: BreathingProfile) -> None:
+        phases: Tuple[BreathingPhase, ...] = profile.phases
+        self.name = profile.name
+        self.phase_names = tuple(phase.name for phase in phases)
+        self.colors = tuple(phase.color for phase in phases)
+        self.durations_ms = array.array("I", (phase.duration_ms for phase in phases))
+        self.flash_durations_ms = array.array("I", (min(phase.flash_duration_ms, phase.duration_ms) for phase in phases))
+        self.fade_durations_ms = array.array(
+            "I",
+            (
+                max(phase.duration_ms - flash_duration_ms, 0) if phase.fade else 0
+                for (phase, flash_duration_ms) in zip(phases, self.flash_durations_ms)
+            ),
+        )
+        # The cycle repeats, so the first keyframe follows the last one.
+        self.send_color = array.array(
+            "B", (int(color != self.colors[i - 1]) for (i, color) in enumerate(self.colors))
+        )
+
+    def __len__(self) -> int:
+        return len(self.colors)
+
+    @property
+    def cycle_duration_ms(self) -> int:
+        return sum(self.durations_ms)
+
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def compile_profile(profile: BreathingProfile) -> KeyframeTable:
+    return KeyframeTable(profile)
+
+
+def classic_profile(
+    inhale_duration_ms: int, exhale_duration_ms: int, inhale_color: Color = BLUE, exhale_color: Color = RED
+) -> BreathingProfile:
+    """Fade to inhale_color while breathing in and back to exhale_color while breathing out."""
+    return BreathingProfile(
+        "classic",
+        (
+            BreathingPhase("inhale", inhale_duration_ms, inhale_color),
+            BreathingPhase("exhale", exhale_duration_ms, exhale_color),
+        ),
+    )
+
+
+def box_profile(count_ms: int = 4000, inhale_color: Color = BLUE, exhale_color: Color = RED) -> BreathingProfile:
+    """Inhale, hold, exhale and hold again, each for count_ms."""
+    return BreathingProfile(
+        "box",
+        (
+            BreathingPhase("inhale", count_ms, inhale_color),
+            BreathingPhase("hold", count_ms, inhale_color, fade=False),
+            BreathingPhase("exhale", count_ms, exhale_color),
+            BreathingPhase("hold", count_ms, exhale_color, fade=False),
+        ),
+    )
+
+
+def four_seven_eight_profile(
+    count_ms: int = 1000, inhale_color: Color = BLUE, exhale_color: Color = RED
+) -> BreathingProfile:
+    """Inhale for 4 counts, hold for 7 and exhale for 8."""
+    return BreathingProfile(
+        "4-7-8",
+        (
+            BreathingPhase("inhale", 4 * count_ms, inhale_color),
+            BreathingPhase("hold", 7 * count_ms, inhale_color, fade=False),
+            BreathingPhase("exhale", 8 * count_ms, exhale_color),
+        ),
+    )
+
+
+# Named profiles for the CLI and the API. Each is sized from the requested inhale and exhale durations: box uses the
+# inhale duration for every side and 4-7-8 derives its count from the 4-count inhale.
+NAMED_PROFILES: Dict[str, Callable[[int, int], BreathingProfile]] = {
+    "classic": classic_profile,
+    "box": lambda inhale_duration_ms, exhale_duration_ms: box_profile(inhale_duration_ms),
+    "4-7-8": lambda inhale_duration_ms, exhale_duration_ms: four_seven_eight_profile(inhale_duration_ms // 4),
+}
+
+
+def named_profile(name: str, inhale_duration_ms: int, exhale_duration_ms: int) -> BreathingProfile:
+    if name not in NAMED_PROFILES:
+        raise ValueError(f"unknown profile {name!r}, expected one of {sorted(NAMED_PROFILES)}")
+    return NAMED_PROFILES[name](inhale_duration_ms, exhale_duration_ms)
+
@@ -0,0 +1,548 @@
+"""
+Asynchronous LIFX LAN client that shares one UDP socket between many bulbs.
+
+lifxlan opens a new blocking socket for every request and waits for the reply before returning. The breathing engine
+instead keeps a single asyncio datagram endpoint open and matches replies to requests by (MAC address, sequence
+number), so many sessions can talk to many bulbs from one event loop.
+
+Acknowledged requests are retransmitted under a RetryPolicy: every attempt gets a new sequence number and a reply to
+any of them completes the request, so requests pipeline freely and a late reply is never wasted. Retries draw from a
+per-bulb RetryBudget, so an unreachable bulb costs a bounded share of extra packets instead of a retry storm. Every
+packet, retransmissions included, first waits for the bulb's packet budget in the PacketScheduler, and a colour,
+power or waveform command that is replaced while it waits is dropped unsent.
+
+from lifx_breathing.protocol import LifxTransport, AsyncLight
+transport = await LifxTransport.create()
+light = AsyncLight(transport, mac_address="d0:73:d5:00:00:01", ip_address="192.168.1.10")
+await light.get_color()
+"""
+
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple, Type, Union, cast
+import asyncio
+import dataclasses
+import functools
+import random
+import time
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("lifx_protocol")
+# -----------------------------------------------------------------------------
+
+from lifxlan.errors import WorkflowException
+from lifxlan.message import Message
+from lifxlan.msgtypes import (
+    Acknowledgement,
+    LightGet,
+    LightGetPower,
+    LightSetColor,
+    LightSetPower,
+    LightSetWaveform,
+    LightState,
+    LightStatePower,
+)
+from lifxlan.unpack import unpack_lifx_message
+
+from . import metrics
+from .scheduler import CommandPriority, CommandSuperseded, PacketScheduler, default_scheduler
+
+Color = Tuple[int, int, int, int]
+Address = Tuple[str, int]
+
+LIFX_PORT: int = 56700
+DEFAULT_TIMEOUT_SECONDS: float = 1.0
+
+# Offsets into the 36 byte LIFX header.
+TARGET_OFFSET: int = 8
+SEQUENCE_NUMBER_OFFSET: int = 23
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class RetryPolicy:
+    # Retransmit when an attempt has had no reply for this long. A bulb on a quiet LAN answers within tens of ms.
+    attempt_timeout_seconds: float = 0.3
+    max_attempts: int = 3
+
+    initial_backoff_seconds: float = 0.05
+    max_backoff_seconds: float = 0.4
+    backoff_multiplier: float = 2.0
+
+    # Each delay is scaled by a random factor in [1 - jitter, 1 + jitter] so that sessions that lost packets in the
+    # same burst do not retransmit in lockstep.
+    jitter: float = 0.5
+
+    def backoff_seconds(self, retry: int) -> float:
+        delay: float = min(
+            self.initial_backoff_seconds * self.backoff_multiplier ** (retry - 1), self.max_backoff_seconds
+        )
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+DEFAULT_RETRY_POLICY: RetryPolicy = RetryPolicy()
+
+
+class RetryBudget:
+    """
+    Token bucket that caps retries at a fraction of the requests sent to one bulb.
+
+    Every request deposits ratio tokens and every retry withdraws one, up to max_balance. A bulb that stops answering
+    therefore gets at most max_balance retries in a burst and then about one retry per 1 / ratio requests.
+    """
+
+    ratio: float
+    max_balance: float
+    balance: float
+
+    def __init__(self, ratio: float = 0.2, max_balance: float = 10.0) -> None:
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self.balance = max_balance
+
+    def record_request(self) -> None:
+        self.balance = min(self.balance + self.ratio, self.max_balance)
+
+    def can_retry(self) -> bool:
+        return self.balance >= 1.0
+
+    def withdraw(self) -> None:
+        self.balance -= 1.0
+
+
+@functools.lru_cache(maxsize=None)
+def mac_address_bytes(mac_address: str) -> bytes:
+    return bytes.fromhex(mac_address.replace(":", ""))
+
+
+@functools.lru_cache(maxsize=None)
+def request_rtt_ms(message_type: Type[Message]) -> metrics.Histogram:
+    # Resolve the labelled histogram once per message type so that recording an RTT is a single observe().
+    return metrics.REQUEST_RTT_MS.labels(message=message_type.__name__)
+
+
+class LifxTransport(asyncio.DatagramProtocol):
+    """One UDP socket shared by every bulb that the engine talks to."""
+
+    _transport: Optional[asyncio.DatagramTransport]
+    _source_id: int
+    _sequence_numbers: Dict[str, int]
+    _pending: Dict[Tuple[str, int], Tuple[Type[Message], "asyncio.Future[Message]"]]
+    _retry_budgets: Dict[str, RetryBudget]
+    retry_policy: RetryPolicy
+    scheduler: PacketScheduler
+
+    def __init__(
+        self, retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY, scheduler: Optional[PacketScheduler] = None
+    ) -> None:
+        self._transport = None
+        self._source_id = random.randrange(2, 1 << 32)
+        self._sequence_numbers = {}
+        self._pending = {}
+        self._retry_budgets = {}
+        self.retry_policy = retry_policy
+        self.scheduler = scheduler if scheduler is not None else default_scheduler()
+
+    @classmethod
+    async def create(
+        cls,
+        local_address: Address = ("0.0.0.0", 0),
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+        scheduler: Optional[PacketScheduler] = None,
+    ) -> "LifxTransport":
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda: cls(retry_policy, scheduler), local_addr=local_address, allow_broadcast=True
+        )
+        return protocol
+
+    @property
+    def source_id(self) -> int:
+        return self._source_id
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        # create_datagram_endpoint always hands over a datagram transport, but before Python 3.12 its class does not
+        # derive from asyncio.DatagramTransport, so an isinstance check would reject it.
+        self._transport = cast(asyncio.DatagramTransport, transport)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        for (_, future) in self._pending.values():
+            if not future.done():
+                future.set_exception(WorkflowException("WorkflowException: transport closed"))
+        self._pending.clear()
+        self._transport = None
+
+    def error_received(self, exc: Exception) -> None:
+        logger.warning(f"error_received: {exc}")
+
+    def datagram_received(self, data: bytes, address: Address) -> None:
+        try:
+            message: Message = unpack_lifx_message(data)
+        except Exception:
+            logger.debug("ignoring malformed datagram from %s", address)
+            return
+        if message.source_id != self._source_id:
+            return
+        key: Tuple[str, int] = (message.target_addr, message.seq_num)
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        response_type, future = pending
+        if type(message) is not response_type:
+            return
+        del self._pending[key]
+        if not future.done():
+            future.set_result(message)
+
+    def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+
+    def retry_budget(self, mac_address: str) -> RetryBudget:
+        budget: Optional[RetryBudget] = self._retry_budgets.get(mac_address)
+        if budget is None:
+            budget = self._retry_budgets[mac_address] = RetryBudget()
+        return budget
+
+    async def acquire_all(self, targets: Sequence[Tuple[str, Address]]) -> None:
+        """Wait until a packet may be sent to every target, so that a burst to a group still leaves as one."""
+        waiting: List[str] = [
+            mac_address
+            for (mac_address, _) in targets
+            if not self.scheduler.bucket(mac_address).try_take(CommandPriority.BREATHING)
+        ]
+        if waiting:
+            await asyncio.gather(*(self.scheduler.acquire(mac_address) for mac_address in waiting))
+
+    def _next_sequence_number(self, mac_address: str) -> int:
+        sequence_number: int = (self._sequence_numbers.get(mac_address, -1) + 1) % 256
+        self._sequence_numbers[mac_address] = sequence_number
+        return sequence_number
+
+    def send(
+        self,
+        mac_address: str,
+        address: Address,
+        message_type: Type[Message],
+        payload: Dict[str, Any],
+        ack_requested: bool = False,
+        response_requested: bool = False,
+    ) -> int:
+        if self._transport is None:
+            raise WorkflowException("WorkflowException: transport is not connected")
+        sequence_number: int = self._next_sequence_number(mac_address)
+        message: Message = message_type(
+            mac_address,
+            self._source_id,
+            sequence_number,
+            payload,
+            ack_requested=ack_requested,
+            response_requested=response_requested,
+        )
+        self._transport.sendto(message.packed_message, address)
+        return sequence_number
+
+    def send_many(
+        self,
+        targets: Sequence[Tuple[str, Address]],
+        message_type: Type[Message],
+        payload: Dict[str, Any],
+        ack_requested: bool = False,
+        response_requested: bool = False,
+    ) -> List[int]:
+        """
+        Send the same message to many bulbs in one burst.
+
+        The message is packed once and only the target MAC address and sequence number are patched for each bulb, so
+        the cost per extra bulb is a header copy and a sendto.
+        """
+        if self._transport is None:
+            raise WorkflowException("WorkflowException: transport is not connected")
+        if not targets:
+            return []
+        packed: bytearray = bytearray(
+            message_type(
+                targets[0][0],
+                self._source_id,
+                0,
+                payload,
+                ack_requested=ack_requested,
+                response_requested=response_requested,
+            ).packed_message
+        )
+        sequence_numbers: List[int] = []
+        for (mac_address, address) in targets:
+            sequence_number: int = self._next_sequence_number(mac_address)
+            packed[TARGET_OFFSET : TARGET_OFFSET + 6] = mac_address_bytes(mac_address)
+            packed[SEQUENCE_NUMBER_OFFSET] = sequence_number
+            self._transport.sendto(bytes(packed), address)
+            sequence_numbers.append(sequence_number)
+        return sequence_numbers
+
+    async def _wait_for_response(
+        self,
+        key: Tuple[str, int],
+        future: "asyncio.Future[Message]",
+        message_type: Type[Message],
+        response_type: Type[Message],
+        timeout_seconds: float,
+        sent_at: float,
+    ) -> Message:
+        try:
+            response: Message = await asyncio.wait_for(future, timeout_seconds)
+            request_rtt_ms(message_type).observe((time.perf_counter() - sent_at) * 1000)
+            return response
+        except asyncio.TimeoutError:
+            metrics.REQUEST_TIMEOUTS.labels(message=message_type.__name__).inc()
+            raise WorkflowException(
+                f"WorkflowException: Did not receive {response_type.__name__} from {key[0]} "
+                f"in response to {message_type.__name__}"
+            )
+        finally:
+            if self._pending.get(key, (None, None))[1] is future:
+                del self._pending[key]
+
+    async def request(
+        self,
+        mac_address: str,
+        address: Address,
+        message_type: Type[Message],
+        response_type: Type[Message],
+        payload: Dict[str, Any],
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+        coalesce_key: Optional[Hashable] = None,
+    ) -> Message:
+        """
+        Send a message and wait for its Acknowledgement or State reply, retransmitting it until timeout_seconds.
+
+        Between attempts the request keeps listening, so a slow reply to an earlier attempt still completes it. The
+        round-trip time is only recorded for requests answered on their first attempt, because a reply to a
+        retransmitted request cannot be matched to the attempt that caused it. timeout_seconds runs from the first
+        send, not from when the request started waiting for the bulb's packet budget. With a coalesce_key, a newer
+        request with the same key for the bulb may replace this one before it is first sent, and this one raises
+        CommandSuperseded.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        future: "asyncio.Future[Message]" = loop.create_future()
+        policy: RetryPolicy = self.retry_policy
+        budget: RetryBudget = self.retry_budget(mac_address)
+        is_ack: bool = response_type is Acknowledgement
+        sent_at: float = 0.0
+        deadline: float = 0.0
+        keys: List[Tuple[str, int]] = []
+        budget.record_request()
+        try:
+            while True:
+                # A retransmission repeats a command that was already sent, so it is never coalesced away.
+                if not await self.scheduler.acquire(
+                    mac_address, CommandPriority.BREATHING, coalesce_key if not keys else None
+                ):
+                    raise CommandSuperseded(
+                        f"{message_type.__name__} to {mac_address} was replaced before it was sent"
+                    )
+                if not keys:
+                    sent_at = time.perf_counter()
+                    deadline = sent_at + timeout_seconds
+                sequence_number: int = self.send(
+                    mac_address, address, message_type, payload, ack_requested=is_ack, response_requested=not is_ack
+                )
+                key: Tuple[str, int] = (mac_address, sequence_number)
+                keys.append(key)
+                self._pending[key] = (response_type, future)
+
+                may_retry: bool = len(keys) < policy.max_attempts and budget.can_retry()
+                remaining: float = deadline - time.perf_counter()
+                attempt_timeout: float = min(policy.attempt_timeout_seconds, remaining) if may_retry else remaining
+                await asyncio.wait([future], timeout=attempt_timeout)
+                if not future.done() and may_retry:
+                    # Back off before retransmitting, still listening for a late reply to the attempts so far.
+                    backoff: float = min(policy.backoff_seconds(len(keys)), deadline - time.perf_counter())
+                    await asyncio.wait([future], timeout=backoff)
+                if future.done():
+                    break
+                if not may_retry or time.perf_counter() >= deadline:
+                    metrics.REQUEST_TIMEOUTS.labels(message=message_type.__name__).inc()
+                    if not budget.can_retry():
+                        metrics.RETRY_BUDGET_EXHAUSTED.inc()
+                    raise WorkflowException(
+                        f"WorkflowException: Did not receive {response_type.__name__} from {mac_address} "
+                        f"in response to {message_type.__name__} after {len(keys)} attempts"
+                    )
+                budget.withdraw()
+                metrics.REQUEST_RETRIES.labels(message=message_type.__name__).inc()
+            response: Message = future.result()
+            if len(keys) == 1:
+                request_rtt_ms(message_type).observe((time.perf_counter() - sent_at) * 1000)
+            return response
+        finally:
+            for key in keys:
+                if self._pending.get(key, (None, None))[1] is future:
+                    del self._pending[key]
+            if not future.done():
+                future.cancel()
+
+    async def request_many(
+        self,
+        targets: Sequence[Tuple[str, Address]],
+        message_type: Type[Message],
+        response_type: Type[Message],
+        payload: Dict[str, Any],
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+    ) -> List[Union[Message, BaseException]]:
+        """Send one burst with send_many and wait for every reply, returning a Message or exception per target."""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        is_ack: bool = response_type is Acknowledgement
+        await self.acquire_all(targets)
+        sent_at: float = time.perf_counter()
+        sequence_numbers: List[int] = self.send_many(
+            targets, message_type, payload, ack_requested=is_ack, response_requested=not is_ack
+        )
+        waiters: List[Any] = []
+        for ((mac_address, _), sequence_number) in zip(targets, sequence_numbers):
+            future: "asyncio.Future[Message]" = loop.create_future()
+            key: Tuple[str, int] = (mac_address, sequence_number)
+            self._pending[key] = (response_type, future)
+            waiters.append(
+                self._wait_for_response(key, future, message_type, response_type, timeout_seconds, sent_at)
+            )
+        return list(await asyncio.gather(*waiters, return_exceptions=True))
+
+
+class AsyncLight:
+    """
+    Asynchronous counterpart of lifxlan.Light for the calls the breathing cycle needs.
+
+    Method names and arguments mirror lifxlan.Light so that the breathing code reads the same either way.
+    """
+
+    _transport: LifxTransport
+    mac_address: str
+    ip_address: str
+    port: int
+
+    def __init__(self, transport: LifxTransport, mac_address: str, ip_address: str, port: int = LIFX_PORT) -> None:
+        self._transport = transport
+        self.mac_address = mac_address.lower()
+        self.ip_address = ip_address
+        self.port = port
+
+    def __repr__(self) -> str:
+        return f"AsyncLight(mac_address={self.mac_address!r}, ip_address={self.ip_address!r}, port={self.port})"
+
+    @property
+    def address(self) -> Address:
+        return (self.ip_address, self.port)
+
+    async def _set(
+        self, message_type: Type[Message], payload: Dict[str, Any], rapid: bool, coalesce_key: Optional[Hashable]
+    ) -> None:
+        # A newer set with the same coalesce_key replaces this one if both are waiting for the bulb's packet budget.
+        if rapid:
+            if await self._transport.scheduler.acquire(self.mac_address, coalesce_key=coalesce_key):
+                self._transport.send(self.mac_address, self.address, message_type, payload)
+            return
+        try:
+            await self._transport.request(
+                self.mac_address, self.address, message_type, Acknowledgement, payload, coalesce_key=coalesce_key
+            )
+        except CommandSuperseded:
+            logger.debug("%s to %s was replaced before it was sent", message_type.__name__, self.mac_address)
+
+    async def get_color(self) -> Color:
+        response: Message = await self._transport.request(self.mac_address, self.address, LightGet, LightState, {})
+        return tuple(response.color)  # type: ignore
+
+    async def get_power(self) -> int:
+        response: Message = await self._transport.request(
+            self.mac_address, self.address, LightGetPower, LightStatePower, {}
+        )
+        return int(response.power_level)
+
+    async def set_color(self, color: Color, duration: int = 0, rapid: bool = False) -> None:
+        await self._set(LightSetColor, {"color": color, "duration": duration}, rapid, LightSetColor)
+
+    async def set_power(self, power: Any, duration: int = 0, rapid: bool = False) -> None:
+        power_level: int = 65535 if power in [True, 1, "on", 65535] else 0
+        # Never coalesced: a flash's power-on would otherwise replace its power-off, and the flash would not happen.
+        await self._set(LightSetPower, {"power_level": power_level, "duration": duration}, rapid, None)
+
+    async def set_waveform(
+        self,
+        is_transient: int,
+        color: Color,
+        period: int,
+        cycles: float,
+        duty_cycle: int,
+        waveform: int,
+        rapid: bool = False,
+    ) -> None:
+        payload: Dict[str, Any] = {
+            "transient": is_transient,
+            "color": color,
+            "period": period,
+            "cycles": cycles,
+            "duty_cycle": duty_cycle,
+            "waveform": waveform,
+        }
+        # A transient cue and a fade to the next phase are different commands, so neither may replace the other.
+        await self._set(LightSetWaveform, payload, rapid, (LightSetWaveform, bool(is_transient)))
+
+
+class AsyncLightGroup:
+    """
+    Several AsyncLights driven as one: every command goes out to all members in a single send_many burst.
+
+    A member that does not acknowledge is logged and skipped rather than failing the whole group.
+    """
+
+    _transport: LifxTransport
+    lights: Sequence[AsyncLight]
+    _targets: List[Tuple[str, Address]]
+
+    def __init__(self, transport: LifxTransport, lights: Sequence[AsyncLight]) -> None:
+        self._transport = transport
+        self.lights = lights
+        self._targets = [(light.mac_address, light.address) for light in lights]
+
+    def __repr__(self) -> str:
+        return f"AsyncLightGroup({[light.mac_address for light in self.lights]})"
+
+    async def _set(self, message_type: Type[Message], payload: Dict[str, Any], rapid: bool) -> None:
+        if rapid:
+            await self._transport.acquire_all(self._targets)
+            self._transport.send_many(self._targets, message_type, payload)
+            return
+        results: List[Union[Message, BaseException]] = await self._transport.request_many(
+            self._targets, message_type, Acknowledgement, payload
+        )
+        for ((mac_address, _), result) in zip(self._targets, results):
+            if isinstance(result, BaseException):
+                logger.warning("%s did not acknowledge %s: %s", mac_address, message_type.__name__, result)
+
+    async def set_color(self, color: Color, duration: int = 0, rapid: bool = False) -> None:
+        await self._set(LightSetColor, {"color": color, "duration": duration}, rapid)
+
+    async def set_power(self, power: Any, duration: int = 0, rapid: bool = False) -> None:
+        power_level: int = 65535 if power in [True, 1, "on", 65535] else 0
+        await self._set(LightSetPower, {"power_level": power_level, "duration": duration}, rapid)
+
+    async def set_waveform(
+        self,
+        is_transient: int,
+        color: Color,
+        period: int,
+        cycles: float,
+        duty_cycle: int,
+        waveform: int,
+        rapid: bool = False,
+    ) -> None:
+        payload: Dict[str, Any] = {
+            "transient": is_transient,
+            "color": color,
+            "period": period,
+            "cycles": cycles,
+            "duty_cycle": duty_cycle,
+            "waveform": waveform,
+        }
+        await self._set(LightSetWaveform, payload, rapid)
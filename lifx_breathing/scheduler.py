@@ -0,0 +1,226 @@
+"""
+Per-bulb packet budget shared by breathing sessions and discovery.
+
+A LIFX bulb starts dropping packets above about 20 messages a second, and breathing, rediscovery and user actions all
+talk to the same bulbs. Every packet the engine sends to a bulb, and every description discovery asks of one, first
+takes a token from that bulb's TokenBucket in the process-wide PacketScheduler. A bucket refills at
+RATE_PER_SECOND up to CAPACITY, so short bursts such as a session restoring a bulb go out at once.
+
+Commands that have to wait are served one priority level at a time and first come, first served within a level.
+Breathing packets come first. Discovery only takes a token while the bucket holds more than DISCOVERY_RESERVE, so a
+refresh can never use up the tokens the next breathing phase needs. A command that is still waiting when a newer
+command with the same coalesce key arrives for the same bulb is dropped, and the newer one takes its place in line:
+the bulb would have been told to go straight somewhere else anyway. The key names the command's intent, such as a set
+colour or a transient waveform, so only commands that really supersede each other share one; power commands have none,
+because the two halves of a flash must both go out.
+
+Sessions await acquire() on the event loop; discovery threads call acquire_blocking().
+
+from lifx_breathing.scheduler import CommandPriority, default_scheduler
+if await default_scheduler().acquire(mac_address, CommandPriority.BREATHING, coalesce_key=LightSetColor):
+    transport.send(...)
+"""
+
+from typing import Any, Dict, Hashable, List, Optional
+import asyncio
+import enum
+import heapq
+import threading
+import time
+
+from . import metrics
+
+RATE_PER_SECOND: float = 20.0
+CAPACITY: float = 10.0
+DISCOVERY_RESERVE: float = 5.0
+
+# Never sleep for less than this while waiting for a token, so waiters that lose the race do not spin.
+MIN_WAIT_SECONDS: float = 0.001
+
+
+class CommandPriority(enum.IntEnum):
+    BREATHING = 0
+    DISCOVERY = 1
+
+
+class CommandSuperseded(Exception):
+    """A command was dropped before it was sent because a newer command of the same kind replaced it."""
+
+
+class _Waiter:
+    __slots__ = ("entry", "superseded", "served")
+
+    # The waiter's [priority, ticket, waiter] heap entry, which a newer command with the same coalesce key inherits.
+    entry: List[Any]
+    superseded: bool
+    served: bool
+
+    def __init__(self) -> None:
+        self.superseded = False
+        self.served = False
+
+
+class TokenBucket:
+    """The packet budget of one bulb and the commands waiting on it."""
+
+    rate_per_second: float
+    capacity: float
+    tokens: float
+    _updated_at: float
+    _lock: threading.Lock
+
+    # Heap of [priority, ticket, waiter] entries, one per command that is waiting for a token.
+    _waiting: List[List[Any]]
+    _next_ticket: int
+
+    # The waiting command for each coalesce key.
+    _coalescing: Dict[Hashable, _Waiter]
+
+    def __init__(self, rate_per_second: float = RATE_PER_SECOND, capacity: float = CAPACITY) -> None:
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._next_ticket = 0
+        self._coalescing = {}
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.tokens + (now - self._updated_at) * self.rate_per_second, self.capacity)
+        self._updated_at = now
+
+    def _seconds_until(self, priority: CommandPriority, now: float) -> float:
+        """0 after taking a token for a command of priority, otherwise how long until one might be free for it."""
+        self._refill(now)
+        needed: float = 1.0 + (DISCOVERY_RESERVE if priority is CommandPriority.DISCOVERY else 0.0)
+        if self.tokens >= needed:
+            self.tokens -= 1.0
+            return 0.0
+        return max((needed - self.tokens) / self.rate_per_second, MIN_WAIT_SECONDS)
+
+    def try_take(self, priority: CommandPriority) -> bool:
+        """The fast path: take a token at once if nothing is waiting for one."""
+        with self._lock:
+            return not self._waiting and self._seconds_until(priority, time.monotonic()) == 0.0
+
+    def enqueue(self, priority: CommandPriority, coalesce_key: Optional[Hashable]) -> _Waiter:
+        waiter: _Waiter = _Waiter()
+        with self._lock:
+            replaced: Optional[_Waiter] = self._coalescing.get(coalesce_key) if coalesce_key is not None else None
+            if replaced is not None:
+                replaced.superseded = True
+                waiter.entry = replaced.entry
+                waiter.entry[2] = waiter
+            else:
+                waiter.entry = [priority, self._next_ticket, waiter]
+                self._next_ticket += 1
+                heapq.heappush(self._waiting, waiter.entry)
+            if coalesce_key is not None:
+                self._coalescing[coalesce_key] = waiter
+        return waiter
+
+    def poll(self, waiter: _Waiter, coalesce_key: Optional[Hashable]) -> float:
+        """0 once waiter has its token, -1 if it was superseded, otherwise how long to sleep before polling again."""
+        with self._lock:
+            if waiter.superseded:
+                return -1.0
+            now: float = time.monotonic()
+            if self._waiting[0] is not waiter.entry:
+                self._refill(now)
+                return max((1.0 - self.tokens) / self.rate_per_second, MIN_WAIT_SECONDS)
+            delay: float = self._seconds_until(waiter.entry[0], now)
+            if delay == 0.0:
+                self._leave(waiter, coalesce_key)
+            return delay
+
+    def cancel(self, waiter: _Waiter, coalesce_key: Optional[Hashable]) -> None:
+        with self._lock:
+            if not waiter.superseded and not waiter.served:
+                self._leave(waiter, coalesce_key)
+
+    def _leave(self, waiter: _Waiter, coalesce_key: Optional[Hashable]) -> None:
+        waiter.served = True
+        self._waiting.remove(waiter.entry)
+        heapq.heapify(self._waiting)
+        if coalesce_key is not None and self._coalescing.get(coalesce_key) is waiter:
+            del self._coalescing[coalesce_key]
+
+
+class PacketScheduler:
+    """A TokenBucket per bulb MAC address."""
+
+    rate_per_second: float
+    capacity: float
+    _buckets: Dict[str, TokenBucket]
+    _lock: threading.Lock
+
+    def __init__(self, rate_per_second: float = RATE_PER_SECOND, capacity: float = CAPACITY) -> None:
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, mac_address: str) -> TokenBucket:
+        bucket: Optional[TokenBucket] = self._buckets.get(mac_address)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(mac_address, TokenBucket(self.rate_per_second, self.capacity))
+        return bucket
+
+    async def acquire(
+        self,
+        mac_address: str,
+        priority: CommandPriority = CommandPriority.BREATHING,
+        coalesce_key: Optional[Hashable] = None,
+    ) -> bool:
+        """
+        Wait until a packet may be sent to the bulb. Returns False, without taking a token, if a newer command with
+        the same coalesce_key replaced this one while it waited.
+        """
+        bucket: TokenBucket = self.bucket(mac_address)
+        if bucket.try_take(priority):
+            return True
+        metrics.COMMANDS_THROTTLED.labels(priority=priority.name.lower()).inc()
+        waiter: _Waiter = bucket.enqueue(priority, coalesce_key)
+        try:
+            while True:
+                delay: float = bucket.poll(waiter, coalesce_key)
+                if delay == 0.0:
+                    return True
+                if delay < 0.0:
+                    metrics.COMMANDS_COALESCED.inc()
+                    return False
+                await asyncio.sleep(delay)
+        finally:
+            bucket.cancel(waiter, coalesce_key)
+
+    def acquire_blocking(self, mac_address: str, priority: CommandPriority = CommandPriority.DISCOVERY) -> None:
+        """acquire() for threads, without coalescing."""
+        bucket: TokenBucket = self.bucket(mac_address)
+        if bucket.try_take(priority):
+            return
+        metrics.COMMANDS_THROTTLED.labels(priority=priority.name.lower()).inc()
+        waiter: _Waiter = bucket.enqueue(priority, None)
+        try:
+            while True:
+                delay: float = bucket.poll(waiter, None)
+                if delay == 0.0:
+                    return
+                time.sleep(delay)
+        finally:
+            bucket.cancel(waiter, None)
+
+
+_default_scheduler: Optional[PacketScheduler] = None
+_default_scheduler_lock: threading.Lock = threading.Lock()
+
+
+def default_scheduler() -> PacketScheduler:
+    """The process's shared scheduler, so that the engine's sessions and discovery draw from the same budgets."""
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = PacketScheduler()
+    return _default_scheduler
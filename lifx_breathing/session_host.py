@@ -0,0 +1,574 @@
+"""
+Multi-process session host.
+
+A BreathingEngine runs every session on one event loop in one interpreter, so with hundreds of lights the GIL starts
+to show up as phase timing error. A ShardedSessionHost runs a fixed pool of worker processes instead, one per core by
+default. Each worker has its own BreathingEngine and UDP socket, and sessions are assigned to workers by consistent
+hashing on the light's MAC address.
+
+The host has the same start, stop and status methods as BreathingEngine, so flask_app and the JSON API drive the whole
+pool through one object. Live status updates from the workers' sessions are merged in each worker and forwarded with
+its state pushes. Commands go to the owning worker over a pipe. Workers push their session states back
+whenever those change, so status queries never leave the web process. When a worker dies, a replacement joins the ring
+and the dead worker's sessions are restarted wherever the ring now puts them. Sessions on the other workers are not
+touched.
+
+from lifx_breathing.session_host import ShardedSessionHost
+host = ShardedSessionHost(worker_count=4)
+host.start(light, inhale_duration_ms=5000, exhale_duration_ms=5000)
+host.session_state(light)
+host.stop_nowait(light)
+host.close()
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+import bisect
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("session_host")
+# -----------------------------------------------------------------------------
+
+from . import metrics
+from .engine import BreathingEngine
+from .journal import SessionJournal, SessionSpec
+from .latency import LatencyStore
+from .lifx import (
+    BreathingMode,
+    DEFAULT_BREATHING_MODE,
+    DEFAULT_TRANSITION_CUE,
+    OriginalState,
+    TransitionCue,
+)
+from .lifx_manager import LifxLightWrapper
+from .pid import PidGains
+from .profiles import BreathingProfile
+from .protocol import LIFX_PORT
+from .status_stream import StatusUpdates
+from .trace import TraceRecorder
+from .tuning import GainStore
+from .supervisor import ACTIVE_SESSION_STATES, DEFAULT_RESTART_POLICY, RestartPolicy, SessionState
+
+# Workers push a snapshot of their session states at most this often, and at least this often while they change.
+STATE_PUSH_INTERVAL_SECONDS: float = 0.2
+WORKER_JOIN_TIMEOUT_SECONDS: float = 10.0
+
+
+class HashRing:
+    """Consistent hash ring over worker ids. Removing a worker only moves the keys that worker owned."""
+
+    # Virtual nodes per worker, so that a handful of workers still split the MAC address space evenly.
+    REPLICAS: int = 64
+
+    _points: List[int]
+    _owners: List[int]
+
+    def __init__(self, worker_ids: Iterable[int] = ()) -> None:
+        self._points = []
+        self._owners = []
+        for worker_id in worker_ids:
+            self.add(worker_id)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    @property
+    def worker_ids(self) -> Set[int]:
+        return set(self._owners)
+
+    def add(self, worker_id: int) -> None:
+        for replica in range(self.REPLICAS):
+            point: int = self._hash(f"worker-{worker_id}-{replica}")
+            index: int = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, worker_id)
+
+    def remove(self, worker_id: int) -> None:
+        kept: List[Tuple[int, int]] = [
+            (point, owner) for (point, owner) in zip(self._points, self._owners) if owner != worker_id
+        ]
+        self._points = [point for (point, _) in kept]
+        self._owners = [owner for (_, owner) in kept]
+
+    def owner(self, key: str) -> int:
+        if not self._points:
+            raise LookupError("hash ring has no workers")
+        index: int = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+class WorkerDiedError(Exception):
+    pass
+
+
+def _worker_main(
+    connection: multiprocessing.connection.Connection,
+    restart_policy: RestartPolicy,
+    port: int,
+    publish_status: bool,
+    record_traces: bool,
+) -> None:
+    """
+    Worker process entry point: run a BreathingEngine and serve commands from the host until told to close.
+
+    Messages to the worker are (kind, request_id, argument) for kind "start" (a SessionSpec and the original states
+    already known for its lights), "stop" (a light) or "close". The worker answers each with ("done", request_id,
+    exception or None, states) once the engine has finished it, and sends ("states", states) whenever its session
+    states change, where states is {light: state value}. It sends ("original_state", spec, mac_address, state) as soon
+    as a session has read a light's original state, so that the host can hand it on if the worker dies. With
+    publish_status it also sends ("status", updates) with the live status updates merged since the last push. With
+    record_traces it records phase traces to a trace file of its own.
+    """
+    status: Optional[StatusUpdates] = StatusUpdates() if publish_status else None
+    trace_recorder: Optional[TraceRecorder] = TraceRecorder() if record_traces else None
+    engine: BreathingEngine = BreathingEngine(
+        restart_policy, LatencyStore(), port, status=status, trace_recorder=trace_recorder, gain_store=GainStore()
+    )
+    send_lock: threading.Lock = threading.Lock()
+
+    def send(message: Tuple[Any, ...]) -> None:
+        with send_lock:
+            connection.send(message)
+
+    def session_states() -> Dict[LifxLightWrapper, str]:
+        return {light: state.value for (light, state) in engine.session_states().items()}
+
+    def reply(request_id: int, future: "concurrent.futures.Future[None]") -> None:
+        send(("done", request_id, future.exception(), session_states()))
+
+    def start(spec: SessionSpec, original_states: Dict[str, OriginalState]) -> "concurrent.futures.Future[None]":
+        def on_original_state(mac_address: str, original_state: OriginalState) -> None:
+            try:
+                send(("original_state", spec, mac_address, original_state))
+            except (OSError, ValueError):
+                # The host is gone; the command loop notices and closes the worker.
+                pass
+
+        return engine.start_spec_nowait(spec, original_states, on_original_state)
+
+    last_states: Optional[Dict[LifxLightWrapper, str]] = None
+    close_request_id: Optional[int] = None
+    try:
+        while close_request_id is None:
+            if connection.poll(STATE_PUSH_INTERVAL_SECONDS):
+                (kind, request_id, argument) = connection.recv()
+                if kind == "close":
+                    close_request_id = request_id
+                    continue
+                try:
+                    future: "concurrent.futures.Future[None]" = (
+                        start(*argument) if kind == "start" else engine.stop_nowait(argument)
+                    )
+                except Exception as e:
+                    send(("done", request_id, e, session_states()))
+                    continue
+                future.add_done_callback(functools.partial(reply, request_id))
+            states: Dict[LifxLightWrapper, str] = session_states()
+            if states != last_states:
+                send(("states", states))
+                last_states = states
+            updates: Dict[str, Dict[str, Any]] = status.drain() if status is not None else {}
+            if updates:
+                send(("status", updates))
+    except (EOFError, OSError):
+        logger.warning("session host went away, closing worker")
+    finally:
+        engine.close()
+        if trace_recorder is not None:
+            trace_recorder.close()
+    if close_request_id is not None:
+        send(("done", close_request_id, None, {}))
+
+
+class _Worker:
+    worker_id: int
+    process: multiprocessing.process.BaseProcess
+    connection: multiprocessing.connection.Connection
+    send_lock: threading.Lock
+
+    # The latest state snapshot from the worker, plus the state each light will be in once the worker has finished the
+    # command that was sent for it, so that a light reads as starting or stopping as soon as it has been asked to.
+    states: Dict[LifxLightWrapper, SessionState]
+    expected_states: Dict[LifxLightWrapper, Tuple[int, SessionState]]
+
+    def __init__(
+        self,
+        worker_id: int,
+        process: multiprocessing.process.BaseProcess,
+        connection: multiprocessing.connection.Connection,
+    ) -> None:
+        self.worker_id = worker_id
+        self.process = process
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.states = {}
+        self.expected_states = {}
+
+    def state(self, light: LifxLightWrapper) -> SessionState:
+        expected: Optional[Tuple[int, SessionState]] = self.expected_states.get(light)
+        if expected is not None:
+            return expected[1]
+        return self.states.get(light, SessionState.STOPPED)
+
+
+class ShardedSessionHost:
+    _context: Any
+    _restart_policy: RestartPolicy
+    _port: int
+    _status: Optional[StatusUpdates]
+    _record_traces: bool
+    _lock: threading.RLock
+    _workers: Dict[int, _Worker]
+    _ring: HashRing
+    _worker_ids: "itertools.count[int]"
+    _request_ids: "itertools.count[int]"
+    _pending: Dict[int, Tuple[int, "concurrent.futures.Future[None]"]]
+    _closing: bool
+
+    # The session each light belongs to and the worker running it. A group's members share one spec.
+    _specs: Dict[LifxLightWrapper, SessionSpec]
+    _placement: Dict[SessionSpec, int]
+
+    # The original state of each light of a session, keyed by MAC address, as its worker first read it. A session
+    # moved off a dead worker restores these rather than the mid-breath colour its lights were left in.
+    _original_states: Dict[SessionSpec, Dict[str, OriginalState]]
+
+    def __init__(
+        self,
+        worker_count: Optional[int] = None,
+        restart_policy: RestartPolicy = DEFAULT_RESTART_POLICY,
+        port: int = LIFX_PORT,
+        status: Optional[StatusUpdates] = None,
+        record_traces: bool = False,
+    ) -> None:
+        worker_count = worker_count or os.cpu_count() or 1
+        logger.info(f"__init__ entry: {worker_count} workers")
+        # Spawn rather than fork: the web process already runs threads that a fork would copy in an unknown state.
+        self._context = multiprocessing.get_context("spawn")
+        self._restart_policy = restart_policy
+        self._port = port
+        self._status = status
+        self._record_traces = record_traces
+        self._lock = threading.RLock()
+        self._workers = {}
+        self._ring = HashRing()
+        self._worker_ids = itertools.count()
+        self._request_ids = itertools.count()
+        self._pending = {}
+        self._closing = False
+        self._specs = {}
+        self._placement = {}
+        self._original_states = {}
+        for _ in range(worker_count):
+            self._spawn_worker()
+        self._monitor = threading.Thread(target=self._monitor_workers, name="session-host", daemon=True)
+        self._monitor.start()
+        metrics.ACTIVE_SESSIONS.set_function(self._active_session_count)
+
+    @property
+    def worker_pids(self) -> Dict[int, Optional[int]]:
+        with self._lock:
+            return {worker_id: worker.process.pid for (worker_id, worker) in self._workers.items()}
+
+    def worker_for(self, light: LifxLightWrapper) -> Optional[int]:
+        """The worker running light's session, if it has one."""
+        with self._lock:
+            spec: Optional[SessionSpec] = self._specs.get(light)
+            return self._placement.get(spec) if spec is not None else None
+
+    def start(
+        self,
+        light: LifxLightWrapper,
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        mode: BreathingMode = DEFAULT_BREATHING_MODE,
+        gains: Optional[PidGains] = None,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> None:
+        self.start_nowait(light, inhale_duration_ms, exhale_duration_ms, mode, gains, profile, cue).result()
+
+    def start_nowait(
+        self,
+        light: LifxLightWrapper,
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        mode: BreathingMode = DEFAULT_BREATHING_MODE,
+        gains: Optional[PidGains] = None,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> "concurrent.futures.Future[None]":
+        logger.info(f"start entry: {light}, mode: {mode.value}, profile: {profile.name if profile else None}")
+        if profile is not None and mode is not BreathingMode.SCHEDULED:
+            raise ValueError("breathing profiles need scheduled mode")
+        return self._start_spec(
+            SessionSpec((light,), inhale_duration_ms, exhale_duration_ms, mode, gains, profile, cue)
+        )
+
+    def start_group(
+        self,
+        lights: Sequence[LifxLightWrapper],
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> None:
+        self.start_group_nowait(lights, inhale_duration_ms, exhale_duration_ms, profile, cue).result()
+
+    def start_group_nowait(
+        self,
+        lights: Sequence[LifxLightWrapper],
+        inhale_duration_ms: int,
+        exhale_duration_ms: int,
+        profile: Optional[BreathingProfile] = None,
+        cue: TransitionCue = DEFAULT_TRANSITION_CUE,
+    ) -> "concurrent.futures.Future[None]":
+        logger.info(f"start_group entry: {list(lights)}, profile: {profile.name if profile else None}")
+        return self._start_spec(
+            SessionSpec(
+                tuple(lights),
+                inhale_duration_ms,
+                exhale_duration_ms,
+                BreathingMode.SCHEDULED,
+                profile=profile,
+                cue=cue,
+                group=True,
+            )
+        )
+
+    def stop(self, light: LifxLightWrapper) -> None:
+        self.stop_nowait(light).result()
+
+    def stop_nowait(self, light: LifxLightWrapper) -> "concurrent.futures.Future[None]":
+        logger.info(f"stop entry: {light}")
+        with self._lock:
+            spec: Optional[SessionSpec] = self._specs.get(light)
+            if spec is None:
+                future: "concurrent.futures.Future[None]" = concurrent.futures.Future()
+                future.set_result(None)
+                return future
+            return self._stop_spec(spec, light)
+
+    def is_running(self, light: LifxLightWrapper) -> bool:
+        return self.session_state(light) in ACTIVE_SESSION_STATES
+
+    def session_state(self, light: LifxLightWrapper) -> SessionState:
+        with self._lock:
+            workers: List[_Worker] = list(self._workers.values())
+        for worker in workers:
+            state: SessionState = worker.state(light)
+            if state is not SessionState.STOPPED:
+                return state
+        return SessionState.STOPPED
+
+    @property
+    def running_lights(self) -> List[LifxLightWrapper]:
+        with self._lock:
+            workers: List[_Worker] = list(self._workers.values())
+        lights: Set[LifxLightWrapper] = set()
+        for worker in workers:
+            lights.update(worker.states)
+            lights.update(worker.expected_states)
+        return [light for light in lights if self.is_running(light)]
+
+    def close(self) -> None:
+        logger.info("close entry")
+        with self._lock:
+            self._closing = True
+            workers: List[_Worker] = list(self._workers.values())
+            futures: List["concurrent.futures.Future[None]"] = [
+                self._send(worker, "close", None) for worker in workers
+            ]
+        concurrent.futures.wait(futures, timeout=WORKER_JOIN_TIMEOUT_SECONDS)
+        for worker in workers:
+            worker.process.join(WORKER_JOIN_TIMEOUT_SECONDS)
+            if worker.process.is_alive():
+                logger.warning(f"worker {worker.worker_id} did not exit, terminating it")
+                worker.process.terminate()
+        self._monitor.join(WORKER_JOIN_TIMEOUT_SECONDS)
+
+    def _active_session_count(self) -> int:
+        with self._lock:
+            return len({spec for (light, spec) in self._specs.items() if self.is_running(light)})
+
+    def _spawn_worker(self) -> _Worker:
+        worker_id: int = next(self._worker_ids)
+        (parent_connection, child_connection) = self._context.Pipe()
+        process: multiprocessing.process.BaseProcess = self._context.Process(
+            target=_worker_main,
+            args=(
+                child_connection,
+                self._restart_policy,
+                self._port,
+                self._status is not None,
+                self._record_traces,
+            ),
+            name=f"breathing-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()
+        worker: _Worker = _Worker(worker_id, process, parent_connection)
+        self._workers[worker_id] = worker
+        self._ring.add(worker_id)
+        logger.info(f"worker {worker_id} started with pid {process.pid}")
+        return worker
+
+    def _send(
+        self,
+        worker: _Worker,
+        kind: str,
+        argument: Any,
+        expected_states: Iterable[Tuple[LifxLightWrapper, SessionState]] = (),
+    ) -> "concurrent.futures.Future[None]":
+        future: "concurrent.futures.Future[None]" = concurrent.futures.Future()
+        request_id: int = next(self._request_ids)
+        self._pending[request_id] = (worker.worker_id, future)
+        for (light, state) in expected_states:
+            worker.expected_states[light] = (request_id, state)
+        try:
+            with worker.send_lock:
+                worker.connection.send((kind, request_id, argument))
+        except (OSError, ValueError) as e:
+            # The monitor thread notices the dead worker and moves its sessions.
+            del self._pending[request_id]
+            future.set_exception(WorkerDiedError(f"worker {worker.worker_id} is not reachable: {e}"))
+        return future
+
+    def _start_spec(self, spec: SessionSpec) -> "concurrent.futures.Future[None]":
+        with self._lock:
+            for light in spec.lights:
+                previous: Optional[SessionSpec] = self._specs.get(light)
+                if previous is not None:
+                    self._stop_spec(previous, light)
+            return self._place(spec)
+
+    def _place(self, spec: SessionSpec) -> "concurrent.futures.Future[None]":
+        worker: _Worker = self._workers[self._ring.owner(spec.shard_key)]
+        for light in spec.lights:
+            self._specs[light] = spec
+        self._placement[spec] = worker.worker_id
+        original_states: Dict[str, OriginalState] = self._original_states.setdefault(spec, {})
+        logger.info(f"placing {list(spec.lights)} on worker {worker.worker_id}")
+        return self._send(
+            worker, "start", (spec, dict(original_states)), ((light, SessionState.STARTING) for light in spec.lights)
+        )
+
+    def _stop_spec(self, spec: SessionSpec, light: LifxLightWrapper) -> "concurrent.futures.Future[None]":
+        # Stopping any member of a group stops the whole group, as in BreathingEngine.
+        for member in spec.lights:
+            if self._specs.get(member) is spec:
+                del self._specs[member]
+        self._original_states.pop(spec, None)
+        worker: _Worker = self._workers[self._placement.pop(spec)]
+        return self._send(worker, "stop", light, ((member, SessionState.STOPPING) for member in spec.lights))
+
+    def _monitor_workers(self) -> None:
+        while True:
+            with self._lock:
+                if self._closing and not self._workers:
+                    return
+                workers: Dict[Any, _Worker] = {}
+                for worker in self._workers.values():
+                    workers[worker.connection] = worker
+                    workers[worker.process.sentinel] = worker
+            for ready in multiprocessing.connection.wait(list(workers), timeout=STATE_PUSH_INTERVAL_SECONDS):
+                worker = workers[ready]
+                if worker.worker_id not in self._workers:
+                    continue
+                if ready is worker.connection:
+                    try:
+                        self._on_message(worker, worker.connection.recv())
+                        continue
+                    except (EOFError, OSError):
+                        pass
+                self._on_worker_exit(worker)
+
+    def _on_message(self, worker: _Worker, message: Tuple[Any, ...]) -> None:
+        with self._lock:
+            if message[0] == "done":
+                (_, request_id, error, states) = message
+                worker.states = {light: SessionState(state) for (light, state) in states.items()}
+                worker.expected_states = {
+                    light: expected for (light, expected) in worker.expected_states.items() if expected[0] != request_id
+                }
+                (_, future) = self._pending.pop(request_id, (None, None))
+                if future is None:
+                    return
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+            elif message[0] == "states":
+                (_, states) = message
+                worker.states = {light: SessionState(state) for (light, state) in states.items()}
+            elif message[0] == "original_state":
+                (_, spec, mac_address, original_state) = message
+                # Only the first read counts: a restarted session on the same worker already reuses it.
+                if spec in self._original_states:
+                    self._original_states[spec].setdefault(mac_address, original_state)
+            elif message[0] == "status" and self._status is not None:
+                (_, updates) = message
+                for (key, fields) in updates.items():
+                    self._status.publish(key, fields)
+
+    def _on_worker_exit(self, worker: _Worker) -> None:
+        with self._lock:
+            # Take in whatever the worker sent before it died, such as the original states its sessions read.
+            try:
+                while worker.connection.poll():
+                    self._on_message(worker, worker.connection.recv())
+            except (EOFError, OSError):
+                pass
+            del self._workers[worker.worker_id]
+            self._ring.remove(worker.worker_id)
+            worker.connection.close()
+            for (request_id, (worker_id, future)) in list(self._pending.items()):
+                if worker_id == worker.worker_id:
+                    del self._pending[request_id]
+                    if self._closing:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(WorkerDiedError(f"worker {worker.worker_id} exited"))
+            if self._closing:
+                return
+            logger.error(f"worker {worker.worker_id} exited with code {worker.process.exitcode}, moving its sessions")
+            self._spawn_worker()
+            for spec in [spec for (spec, worker_id) in self._placement.items() if worker_id == worker.worker_id]:
+                self._place(spec)
+
+
+# Either runs sessions: flask_app and the API only use the start, stop and status methods the two have in common.
+SessionController = Union[BreathingEngine, ShardedSessionHost]
+
+
+def create_session_controller(workers: Optional[str], status: Optional[StatusUpdates] = None) -> SessionController:
+    """
+    An in-process BreathingEngine when workers is empty, otherwise a ShardedSessionHost with that many workers, or one
+    per core for "auto". Only the in-process engine journals its sessions, so only it takes them back after a restart.
+    Either publishes live session status to status, records phase traces under the cache directory and uses the tuned
+    gains saved there.
+    """
+    if not workers:
+        return BreathingEngine(
+            latency_store=LatencyStore(),
+            journal=SessionJournal(),
+            status=status,
+            trace_recorder=TraceRecorder(),
+            gain_store=GainStore(),
+        )
+    return ShardedSessionHost(
+        worker_count=None if workers == "auto" else int(workers), status=status, record_traces=True
+    )
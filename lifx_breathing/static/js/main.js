@@ -0,0 +1,51 @@
+// Live session status from /status, so the page never has to be reloaded to see what a light is doing.
+(function () {
+  if (!window.EventSource) {
+    return;
+  }
+
+  var sessions = {};
+
+  function describe(session) {
+    if (!session.state || session.state === "stopped") {
+      return "";
+    }
+    var parts = [session.state];
+    if (session.state === "running" && session.phase) {
+      parts.push(session.phase + (session.cycle !== undefined ? " (cycle " + (session.cycle + 1) + ")" : ""));
+    }
+    if (session.measured_inhale_ms !== undefined && session.measured_exhale_ms !== undefined) {
+      parts.push("inhale " + session.measured_inhale_ms + " ms, exhale " + session.measured_exhale_ms + " ms");
+    }
+    if (session.inhale_correction_ms !== undefined) {
+      parts.push("correction " + session.inhale_correction_ms + " / " + session.exhale_correction_ms + " ms");
+    }
+    if (session.lateness_ms !== undefined) {
+      parts.push(session.lateness_ms + " ms late");
+    }
+    return parts.join(" · ");
+  }
+
+  function render(macAddress) {
+    var row = document.querySelector('[data-mac-address="' + macAddress + '"]');
+    if (row) {
+      row.querySelector(".session-status").textContent = describe(sessions[macAddress]);
+    }
+  }
+
+  function merge(updates) {
+    Object.keys(updates).forEach(function (macAddress) {
+      sessions[macAddress] = Object.assign(sessions[macAddress] || {}, updates[macAddress]);
+      render(macAddress);
+    });
+  }
+
+  var source = new EventSource("/status");
+  source.addEventListener("snapshot", function (event) {
+    sessions = {};
+    merge(JSON.parse(event.data));
+  });
+  source.addEventListener("status", function (event) {
+    merge(JSON.parse(event.data));
+  });
+})();
@@ -0,0 +1,157 @@
+"""
+Live session status, pushed to dashboards as server-sent events.
+
+Sessions publish what they are doing (state, phase, cycle, measured phase durations, PID corrections) as small dicts
+keyed by MAC address. StatusUpdates merges them, so a light that publishes ten times between flushes costs one entry.
+A StatusBroadcaster flushes the merged updates every flush_interval_seconds into a single encoded SSE frame, and every
+connected dashboard is sent those same bytes. A hundred open dashboards therefore cost one encode per flush, instead of
+a hundred full re-renders of the index page. A client that connects, or falls too far behind, first gets a snapshot of
+the latest status of every light.
+
+from lifx_breathing.status_stream import StatusBroadcaster
+status = StatusBroadcaster()
+engine = BreathingEngine(status=status)
+for frame in status.stream():
+    response.write(frame)
+
+curl -sN localhost:5000/status
+"""
+
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+import collections
+import json
+import threading
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("status_stream")
+# -----------------------------------------------------------------------------
+
+from . import metrics
+
+DEFAULT_FLUSH_INTERVAL_SECONDS: float = 0.1
+
+
+def encode_event(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+class StatusUpdates:
+    """Thread-safe buffer of status updates, merged per key until they are drained."""
+
+    _lock: threading.Lock
+    _pending: Dict[str, Dict[str, Any]]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def publish(self, key: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self._pending.setdefault(key, {}).update(fields)
+
+    def drain(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            (pending, self._pending) = (self._pending, {})
+        return pending
+
+
+class StatusBroadcaster(StatusUpdates):
+    # Frames kept for clients that are catching up; a client further behind than this gets a fresh snapshot.
+    HISTORY_FRAMES: int = 64
+
+    # A comment line this often keeps proxies from closing an idle stream.
+    KEEPALIVE_SECONDS: float = 15.0
+
+    flush_interval_seconds: float
+
+    # The latest known status of every key, sent to each client when it connects.
+    _snapshot: Dict[str, Dict[str, Any]]
+
+    # (sequence number, encoded frame), oldest first.
+    _frames: Deque[Tuple[int, bytes]]
+    _sequence: int
+    # Clients wait on _condition for new frames; only the flusher waits on _dirty, so publishing wakes no client.
+    _condition: threading.Condition
+    _dirty: threading.Event
+    _stopping: threading.Event
+    _closed: bool
+    _clients: int
+    _flusher: threading.Thread
+
+    def __init__(self, flush_interval_seconds: float = DEFAULT_FLUSH_INTERVAL_SECONDS) -> None:
+        super().__init__()
+        self.flush_interval_seconds = flush_interval_seconds
+        self._snapshot = {}
+        self._frames = collections.deque(maxlen=self.HISTORY_FRAMES)
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._dirty = threading.Event()
+        self._stopping = threading.Event()
+        self._closed = False
+        self._clients = 0
+        self._flusher = threading.Thread(target=self._flush_frames, name="status-stream", daemon=True)
+        self._flusher.start()
+        metrics.STATUS_STREAM_CLIENTS.set_function(lambda: self._clients)
+
+    def publish(self, key: str, fields: Dict[str, Any]) -> None:
+        super().publish(key, fields)
+        self._dirty.set()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._condition:
+            return {key: dict(fields) for (key, fields) in self._snapshot.items()}
+
+    def _flush_frames(self) -> None:
+        while not self._stopping.is_set():
+            self._dirty.wait()
+            # Let updates from every session gather into one frame.
+            self._stopping.wait(self.flush_interval_seconds)
+            self._dirty.clear()
+            updates: Dict[str, Dict[str, Any]] = self.drain()
+            if not updates:
+                continue
+            frame: bytes = encode_event("status", updates)
+            with self._condition:
+                for (key, fields) in updates.items():
+                    self._snapshot.setdefault(key, {}).update(fields)
+                self._sequence += 1
+                self._frames.append((self._sequence, frame))
+                self._condition.notify_all()
+
+    def stream(self) -> Iterator[bytes]:
+        """Yield SSE frames for one client until the client goes away or the broadcaster is closed."""
+        with self._condition:
+            self._clients += 1
+        try:
+            cursor: Optional[int] = None
+            while True:
+                with self._condition:
+                    if cursor is None or (self._frames and self._frames[0][0] > cursor + 1):
+                        # New, or so far behind that frames were dropped: start over from the full picture.
+                        cursor = self._sequence
+                        frames: Tuple[bytes, ...] = (encode_event("snapshot", self._snapshot),)
+                    else:
+                        self._condition.wait_for(
+                            lambda: self._sequence > cursor or self._closed,  # type: ignore
+                            timeout=self.KEEPALIVE_SECONDS,
+                        )
+                        if self._closed:
+                            return
+                        frames = tuple(frame for (sequence, frame) in self._frames if sequence > cursor)
+                        cursor = self._sequence
+                yield from frames or (b": keepalive\n\n",)
+        finally:
+            with self._condition:
+                self._clients -= 1
+
+    def close(self) -> None:
+        self._stopping.set()
+        self._dirty.set()
+        self._flusher.join()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
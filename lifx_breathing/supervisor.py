@@ -0,0 +1,165 @@
+"""
+Supervision of breathing sessions on the engine's event loop.
+
+A SupervisedSession owns the asyncio task that runs one session (a single light or a synchronized group) and reports
+where that session is in its lifecycle:
+
+STARTING -> RUNNING -> STOPPING -> STOPPED
+               |  ^
+               v  |
+             BACKOFF -> FAILED
+
+A session whose coroutine raises is restarted after an exponential, jittered backoff instead of being dropped. The
+backoff resets once a run has lasted RestartPolicy.stable_after_seconds, and after max_restarts consecutive crashes
+the session gives up and stays FAILED. Stopping a session only cancels its task; the session coroutine restores the
+original colour in its own `finally` block, so nothing waits on it except the engine's event loop. Once a session is
+STOPPING it ends STOPPED whatever its last run raises, and is never restarted.
+
+from lifx_breathing.supervisor import RestartPolicy, SupervisedSession
+session = SupervisedSession(lights, lambda: run_session(light, 5000, 5000), RestartPolicy())
+session.start(loop)
+session.stop()
+"""
+
+from typing import Any, Callable, Coroutine, Optional, Tuple
+import asyncio
+import dataclasses
+import enum
+import random
+import time
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("supervisor")
+# -----------------------------------------------------------------------------
+
+from .lifx_manager import LifxLightWrapper
+
+SessionFactory = Callable[[], Coroutine[Any, Any, None]]
+
+
+class SessionState(enum.Enum):
+    STARTING = "starting"
+    RUNNING = "running"
+    BACKOFF = "backoff"
+    STOPPING = "stopping"
+    STOPPED = "stopped"
+    FAILED = "failed"
+
+
+ACTIVE_SESSION_STATES = frozenset([SessionState.STARTING, SessionState.RUNNING, SessionState.BACKOFF])
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class RestartPolicy:
+    initial_backoff_seconds: float = 1.0
+    max_backoff_seconds: float = 60.0
+    backoff_multiplier: float = 2.0
+
+    # Each delay is scaled by a random factor in [1 - jitter, 1 + jitter] so that bulbs on a flaky network do not
+    # all retry in the same instant.
+    jitter: float = 0.2
+
+    # A run that lasts this long counts as healthy and resets the backoff and the crash count.
+    stable_after_seconds: float = 60.0
+    max_restarts: int = 10
+
+    def backoff_seconds(self, consecutive_crashes: int) -> float:
+        delay: float = min(
+            self.initial_backoff_seconds * self.backoff_multiplier ** (consecutive_crashes - 1), self.max_backoff_seconds
+        )
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+DEFAULT_RESTART_POLICY: RestartPolicy = RestartPolicy()
+
+
+class SupervisedSession:
+    lights: Tuple[LifxLightWrapper, ...]
+    state: SessionState
+    restarts: int
+    last_error: Optional[BaseException]
+
+    _factory: SessionFactory
+    _policy: RestartPolicy
+    _task: Optional["asyncio.Task[None]"]
+    _on_state: Optional[Callable[[SessionState], None]]
+
+    def __init__(
+        self,
+        lights: Tuple[LifxLightWrapper, ...],
+        factory: SessionFactory,
+        policy: RestartPolicy = DEFAULT_RESTART_POLICY,
+        on_state: Optional[Callable[[SessionState], None]] = None,
+    ) -> None:
+        self.lights = lights
+        self.restarts = 0
+        self.last_error = None
+        self._factory = factory
+        self._policy = policy
+        self._task = None
+        self._on_state = on_state
+        self._set_state(SessionState.STARTING)
+
+    def _set_state(self, state: SessionState) -> None:
+        self.state = state
+        if self._on_state is not None:
+            self._on_state(state)
+
+    @property
+    def is_active(self) -> bool:
+        return self.state in ACTIVE_SESSION_STATES
+
+    @property
+    def task(self) -> "asyncio.Task[None]":
+        assert self._task is not None
+        return self._task
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> "asyncio.Task[None]":
+        self._task = loop.create_task(self._supervise())
+        return self._task
+
+    def stop(self) -> None:
+        # Cancelling twice would interrupt the session while it restores its lights.
+        if self._task is None or self._task.done() or self.state is SessionState.STOPPING:
+            return
+        self._set_state(SessionState.STOPPING)
+        self._task.cancel()
+
+    async def _supervise(self) -> None:
+        consecutive_crashes: int = 0
+        try:
+            while True:
+                self._set_state(SessionState.RUNNING)
+                started_at: float = time.monotonic()
+                try:
+                    await self._factory()
+                    # A session only returns on its own if it was asked to stop from inside; treat it as finished.
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.last_error = e
+                    if self.state is SessionState.STOPPING:
+                        # The session was already asked to stop; whatever went wrong on its way out, never restart it.
+                        logger.warning(f"session for {list(self.lights)} failed while stopping: {e!r}")
+                        break
+                    if time.monotonic() - started_at >= self._policy.stable_after_seconds:
+                        consecutive_crashes = 0
+                    consecutive_crashes += 1
+                    if consecutive_crashes > self._policy.max_restarts:
+                        logger.error(f"session for {list(self.lights)} failed {consecutive_crashes} times, giving up")
+                        self._set_state(SessionState.FAILED)
+                        return
+                    delay: float = self._policy.backoff_seconds(consecutive_crashes)
+                    logger.warning(f"session for {list(self.lights)} crashed: {e!r}, restarting in {delay:.1f} s")
+                    self._set_state(SessionState.BACKOFF)
+                    await asyncio.sleep(delay)
+                    self.restarts += 1
+            self._set_state(SessionState.STOPPED)
+        except asyncio.CancelledError:
+            self._set_state(SessionState.STOPPED)
+            raise
@@ -0,0 +1,343 @@
+"""
+Per-phase timing traces of breathing sessions, for working out afterwards why a bulb's cadence drifted.
+
+A TraceRecorder appends one fixed-width record per breathing phase to a memory-mapped file. Each record holds a
+timestamp, the bulb, the session and cycle, the target, commanded, requested and actual phase durations, the PID
+terms and the bulb's latency estimates. Recording a phase is a struct.pack_into into the mapping and does no system
+call. The file grows CHUNK_RECORDS records at a time, and its header holds the record count, so a process that dies
+without closing the file leaves a trace that loads up to the last phase it recorded.
+
+Loading and analysis need NumPy, which is only imported here when a trace is loaded. load_traces maps every file into
+one structured array, so weeks of sessions across many bulbs can be filtered and aggregated with array operations.
+replay runs a trace through a PidController with other gains and predicts the phase durations those gains would have
+produced.
+
+from lifx_breathing.trace import TraceRecorder, load_traces, replay
+recorder = TraceRecorder("/tmp/traces/session.lxtrace")
+trace = recorder.session("d0:73:d5:00:00:01", "polling")
+trace.phase(0, cycle=0, target_ms=5000, commanded_ms=5000, requested_ms=4840, actual_ms=5012)
+recorder.close()
+records = load_traces("/tmp/traces")
+predicted_actual_ms = replay(records, PidGains(k_p=0.8))
+
+python -m lifx_breathing.trace summary ~/.cache/lifx_breathing/traces
+python -m lifx_breathing.trace replay ~/.cache/lifx_breathing/traces --k-p 0.8 --k-i 0.05 --k-d 0.0
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("trace")
+# -----------------------------------------------------------------------------
+
+from .pid import PidController, PidGains
+
+if TYPE_CHECKING:
+    import numpy
+
+TRACE_MAGIC: bytes = b"LXTRACE\x00"
+TRACE_VERSION: int = 1
+TRACE_SUFFIX: str = ".lxtrace"
+
+# Stored in the mode field; the index is the code.
+TRACE_MODES: Tuple[str, ...] = ("polling", "scheduled")
+
+# One (name, struct code) per field, little-endian and unpadded. The struct format and the NumPy dtype are both derived
+# from this list, so they cannot disagree about the layout.
+RECORD_FIELDS: Tuple[Tuple[str, str], ...] = (
+    # Wall-clock time the phase ended, in seconds since the epoch.
+    ("timestamp", "d"),
+    # MAC address as a 48-bit integer.
+    ("bulb", "Q"),
+    ("session", "Q"),
+    ("cycle", "I"),
+    # Index of the phase in the session's cycle: inhale 0 and exhale 1 for the classic cycle.
+    ("phase", "B"),
+    ("mode", "B"),
+    ("reserved", "H"),
+    # What the user asked for, what the PID loop asked for, and what went to the bulb after latency compensation.
+    ("target_ms", "i"),
+    ("commanded_ms", "i"),
+    ("requested_ms", "i"),
+    ("actual_ms", "i"),
+    # How late the phase's first packet left, in scheduled mode.
+    ("start_error_ms", "i"),
+    ("error_ms", "i"),
+    ("integral_ms", "i"),
+    ("derivative_ms", "i"),
+    ("correction_ms", "i"),
+    # NaN where the session keeps no latency model.
+    ("rtt_ms", "f"),
+    ("fade_lag_ms", "f"),
+    ("padding", "I"),
+)
+RECORD_STRUCT: struct.Struct = struct.Struct("<" + "".join(code for (_, code) in RECORD_FIELDS))
+
+# magic, version, record size, record count, reserved
+HEADER_STRUCT: struct.Struct = struct.Struct("<8sIIQQ")
+COUNT_OFFSET: int = 16
+
+CHUNK_RECORDS: int = 4096
+
+
+def mac_address_to_int(mac_address: str) -> int:
+    return int(mac_address.replace(":", ""), 16)
+
+
+def int_to_mac_address(value: int) -> str:
+    return ":".join(f"{(value >> shift) & 0xFF:02x}" for shift in range(40, -8, -8))
+
+
+def default_trace_path() -> str:
+    from .lifx_manager import default_cache_directory
+
+    started_at: str = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(default_cache_directory(), "traces", f"{started_at}-{os.getpid()}{TRACE_SUFFIX}")
+
+
+class TraceRecorder:
+    path: str
+    count: int
+
+    _chunk_records: int
+    _capacity: int
+    _file: Any
+    _map: mmap.mmap
+    _lock: threading.Lock
+
+    def __init__(self, path: Optional[str] = None, chunk_records: int = CHUNK_RECORDS) -> None:
+        self.path = path if path is not None else default_trace_path()
+        directory: str = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.count = 0
+        self._chunk_records = chunk_records
+        self._capacity = chunk_records
+        self._lock = threading.Lock()
+        self._file = open(self.path, "w+b")
+        self._file.truncate(HEADER_STRUCT.size + self._capacity * RECORD_STRUCT.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        HEADER_STRUCT.pack_into(self._map, 0, TRACE_MAGIC, TRACE_VERSION, RECORD_STRUCT.size, 0, 0)
+        logger.info(f"recording traces to {self.path}")
+
+    def session(self, mac_address: str, mode: str) -> "SessionTrace":
+        return SessionTrace(self, mac_address_to_int(mac_address), random.getrandbits(63), TRACE_MODES.index(mode))
+
+    def _grow(self) -> None:
+        self._map.close()
+        self._capacity += self._chunk_records
+        self._file.truncate(HEADER_STRUCT.size + self._capacity * RECORD_STRUCT.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def append(self, *values: Any) -> None:
+        """Append one record; values are every field of RECORD_FIELDS after the timestamp, in order."""
+        with self._lock:
+            if self._map.closed:
+                return
+            if self.count == self._capacity:
+                self._grow()
+            offset: int = HEADER_STRUCT.size + self.count * RECORD_STRUCT.size
+            RECORD_STRUCT.pack_into(self._map, offset, time.time(), *values)
+            self.count += 1
+            # Only count the record once it is complete, so a reader never sees a half-written one.
+            struct.pack_into("<Q", self._map, COUNT_OFFSET, self.count)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._map.closed:
+                return
+            self._map.flush()
+            self._map.close()
+            self._file.truncate(HEADER_STRUCT.size + self.count * RECORD_STRUCT.size)
+            self._file.close()
+
+
+class SessionTrace:
+    """One run of one session's records in a TraceRecorder."""
+
+    __slots__ = ("_recorder", "_bulb", "session_id", "_mode")
+
+    _recorder: TraceRecorder
+    _bulb: int
+    session_id: int
+    _mode: int
+
+    def __init__(self, recorder: TraceRecorder, bulb: int, session_id: int, mode: int) -> None:
+        self._recorder = recorder
+        self._bulb = bulb
+        self.session_id = session_id
+        self._mode = mode
+
+    def phase(
+        self,
+        phase: int,
+        cycle: int,
+        target_ms: int,
+        commanded_ms: int,
+        requested_ms: int,
+        actual_ms: int,
+        start_error_ms: int = 0,
+        error_ms: int = 0,
+        integral_ms: int = 0,
+        derivative_ms: int = 0,
+        correction_ms: int = 0,
+        rtt_ms: float = math.nan,
+        fade_lag_ms: float = math.nan,
+    ) -> None:
+        self._recorder.append(
+            self._bulb,
+            self.session_id,
+            cycle,
+            phase,
+            self._mode,
+            0,
+            target_ms,
+            commanded_ms,
+            requested_ms,
+            actual_ms,
+            start_error_ms,
+            error_ms,
+            integral_ms,
+            derivative_ms,
+            correction_ms,
+            rtt_ms,
+            fade_lag_ms,
+            0,
+        )
+
+
+def record_dtype() -> "numpy.dtype":
+    import numpy
+
+    return numpy.dtype([(name, "<" + code) for (name, code) in RECORD_FIELDS])
+
+
+def trace_paths(paths: Iterable[str]) -> List[str]:
+    """Expand directories into the trace files inside them."""
+    found: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(
+                sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(TRACE_SUFFIX))
+            )
+        else:
+            found.append(path)
+    return found
+
+
+def load_trace(path: str) -> "numpy.ndarray":
+    import numpy
+
+    with open(path, "rb") as f:
+        header: bytes = f.read(HEADER_STRUCT.size)
+    (magic, version, record_size, count, _) = HEADER_STRUCT.unpack(header)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD_STRUCT.size:
+        raise ValueError(f"{path} is not a version {TRACE_VERSION} breathing trace")
+    if count == 0:
+        return numpy.empty(0, dtype=record_dtype())
+    return numpy.memmap(path, dtype=record_dtype(), mode="r", offset=HEADER_STRUCT.size, shape=(count,))
+
+
+def load_traces(*paths: str) -> "numpy.ndarray":
+    """Every record in the given trace files and directories, as one structured array in file order."""
+    import numpy
+
+    arrays: List["numpy.ndarray"] = [load_trace(path) for path in trace_paths(paths)]
+    return numpy.concatenate(arrays) if arrays else numpy.empty(0, dtype=record_dtype())
+
+
+def replay(records: "numpy.ndarray", gains: PidGains) -> "numpy.ndarray":
+    """
+    The actual duration each polling phase would have had under gains, aligned with records.
+
+    The bulb and network are modelled by what they added to each phase in the trace, actual_ms - commanded_ms, and
+    that disturbance is replayed against a fresh controller per session and phase. Scheduled phases are not under PID
+    control and keep their recorded durations.
+    """
+    import numpy
+
+    predicted: "numpy.ndarray" = records["actual_ms"].astype(numpy.int64)
+    polling: "numpy.ndarray" = numpy.flatnonzero(records["mode"] == TRACE_MODES.index("polling"))
+    if len(polling) == 0:
+        return predicted
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for (index, key) in enumerate(zip(records["session"][polling].tolist(), records["phase"][polling].tolist())):
+        groups.setdefault(key, []).append(int(polling[index]))
+    for indices in groups.values():
+        controller: PidController = PidController(gains)
+        commanded_ms: int = int(records["commanded_ms"][indices[0]])
+        for index in indices:
+            actual_ms: int = commanded_ms + int(records["actual_ms"][index]) - int(records["commanded_ms"][index])
+            predicted[index] = actual_ms
+            commanded_ms += controller.update(int(records["target_ms"][index]) - actual_ms)
+    return predicted
+
+
+def summarize(records: "numpy.ndarray") -> List[Tuple[str, str, int, float, float, float]]:
+    """Per bulb and mode: phases, mean and 95th percentile |actual - target| and mean start error, in ms."""
+    import numpy
+
+    rows: List[Tuple[str, str, int, float, float, float]] = []
+    for (bulb, mode) in sorted(set(zip(records["bulb"].tolist(), records["mode"].tolist()))):
+        selected: "numpy.ndarray" = records[(records["bulb"] == bulb) & (records["mode"] == mode)]
+        errors: "numpy.ndarray" = numpy.abs(selected["actual_ms"].astype(numpy.int64) - selected["target_ms"])
+        rows.append(
+            (
+                int_to_mac_address(bulb),
+                TRACE_MODES[mode],
+                len(selected),
+                float(errors.mean()),
+                float(numpy.percentile(errors, 95)),
+                float(selected["start_error_ms"].mean()),
+            )
+        )
+    return rows
+
+
+def main() -> None:
+    import argparse
+
+    import numpy
+
+    parser = argparse.ArgumentParser(description="Analyse recorded breathing traces.")
+    parser.add_argument("command", choices=["summary", "replay"])
+    parser.add_argument("paths", nargs="+", help="trace files or directories of them")
+    parser.add_argument("--k-p", type=float, default=PidGains.k_p)
+    parser.add_argument("--k-i", type=float, default=PidGains.k_i)
+    parser.add_argument("--k-d", type=float, default=PidGains.k_d)
+    args = parser.parse_args()
+
+    records: "numpy.ndarray" = load_traces(*args.paths)
+    print(f"{len(records)} phases")
+    if args.command == "summary":
+        for (bulb, mode, phases, mean_ms, p95_ms, start_error_ms) in summarize(records):
+            print(
+                f"{bulb} {mode:9} {phases:8} phases, |error| mean {mean_ms:7.1f} ms, p95 {p95_ms:7.1f} ms, "
+                f"start error mean {start_error_ms:5.1f} ms"
+            )
+        return
+    gains: PidGains = PidGains(k_p=args.k_p, k_i=args.k_i, k_d=args.k_d)
+    polling: "numpy.ndarray" = records["mode"] == TRACE_MODES.index("polling")
+    targets: "numpy.ndarray" = records["target_ms"][polling].astype(numpy.int64)
+    recorded: "numpy.ndarray" = numpy.abs(records["actual_ms"][polling] - targets)
+    predicted: "numpy.ndarray" = numpy.abs(replay(records, gains)[polling] - targets)
+    if len(targets) == 0:
+        print("no polling phases to replay")
+        return
+    print(f"recorded  |error| mean {recorded.mean():7.1f} ms, p95 {numpy.percentile(recorded, 95):7.1f} ms")
+    print(f"{gains}: |error| mean {predicted.mean():7.1f} ms, p95 {numpy.percentile(predicted, 95):7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Offline PID gain tuning, and the per-bulb gain profiles it produces.
+
+Polling sessions correct each phase with a PidController, and the default gains were picked by hand for one bulb on
+one network. The tuner picks gains per bulb instead. From a bulb's traces it takes what the bulb and network added to
+each polling phase, actual_ms - commanded_ms, and replays sessions drawn from that distribution through every
+combination of gains on a grid at once: the controller state of thousands of (gains, session) pairs is advanced one
+phase at a time as NumPy arrays. Each combination is scored by its mean |actual - target| plus a cost per phase spent
+settling, and the grid is split into chunks that run on a process pool when there is more than one core to use.
+
+The best gains per bulb are saved to a GainStore, gains.json next to the device cache. Sessions look their bulb up in
+it when they start, so profiles tuned while the app is running are used from the next session on. Gains passed
+explicitly to a session, from the command line or the API, win over the stored profile.
+
+Tuning needs NumPy, which is only imported here when tuning runs. Looking up a stored profile does not need it.
+
+from lifx_breathing.tuning import GainStore, tune
+result = tune(disturbances_ms)
+store = GainStore()
+store.set("d0:73:d5:00:00:01", result.gains)
+store.save()
+gains = store.get("d0:73:d5:00:00:01")
+
+python -m lifx_breathing.tuning tune ~/.cache/lifx_breathing/traces
+python -m lifx_breathing.tuning simulate --offset-ms 180 --jitter-ms 40
+"""
+
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, TYPE_CHECKING
+import concurrent.futures
+import json
+import multiprocessing
+import os
+
+# -----------------------------------------------------------------------------
+# create logger
+# -----------------------------------------------------------------------------
+from .log_queue import get_logger
+
+logger = get_logger("tuning")
+# -----------------------------------------------------------------------------
+
+from .pid import DEFAULT_PID_GAINS, PidGains
+
+if TYPE_CHECKING:
+    import numpy
+
+# The default grid: 16 values per gain, 4096 combinations.
+K_P_VALUES: Sequence[float] = tuple(0.1 * i for i in range(16))
+K_I_VALUES: Sequence[float] = tuple(0.02 * i for i in range(16))
+K_D_VALUES: Sequence[float] = tuple(0.02 * i for i in range(16))
+
+# Sessions drawn per bulb and phases per session. The first phases of a session are where the gains matter most.
+EPISODES: int = 64
+CYCLES: int = 40
+
+# A phase within this many milliseconds of its target counts as settled, and each phase a session spends before it
+# settles for good costs as much as this many milliseconds of mean error.
+SETTLED_WITHIN_MS: int = 100
+SETTLING_CYCLE_COST_MS: float = 10.0
+
+# Combinations per task sent to the process pool.
+CHUNK_GAINS: int = 512
+
+# Bulbs with fewer polling phases than this in their traces keep the default gains.
+MIN_SAMPLES: int = 20
+
+
+class GainStore:
+    """Tuned PidGains keyed by MAC address, saved as compact JSON rows of [mac, k_p, k_i, k_d]."""
+
+    FORMAT_VERSION: int = 1
+
+    path: str
+    _bulbs: Dict[str, PidGains]
+
+    # Modification time of the file when it was last read, so get() notices profiles saved by the tuner.
+    _loaded_mtime: Optional[float]
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        if path is None:
+            # Imported here so that the command line session, which never discovers lights, does not load the manager.
+            from .lifx_manager import default_cache_directory
+
+            path = os.path.join(default_cache_directory(), "gains.json")
+        self.path = path
+        self._loaded_mtime = None
+        self._bulbs = self._load()
+
+    def _mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _load(self) -> Dict[str, PidGains]:
+        self._loaded_mtime = self._mtime()
+        try:
+            with open(self.path, "r") as f:
+                data: Dict[str, Any] = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.exception(f"ignoring unreadable gain store {self.path}")
+            return {}
+        if data.get("version") != self.FORMAT_VERSION:
+            return {}
+        return {
+            mac_address: PidGains(k_p=k_p, k_i=k_i, k_d=k_d)
+            for (mac_address, k_p, k_i, k_d) in data.get("bulbs", [])
+        }
+
+    def get(self, mac_address: str, default: PidGains = DEFAULT_PID_GAINS) -> PidGains:
+        if self._mtime() != self._loaded_mtime:
+            self._bulbs = self._load()
+        return self._bulbs.get(mac_address.lower(), default)
+
+    def set(self, mac_address: str, gains: PidGains) -> None:
+        self._bulbs[mac_address.lower()] = gains
+
+    def save(self) -> None:
+        rows: List[List[Any]] = [
+            [mac_address, gains.k_p, gains.k_i, gains.k_d] for (mac_address, gains) in sorted(self._bulbs.items())
+        ]
+        data: Dict[str, Any] = {"version": self.FORMAT_VERSION, "bulbs": rows}
+        directory: str = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path: str = f"{self.path}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(temporary_path, self.path)
+        except OSError:
+            logger.exception(f"could not write gain store {self.path}")
+        self._loaded_mtime = self._mtime()
+
+
+class TuningResult(NamedTuple):
+    gains: PidGains
+    cost: float
+    mean_error_ms: float
+    settling_cycles: float
+
+
+def gain_grid(
+    k_p_values: Sequence[float] = K_P_VALUES,
+    k_i_values: Sequence[float] = K_I_VALUES,
+    k_d_values: Sequence[float] = K_D_VALUES,
+) -> "numpy.ndarray":
+    """Every combination of the given values, as rows of (k_p, k_i, k_d)."""
+    import numpy
+
+    grid: List["numpy.ndarray"] = numpy.meshgrid(k_p_values, k_i_values, k_d_values, indexing="ij")
+    return numpy.stack([axis.ravel() for axis in grid], axis=1).astype(numpy.float64)
+
+
+def simulate(
+    disturbances_ms: "numpy.ndarray",
+    gains: "numpy.ndarray",
+    history_window_size: int = DEFAULT_PID_GAINS.history_window_size,
+    integral_limit_ms: int = DEFAULT_PID_GAINS.integral_limit_ms,
+) -> "numpy.ndarray":
+    """
+    The timing error, actual_ms - target_ms, of every phase of every session under every row of gains.
+
+    disturbances_ms has one row per session, holding what the bulb added to each phase. gains has one row of
+    (k_p, k_i, k_d) per combination. The result has shape (combinations, sessions, phases) and matches a PidController
+    phase for phase: each session starts commanding the target duration, and the correction is truncated to whole
+    milliseconds term by term.
+    """
+    import numpy
+
+    disturbances_ms = numpy.asarray(disturbances_ms, dtype=numpy.int64)
+    (episodes, cycles) = disturbances_ms.shape
+    k_p: "numpy.ndarray" = gains[:, 0:1]
+    k_i: "numpy.ndarray" = gains[:, 1:2]
+    k_d: "numpy.ndarray" = gains[:, 2:3]
+
+    # Offset of the commanded duration from the target; the target itself cancels out of every error.
+    offset_ms: "numpy.ndarray" = numpy.zeros((len(gains), episodes), dtype=numpy.int64)
+    history: "numpy.ndarray" = numpy.zeros((history_window_size, len(gains), episodes), dtype=numpy.int64)
+    window_sum: "numpy.ndarray" = numpy.zeros_like(offset_ms)
+    last_error_ms: "numpy.ndarray" = numpy.zeros_like(offset_ms)
+    timing_errors_ms: "numpy.ndarray" = numpy.empty((len(gains), episodes, cycles), dtype=numpy.int64)
+    for cycle in range(cycles):
+        timing_errors_ms[:, :, cycle] = offset_ms + disturbances_ms[:, cycle]
+        error_ms: "numpy.ndarray" = -timing_errors_ms[:, :, cycle]
+        slot: int = cycle % history_window_size
+        window_sum += error_ms - history[slot]
+        history[slot] = error_ms
+        derivative_ms: "numpy.ndarray" = error_ms - last_error_ms if cycle > 0 else numpy.zeros_like(error_ms)
+        last_error_ms = error_ms
+        integral_ms: "numpy.ndarray" = numpy.clip(window_sum, -integral_limit_ms, integral_limit_ms)
+        offset_ms += (
+            numpy.trunc(k_p * error_ms) + numpy.trunc(k_i * integral_ms) + numpy.trunc(k_d * derivative_ms)
+        ).astype(numpy.int64)
+    return timing_errors_ms
+
+
+def evaluate(disturbances_ms: "numpy.ndarray", gains: "numpy.ndarray") -> "numpy.ndarray":
+    """Rows of (cost, mean |error| in ms, mean phases before settling) for every row of gains."""
+    import numpy
+
+    errors_ms: "numpy.ndarray" = numpy.abs(simulate(disturbances_ms, gains))
+    cycles: int = errors_ms.shape[2]
+    # Phases after the last one outside SETTLED_WITHIN_MS are settled; the rest of the session was spent settling.
+    settled: "numpy.ndarray" = numpy.cumprod((errors_ms <= SETTLED_WITHIN_MS)[:, :, ::-1], axis=2).sum(axis=2)
+    settling_cycles: "numpy.ndarray" = (cycles - settled).mean(axis=1)
+    mean_error_ms: "numpy.ndarray" = errors_ms.mean(axis=(1, 2))
+    return numpy.stack([mean_error_ms + SETTLING_CYCLE_COST_MS * settling_cycles, mean_error_ms, settling_cycles], 1)
+
+
+def tune(
+    disturbances_ms: "numpy.ndarray", gains: Optional["numpy.ndarray"] = None, workers: Optional[int] = None
+) -> TuningResult:
+    """
+    The gains on the grid with the lowest cost over the sessions in disturbances_ms.
+
+    The grid is evaluated CHUNK_GAINS rows at a time, on a process pool of workers processes (one per core by
+    default) when it has more than one chunk and more than one worker.
+    """
+    import numpy
+
+    if gains is None:
+        gains = gain_grid()
+    chunks: List["numpy.ndarray"] = [gains[start : start + CHUNK_GAINS] for start in range(0, len(gains), CHUNK_GAINS)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers > 1:
+        # spawn, as the session host does, so that workers never inherit another thread's locks.
+        with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("spawn")) as pool:
+            scores: List["numpy.ndarray"] = list(pool.map(evaluate, [disturbances_ms] * len(chunks), chunks))
+    else:
+        scores = [evaluate(disturbances_ms, chunk) for chunk in chunks]
+    score: "numpy.ndarray" = numpy.concatenate(scores)
+    best: int = int(numpy.argmin(score[:, 0]))
+    (k_p, k_i, k_d) = (float(value) for value in gains[best])
+    return TuningResult(PidGains(k_p=k_p, k_i=k_i, k_d=k_d), *(float(value) for value in score[best]))
+
+
+def resampled_episodes(
+    samples_ms: "numpy.ndarray", episodes: int = EPISODES, cycles: int = CYCLES, seed: int = 0
+) -> "numpy.ndarray":
+    """Sessions of cycles phases whose disturbances are drawn, with replacement, from the measured samples_ms."""
+    import numpy
+
+    return numpy.random.default_rng(seed).choice(numpy.asarray(samples_ms, dtype=numpy.int64), (episodes, cycles))
+
+
+def simulated_episodes(
+    offset_ms: float, jitter_ms: float, episodes: int = EPISODES, cycles: int = CYCLES, seed: int = 0
+) -> "numpy.ndarray":
+    """Sessions for a bulb with no traces yet: a constant offset_ms plus normally distributed jitter."""
+    import numpy
+
+    rng: "numpy.random.Generator" = numpy.random.default_rng(seed)
+    return numpy.rint(rng.normal(offset_ms, jitter_ms, (episodes, cycles))).astype(numpy.int64)
+
+
+def trace_disturbances(records: "numpy.ndarray") -> Dict[str, "numpy.ndarray"]:
+    """actual_ms - commanded_ms of every polling phase in records, by bulb MAC address."""
+    import numpy
+
+    from .trace import TRACE_MODES, int_to_mac_address
+
+    polling: "numpy.ndarray" = records[records["mode"] == TRACE_MODES.index("polling")]
+    disturbances_ms: "numpy.ndarray" = polling["actual_ms"].astype(numpy.int64) - polling["commanded_ms"]
+    return {
+        int_to_mac_address(bulb): disturbances_ms[polling["bulb"] == bulb]
+        for bulb in sorted(set(polling["bulb"].tolist()))
+    }
+
+
+def tune_traces(
+    records: "numpy.ndarray", workers: Optional[int] = None, seed: int = 0
+) -> Dict[str, TuningResult]:
+    """Tuned gains for every bulb with at least MIN_SAMPLES polling phases in records."""
+    results: Dict[str, TuningResult] = {}
+    for (mac_address, samples_ms) in trace_disturbances(records).items():
+        if len(samples_ms) < MIN_SAMPLES:
+            logger.info(f"{mac_address} has only {len(samples_ms)} polling phases traced, not tuning it")
+            continue
+        results[mac_address] = tune(resampled_episodes(samples_ms, seed=seed), workers=workers)
+    return results
+
+
+def describe(result: TuningResult) -> str:
+    gains: PidGains = result.gains
+    return (
+        f"k_p {gains.k_p:.2f} k_i {gains.k_i:.2f} k_d {gains.k_d:.2f}: |error| mean {result.mean_error_ms:6.1f} ms, "
+        f"settles in {result.settling_cycles:4.1f} phases"
+    )
+
+
+def main() -> None:
+    import argparse
+
+    import numpy
+
+    from .trace import load_traces
+
+    parser = argparse.ArgumentParser(description="Tune PID gains per bulb from recorded or simulated sessions.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    tune_parser = subparsers.add_parser("tune", help="tune every traced bulb and save its gains")
+    tune_parser.add_argument("paths", nargs="+", help="trace files or directories of them")
+    tune_parser.add_argument("--store", help="gain store to update, gains.json in the cache directory by default")
+    tune_parser.add_argument("--dry-run", action="store_true", help="print the gains without saving them")
+    simulate_parser = subparsers.add_parser("simulate", help="tune against a bulb with the given latency")
+    simulate_parser.add_argument("--offset-ms", type=float, required=True, help="mean extra time per phase")
+    simulate_parser.add_argument("--jitter-ms", type=float, default=0.0, help="standard deviation of that time")
+    for subparser in (tune_parser, simulate_parser):
+        subparser.add_argument("--workers", type=int, help="processes to tune on, one per core by default")
+    args = parser.parse_args()
+
+    if args.command == "simulate":
+        episodes: "numpy.ndarray" = simulated_episodes(args.offset_ms, args.jitter_ms)
+        result: TuningResult = tune(episodes, workers=args.workers)
+        default: "numpy.ndarray" = evaluate(
+            episodes, numpy.array([[DEFAULT_PID_GAINS.k_p, DEFAULT_PID_GAINS.k_i, DEFAULT_PID_GAINS.k_d]])
+        )[0]
+        print(f"default  {describe(TuningResult(DEFAULT_PID_GAINS, *(float(value) for value in default)))}")
+        print(f"tuned    {describe(result)}")
+        return
+
+    results: Dict[str, TuningResult] = tune_traces(load_traces(*args.paths), args.workers)
+    if not results:
+        print(f"no bulb has {MIN_SAMPLES} polling phases traced")
+        return
+    store: GainStore = GainStore(args.store)
+    for (mac_address, result) in results.items():
+        print(f"{mac_address} {describe(result)}")
+        store.set(mac_address, result.gains)
+    if not args.dry_run:
+        store.save()
+        print(f"saved to {store.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Local stand-in for LIFX bulbs that speaks the subset of the LAN protocol used by lifx_breathing.
+
+Every simulated bulb shares one UDP socket on localhost, and requests are routed by the target MAC address in the
+frame header exactly as a real network would route them by IP. Broadcast (tagged) requests are answered by every bulb.
+
+from tests.lifx_simulator import LifxSimulator
+with LifxSimulator(bulb_count=10, latency_seconds=0.005, loss_rate=0.01) as simulator:
+    light = lifxlan.Light(simulator.bulbs[0].mac_address, "127.0.0.1", port=simulator.port)
+    light.get_color()
+    with simulator.redirect_broadcasts():
+        lifxlan.LifxLAN().get_lights()
+"""
+
+from typing import Any, Dict, Iterator, List, Tuple, Type
+import collections
+import contextlib
+import dataclasses
+import heapq
+import random
+import socket
+import struct
+import threading
+import time
+
+import lifxlan.lifxlan
+from lifxlan.message import BROADCAST_MAC, HEADER_SIZE_BYTES, Message
+from lifxlan.msgtypes import (
+    Acknowledgement,
+    GetLabel,
+    GetLocation,
+    GetPower,
+    GetService,
+    GetVersion,
+    LightGet,
+    LightGetPower,
+    LightSetColor,
+    LightSetPower,
+    LightSetWaveform,
+    LightState,
+    LightStatePower,
+    SetPower,
+    StateLabel,
+    StateLocation,
+    StatePower,
+    StateService,
+    StateVersion,
+)
+from lifxlan.unpack import unpack_lifx_message
+
+Color = Tuple[int, int, int, int]
+Address = Tuple[str, int]
+
+SET_WAVEFORM_MESSAGE_TYPE: int = 103
+SET_WAVEFORM_FORMAT: str = "<BB4HIfhB"
+
+# LIFX A19, a colour bulb, so lifxlan's discovery classifies every simulated bulb as a plain Light.
+SIMULATED_PRODUCT: int = 27
+
+
+def decode_set_waveform(data: bytes) -> Dict[str, Any]:
+    """lifxlan's unpack_lifx_message does not decode SetWaveform, so read its payload directly."""
+    (_, transient, hue, saturation, brightness, kelvin, period, cycles, duty_cycle, waveform) = struct.unpack_from(
+        SET_WAVEFORM_FORMAT, data, HEADER_SIZE_BYTES
+    )
+    return {
+        "transient": transient,
+        "color": (hue, saturation, brightness, kelvin),
+        "period": period,
+        "cycles": cycles,
+        "duty_cycle": duty_cycle,
+        "waveform": waveform,
+    }
+
+
+@dataclasses.dataclass
+class SimulatedBulb:
+    mac_address: str
+    label: str
+    location: str
+    color: Color = (0, 0, 65535, 3500)
+    power_level: int = 65535
+    fade_start: float = 0.0
+    fade_end: float = 0.0
+    fade_from: Color = (0, 0, 65535, 3500)
+
+    def current_color(self, now: float) -> Color:
+        if now >= self.fade_end or self.fade_end <= self.fade_start:
+            return self.color
+        fraction: float = (now - self.fade_start) / (self.fade_end - self.fade_start)
+        return tuple(  # type: ignore
+            int(start + (end - start) * fraction) for (start, end) in zip(self.fade_from, self.color)
+        )
+
+    def fade_to(self, color: Color, duration_seconds: float, now: float) -> None:
+        self.fade_from = self.current_color(now)
+        self.color = tuple(color)  # type: ignore
+        self.fade_start = now
+        self.fade_end = now + duration_seconds
+
+
+class LifxSimulator:
+    """
+    Threaded UDP server hosting many simulated bulbs.
+
+    latency_seconds delays every reply, loss_rate drops that fraction of inbound packets, and fade_lag_seconds is added
+    to the duration of every colour change to mimic a bulb finishing its fade late. With record_history every request
+    that was not dropped is kept in history as (arrival monotonic time, message). Bulbs are numbered from first_bulb,
+    so simulators standing in for different subnets host different bulbs.
+    """
+
+    bulbs: List[SimulatedBulb]
+    latency_seconds: float
+    loss_rate: float
+    fade_lag_seconds: float
+    received: Dict[str, int]
+    history: List[Tuple[float, Message]]
+
+    def __init__(
+        self,
+        bulb_count: int = 1,
+        latency_seconds: float = 0.0,
+        loss_rate: float = 0.0,
+        fade_lag_seconds: float = 0.0,
+        seed: int = 0,
+        record_history: bool = False,
+        first_bulb: int = 0,
+    ) -> None:
+        self.bulbs = [
+            SimulatedBulb(mac_address=f"d0:73:d5:00:{i >> 8:02x}:{i & 0xFF:02x}", label=f"Bulb {i}", location="Simulated")
+            for i in range(first_bulb, first_bulb + bulb_count)
+        ]
+        self._bulbs_by_mac: Dict[str, SimulatedBulb] = {bulb.mac_address: bulb for bulb in self.bulbs}
+        self.latency_seconds = latency_seconds
+        self.loss_rate = loss_rate
+        self.fade_lag_seconds = fade_lag_seconds
+        self.received = collections.Counter()
+        self.history = []
+        self._record_history = record_history
+        self._random = random.Random(seed)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.settimeout(0.05)
+        self._lock = threading.Lock()
+        self._outbox: List[Tuple[float, int, bytes, Address]] = []
+        self._outbox_counter = 0
+        self._running = False
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def port(self) -> int:
+        return int(self._socket.getsockname()[1])
+
+    @property
+    def address(self) -> Address:
+        return ("127.0.0.1", self.port)
+
+    def bulb(self, mac_address: str) -> SimulatedBulb:
+        return self._bulbs_by_mac[mac_address]
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.received.clear()
+            self.history.clear()
+
+    @contextlib.contextmanager
+    def redirect_broadcasts(self) -> Iterator[None]:
+        """Point lifxlan.LifxLAN's discovery broadcasts at the simulator instead of the LAN."""
+        saved: Tuple[List[str], int] = (lifxlan.lifxlan.UDP_BROADCAST_IP_ADDRS, lifxlan.lifxlan.UDP_BROADCAST_PORT)
+        lifxlan.lifxlan.UDP_BROADCAST_IP_ADDRS = ["127.0.0.1"]
+        lifxlan.lifxlan.UDP_BROADCAST_PORT = self.port
+        try:
+            yield
+        finally:
+            (lifxlan.lifxlan.UDP_BROADCAST_IP_ADDRS, lifxlan.lifxlan.UDP_BROADCAST_PORT) = saved
+
+    def start(self) -> "LifxSimulator":
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._receive_loop, name="lifx-simulator-rx", daemon=True),
+            threading.Thread(target=self._send_loop, name="lifx-simulator-tx", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._socket.close()
+
+    def __enter__(self) -> "LifxSimulator":
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def _receive_loop(self) -> None:
+        while self._running:
+            try:
+                data, address = self._socket.recvfrom(1024)
+                arrived_at: float = time.monotonic()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if self._random.random() < self.loss_rate:
+                continue
+            try:
+                message: Message = unpack_lifx_message(data)
+                if message.message_type == SET_WAVEFORM_MESSAGE_TYPE:
+                    message = LightSetWaveform(
+                        message.target_addr,
+                        message.source_id,
+                        message.seq_num,
+                        decode_set_waveform(data),
+                        message.ack_requested,
+                        message.response_requested,
+                    )
+            except Exception:
+                continue
+            with self._lock:
+                self.received[type(message).__name__] += 1
+                if self._record_history:
+                    self.history.append((arrived_at, message))
+            if message.target_addr == BROADCAST_MAC:
+                targets: List[SimulatedBulb] = self.bulbs
+            elif message.target_addr in self._bulbs_by_mac:
+                targets = [self._bulbs_by_mac[message.target_addr]]
+            else:
+                targets = []
+            for bulb in targets:
+                self._handle(bulb, message, address)
+
+    def _send_loop(self) -> None:
+        while self._running:
+            with self._lock:
+                now: float = time.monotonic()
+                ready: List[Tuple[bytes, Address]] = []
+                while self._outbox and self._outbox[0][0] <= now:
+                    (_, _, data, address) = heapq.heappop(self._outbox)
+                    ready.append((data, address))
+            for (data, address) in ready:
+                try:
+                    self._socket.sendto(data, address)
+                except OSError:
+                    pass
+            time.sleep(0.0005)
+
+    def _reply(
+        self, bulb: SimulatedBulb, request: Message, address: Address, reply_type: Type[Message], payload: Dict[str, Any]
+    ) -> None:
+        reply: Message = reply_type(bulb.mac_address, request.source_id, request.seq_num, payload)
+        with self._lock:
+            self._outbox_counter += 1
+            heapq.heappush(
+                self._outbox,
+                (time.monotonic() + self.latency_seconds, self._outbox_counter, reply.packed_message, address),
+            )
+
+    def _handle(self, bulb: SimulatedBulb, message: Message, address: Address) -> None:
+        now: float = time.monotonic()
+        if isinstance(message, GetService):
+            self._reply(bulb, message, address, StateService, {"service": 1, "port": self.port})
+        elif isinstance(message, GetVersion):
+            self._reply(
+                bulb, message, address, StateVersion, {"vendor": 1, "product": SIMULATED_PRODUCT, "version": 0}
+            )
+        elif isinstance(message, GetLabel):
+            self._reply(bulb, message, address, StateLabel, {"label": bulb.label})
+        elif isinstance(message, GetLocation):
+            self._reply(
+                bulb,
+                message,
+                address,
+                StateLocation,
+                {"location": [0] * 16, "label": bulb.location, "updated_at": 0},
+            )
+        elif isinstance(message, LightGet):
+            self._reply(
+                bulb,
+                message,
+                address,
+                LightState,
+                {
+                    "color": bulb.current_color(now),
+                    "reserved1": 0,
+                    "power_level": bulb.power_level,
+                    "label": bulb.label,
+                    "reserved2": 0,
+                },
+            )
+        elif isinstance(message, (GetPower, LightGetPower)):
+            reply_type: Type[Message] = StatePower if isinstance(message, GetPower) else LightStatePower
+            self._reply(bulb, message, address, reply_type, {"power_level": bulb.power_level})
+        elif isinstance(message, LightSetColor):
+            bulb.fade_to(message.color, message.duration / 1000.0 + self.fade_lag_seconds, now)
+        elif isinstance(message, LightSetWaveform):
+            if not message.transient:
+                duration_seconds: float = message.period * message.cycles / 1000.0
+                bulb.fade_to(message.color, duration_seconds + self.fade_lag_seconds, now)
+        elif isinstance(message, (SetPower, LightSetPower)):
+            bulb.power_level = message.power_level
+
+        if message.ack_requested:
+            self._reply(bulb, message, address, Acknowledgement, {})
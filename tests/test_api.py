@@ -0,0 +1,156 @@
+from flask import Flask
+
+from lifx_breathing.api import create_api_blueprint
+from lifx_breathing.lifx import BreathingMode, TransitionCue
+from lifx_breathing.lifx_manager import LifxLightWrapper, LightInventory
+from lifx_breathing.supervisor import SessionState
+
+office = LifxLightWrapper(location="Office", label="Lamp", ip_address="192.168.1.10", mac_address="d0:73:d5:00:00:01")
+bedroom = LifxLightWrapper(location="Bedroom", label="Lamp", ip_address="192.168.1.11", mac_address="d0:73:d5:00:00:02")
+
+
+class FakeManager:
+    def __init__(self, lights):
+        self.inventory = LightInventory(lights)
+
+
+class FakeEngine:
+    def __init__(self):
+        self.running = set()
+        self.calls = []
+
+    def is_running(self, light):
+        return light in self.running
+
+    def session_state(self, light):
+        return SessionState.RUNNING if light in self.running else SessionState.STOPPED
+
+    @property
+    def running_lights(self):
+        return list(self.running)
+
+    def start_nowait(self, light, inhale_duration_ms, exhale_duration_ms, mode, profile=None, cue=None):
+        self.calls.append(("start", light, inhale_duration_ms, exhale_duration_ms))
+        self.mode = mode
+        self.profile = profile
+        self.cue = cue
+        self.running.add(light)
+
+    def start_group_nowait(self, lights, inhale_duration_ms, exhale_duration_ms, profile=None, cue=None):
+        self.calls.append(("start_group", tuple(lights), inhale_duration_ms, exhale_duration_ms))
+        self.running.update(lights)
+
+    def stop_nowait(self, light):
+        self.calls.append(("stop", light))
+        self.running.discard(light)
+
+
+def make_client(engine):
+    app = Flask(__name__)
+    app.register_blueprint(create_api_blueprint(FakeManager([office, bedroom]), engine))
+    return app.test_client()
+
+
+def test_batch_start_and_stop():
+    engine = FakeEngine()
+    client = make_client(engine)
+    response = client.post(
+        "/api/v1/sessions/start",
+        json={
+            "lights": [{"mac_address": "D0:73:D5:00:00:01"}, {"location": "Bedroom", "label": "Lamp"}, {"label": "x", "location": "y"}],
+            "inhale_seconds": 4,
+            "exhale_seconds": 0.5,
+        },
+    )
+    assert response.status_code == 202
+    assert response.get_json()["not_found"] == [{"label": "x", "location": "y"}]
+    assert engine.calls == [("start", office, 4000, 1000), ("start", bedroom, 4000, 1000)]
+    assert engine.mode is BreathingMode.POLLING
+
+    response = client.post("/api/v1/sessions/stop", json={"all": True})
+    assert response.status_code == 202
+    assert len(response.get_json()["stopping"]) == 2
+    assert engine.running == set()
+
+
+def test_status_and_validation():
+    engine = FakeEngine()
+    engine.running.add(office)
+    client = make_client(engine)
+    lights = client.get("/api/v1/lights").get_json()["lights"]
+    assert [(light["location"], light["is_running"], light["state"]) for light in lights] == [
+        ("Bedroom", False, "stopped"),
+        ("Office", True, "running"),
+    ]
+    response = client.post("/api/v1/sessions/start", json={"lights": [{}]})
+    assert response.status_code == 400
+    response = client.post("/api/v1/sessions/start", json={"lights": [], "mode": "nope"})
+    assert response.status_code == 400
+
+
+def test_start_with_profile():
+    engine = FakeEngine()
+    client = make_client(engine)
+    response = client.post("/api/v1/sessions/start", json={"lights": [{"mac_address": office.mac_address}], "profile": "box"})
+    assert response.status_code == 202
+    assert engine.profile.name == "box"
+    assert engine.mode is BreathingMode.SCHEDULED
+
+    phases = [{"name": "in", "seconds": 3, "color": [0, 0, 65535, 3500]}, {"name": "out", "seconds": 6, "color": [1, 2, 3, 3500]}]
+    response = client.post("/api/v1/sessions/start", json={"lights": [{"mac_address": office.mac_address}], "phases": phases})
+    assert response.status_code == 202
+    assert [phase.duration_ms for phase in engine.profile.phases] == [3000, 6000]
+
+    response = client.post("/api/v1/sessions/start", json={"lights": [], "phases": [{"seconds": 3, "color": [1]}]})
+    assert response.status_code == 400
+    response = client.post("/api/v1/sessions/start", json={"lights": [], "profile": "box", "mode": "polling"})
+    assert response.status_code == 400
+
+
+def test_start_with_cue():
+    engine = FakeEngine()
+    client = make_client(engine)
+    response = client.post("/api/v1/sessions/start", json={"lights": [{"mac_address": office.mac_address}], "cue": "dip"})
+    assert response.status_code == 202
+    assert engine.cue is TransitionCue.DIP
+
+    response = client.post("/api/v1/sessions/start", json={"lights": [], "cue": "strobe"})
+    assert response.status_code == 400
+
+
+def test_non_finite_durations_and_group_modes_are_rejected():
+    engine = FakeEngine()
+    client = make_client(engine)
+    for body in (
+        '{"lights": [], "inhale_seconds": NaN}',
+        '{"lights": [], "exhale_seconds": Infinity}',
+        '{"lights": [], "phases": [{"seconds": -Infinity, "color": [0, 0, 65535, 3500]}]}',
+    ):
+        response = client.post("/api/v1/sessions/start", data=body, content_type="application/json")
+        assert response.status_code == 400
+
+    lights = [{"mac_address": office.mac_address}, {"mac_address": bedroom.mac_address}]
+    response = client.post("/api/v1/sessions/start", json={"lights": lights, "group": True, "mode": "polling"})
+    assert response.status_code == 400
+    response = client.post("/api/v1/sessions/start", json={"lights": lights, "group": True, "mode": "scheduled"})
+    assert response.status_code == 202
+    assert engine.calls == [("start_group", (office, bedroom), 5000, 5000)]
+
+
+def test_oversized_durations_and_non_string_selectors_are_rejected():
+    engine = FakeEngine()
+    client = make_client(engine)
+    light = [{"mac_address": office.mac_address}]
+    for seconds in (1e308, 1e7):
+        response = client.post("/api/v1/sessions/start", json={"lights": light, "inhale_seconds": seconds})
+        assert response.status_code == 400
+        phases = [{"seconds": seconds, "color": [0, 0, 65535, 3500]}]
+        response = client.post("/api/v1/sessions/start", json={"lights": light, "phases": phases})
+        assert response.status_code == 400
+    response = client.post("/api/v1/sessions/start", json={"lights": light, "inhale_seconds": 300})
+    assert response.status_code == 202
+
+    for selector in ({"location": ["Office"], "label": "Lamp"}, {"location": "Office", "label": {}}, {"mac_address": 1}):
+        response = client.post("/api/v1/sessions/status", json={"lights": [selector]})
+        assert response.status_code == 400
+    assert engine.calls == [("start", office, 300000, 5000)]
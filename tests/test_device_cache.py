@@ -0,0 +1,76 @@
+import json
+import time
+
+from lifx_breathing.lifx_manager import DeviceCache, LifxLightWrapper
+
+office = LifxLightWrapper(location="Office", label="Lamp", ip_address="192.168.1.10", mac_address="d0:73:d5:00:00:01")
+bedroom = LifxLightWrapper(location="Bedroom", label="Lamp", ip_address="192.168.1.11", mac_address="d0:73:d5:00:00:02")
+
+
+def test_round_trip(tmp_path):
+    cache = DeviceCache(str(tmp_path / "devices.json"))
+    cache.save([office, bedroom])
+    loaded = cache.load()
+    assert sorted(loaded, key=lambda x: x.mac_address) == [office, bedroom]
+    assert [light.ip_address for light in sorted(loaded, key=lambda x: x.mac_address)] == [
+        "192.168.1.10",
+        "192.168.1.11",
+    ]
+
+
+def test_missing_file_is_empty(tmp_path):
+    assert DeviceCache(str(tmp_path / "missing.json")).load() == []
+
+
+def test_expired_entries_are_ignored(tmp_path):
+    path = tmp_path / "devices.json"
+    cache = DeviceCache(str(path), ttl_seconds=60)
+    cache.save([office, bedroom])
+    data = json.loads(path.read_text())
+    data["lights"][0][4] = time.time() - 120
+    path.write_text(json.dumps(data))
+    assert [light.mac_address for light in cache.load()] == [bedroom.mac_address]
+
+
+def test_duplicate_macs_keep_latest(tmp_path):
+    cache = DeviceCache(str(tmp_path / "devices.json"))
+    moved = LifxLightWrapper(location="Office", label="Lamp", ip_address="192.168.1.99", mac_address=office.mac_address)
+    cache.save([office, moved])
+    assert [light.ip_address for light in cache.load()] == ["192.168.1.99"]
+
+
+def test_corrupt_rows_are_skipped(tmp_path):
+    path = tmp_path / "devices.json"
+    cache = DeviceCache(str(path))
+    cache.save([office, bedroom])
+    data = json.loads(path.read_text())
+    data["lights"] += [["Office", "Lamp"], ["Office", "Lamp", "192.168.1.12", "d0:73:d5:00:00:03", "yesterday"], 7]
+    path.write_text(json.dumps(data))
+    assert sorted(light.mac_address for light in DeviceCache(str(path)).load()) == [
+        office.mac_address,
+        bedroom.mac_address,
+    ]
+
+
+def test_cache_that_is_not_an_object_is_empty(tmp_path):
+    path = tmp_path / "devices.json"
+    for content in ("[1, 2, 3]", '{"version": 1, "lights": {"a": 1}}', "null"):
+        path.write_text(content)
+        assert DeviceCache(str(path)).load() == []
+
+
+def test_unseen_lights_keep_their_last_seen_time(tmp_path):
+    path = tmp_path / "devices.json"
+    cache = DeviceCache(str(path), ttl_seconds=60)
+    cache.save([office, bedroom])
+    data = json.loads(path.read_text())
+    data["lights"][0][4] = time.time() - 50
+    path.write_text(json.dumps(data))
+    cache = DeviceCache(str(path), ttl_seconds=60)
+    cache.save(cache.load(), seen_mac_addresses=[bedroom.mac_address])
+    seen_at = {row[3]: row[4] for row in json.loads(path.read_text())["lights"]}
+    assert seen_at[office.mac_address] < time.time() - 49
+    assert seen_at[bedroom.mac_address] > time.time() - 5
+    assert cache.is_out_of_date([office.mac_address]) is False
+    cache.SEEN_AT_RESOLUTION_SECONDS = 10
+    assert cache.is_out_of_date([office.mac_address]) is True
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+from lifxlan import LifxLAN
+
+from lifx_breathing.discovery import DiscoveryTarget, SubnetDiscovery
+from lifx_breathing.lifx_manager import LifxManager
+from tests.lifx_simulator import LifxSimulator
+
+
+def test_targets_are_parsed_from_config():
+    assert DiscoveryTarget.parse("192.168.10.0/24") == DiscoveryTarget(("192.168.10.255",), 56700, broadcast=True)
+    assert DiscoveryTarget.parse(" 10.0.5.254-10.0.6.1:56701 ") == DiscoveryTarget(
+        ("10.0.5.254", "10.0.5.255", "10.0.6.0", "10.0.6.1"), 56701
+    )
+    assert DiscoveryTarget.parse("10.0.5.7").addresses == ("10.0.5.7",)
+    with pytest.raises(ValueError):
+        DiscoveryTarget.parse("10.0.0.0-10.1.0.0")
+    assert SubnetDiscovery.from_config(None) is None
+    assert SubnetDiscovery.from_config(" , ") is None
+    assert len(SubnetDiscovery.from_config("192.168.10.0/24,192.168.20.0/24").targets) == 2
+
+
+def test_subnets_are_scanned_concurrently_and_merged_by_mac():
+    with LifxSimulator(bulb_count=3, latency_seconds=0.3) as first, LifxSimulator(
+        bulb_count=2, latency_seconds=0.3, first_bulb=3
+    ) as second:
+        discovery = SubnetDiscovery.from_config(
+            f"127.0.0.1:{first.port},127.0.0.1-127.0.0.2:{second.port},127.0.0.1:{second.port}"
+        )
+        started_at = time.monotonic()
+        found = discovery.scan(attempts=1, window_seconds=0.5)
+        elapsed = time.monotonic() - started_at
+        assert sorted(found) == sorted(bulb.mac_address for bulb in first.bulbs + second.bulbs)
+        assert found[second.bulbs[0].mac_address] == ("127.0.0.1", second.port)
+    # Three targets with 300 ms replies each, answered within one 500 ms window.
+    assert elapsed < 0.7
+
+
+def test_manager_discovers_lights_on_every_subnet():
+    with LifxSimulator(bulb_count=2, latency_seconds=0.002) as first, LifxSimulator(
+        bulb_count=2, latency_seconds=0.002, first_bulb=2
+    ) as second:
+        discovery = SubnetDiscovery.from_config(f"127.0.0.1:{first.port},127.0.0.1:{second.port}")
+        manager = LifxManager(lan=LifxLAN(), discovery=discovery)
+        try:
+            deadline = time.monotonic() + 10
+            while len(manager.lights) < 4 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert [light.label for light in manager.lights] == ["Bulb 0", "Bulb 1", "Bulb 2", "Bulb 3"]
+        finally:
+            manager.close()
+
+
+def test_slow_bulb_does_not_hold_up_the_others_and_is_retried_next_round(monkeypatch, caplog):
+    # Describing a bulb takes two round trips, so the slow bulb cannot be described within one discovery round.
+    monkeypatch.setattr(LifxManager, "DISCOVERY_ROUND_TIMEOUT_SECONDS", 0.45)
+    with LifxSimulator(bulb_count=3, latency_seconds=0.002) as fast, LifxSimulator(
+        latency_seconds=0.3, first_bulb=3
+    ) as slow:
+        discovery = SubnetDiscovery.from_config(f"127.0.0.1:{fast.port},127.0.0.1:{slow.port}")
+        manager = LifxManager(lan=LifxLAN(), discovery=discovery)
+        try:
+            deadline = time.monotonic() + 10
+            while "describing devices timed out with 1 devices still answering" not in caplog.text:
+                assert time.monotonic() < deadline, "timed out"
+                time.sleep(0.01)
+            assert [light.label for light in manager.lights] == ["Bulb 0", "Bulb 1", "Bulb 2"]
+
+            # The bulb recovers before the next round's scan has finished, and that round describes it.
+            slow.latency_seconds = 0.002
+            while len(manager.lights) < 4:
+                assert time.monotonic() < deadline, "timed out"
+                time.sleep(0.01)
+            assert manager.is_updating
+            assert manager.get_light("Simulated", "Bulb 3").mac_address == slow.bulbs[0].mac_address
+            assert slow.received["GetLocation"] == 2
+        finally:
+            manager.close()
@@ -0,0 +1,49 @@
+import time
+
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.lifx_manager import LifxLightWrapper
+from lifx_breathing.supervisor import SessionState
+from tests.lifx_simulator import LifxSimulator
+
+
+def wait_for(condition, timeout_seconds=5.0):
+    deadline = time.monotonic() + timeout_seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_start_stop_and_status_of_sessions():
+    with LifxSimulator(bulb_count=2, latency_seconds=0.002) as simulator:
+        (first, second) = [
+            LifxLightWrapper("Simulated", bulb.label, "127.0.0.1", bulb.mac_address) for bulb in simulator.bulbs
+        ]
+        originals = [bulb.color for bulb in simulator.bulbs]
+        engine = BreathingEngine(port=simulator.port)
+        try:
+            assert engine.session_state(first) is SessionState.STOPPED
+            assert not engine.is_running(first)
+
+            engine.start(first, 300, 300)
+            engine.start(second, 300, 300)
+            wait_for(lambda: set(engine.session_states().values()) == {SessionState.RUNNING})
+            assert sorted(engine.running_lights, key=lambda light: light.mac_address) == [first, second]
+
+            # Starting a running light again replaces its session rather than adding a second one.
+            engine.start(first, 400, 400)
+            wait_for(lambda: engine.session_state(first) is SessionState.RUNNING)
+            assert len(engine.session_states()) == 2
+
+            engine.stop(first)
+            assert engine.session_state(first) is SessionState.STOPPED
+            assert not engine.is_running(first)
+            assert engine.running_lights == [second]
+            assert simulator.bulbs[0].color == originals[0]
+            assert engine.session_state(second) is SessionState.RUNNING
+
+            # Stopping a light that has no session does nothing.
+            engine.stop(first)
+        finally:
+            engine.close()
+        assert engine.running_lights == []
+        assert [bulb.color for bulb in simulator.bulbs] == originals
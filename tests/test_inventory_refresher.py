@@ -0,0 +1,44 @@
+from lifx_breathing.inventory_refresher import InventoryRefresher
+from lifx_breathing.lifx_manager import LifxLightWrapper, LightInventory
+
+office = LifxLightWrapper(location="Office", label="Lamp", ip_address="192.168.1.10", mac_address="d0:73:d5:00:00:01")
+bedroom = LifxLightWrapper(location="Bedroom", label="Lamp", ip_address="192.168.1.11", mac_address="d0:73:d5:00:00:02")
+
+
+class FakeManager:
+    def __init__(self, lights, described):
+        self.inventory = LightInventory(lights)
+        self.described = described
+        self.probed = []
+
+    def probe_lights(self, ip_addresses):
+        self.probed.append(dict(ip_addresses))
+        return {mac: self.described[mac] for mac in ip_addresses if mac in self.described}
+
+    def apply_inventory_changes(self, updated, removed_mac_addresses):
+        self.inventory = self.inventory.with_changes(updated, removed_mac_addresses)
+
+    def mark_lights_seen(self, mac_addresses):
+        pass
+
+
+def test_only_new_and_moved_bulbs_are_probed():
+    moved = LifxLightWrapper(location="Office", label="Lamp", ip_address="192.168.1.20", mac_address=office.mac_address)
+    kitchen = LifxLightWrapper(location="Kitchen", label="Lamp", ip_address="192.168.1.12", mac_address="d0:73:d5:00:00:03")
+    manager = FakeManager([office, bedroom], {office.mac_address: moved, kitchen.mac_address: kitchen})
+    refresher = InventoryRefresher(manager, broadcast_addresses=[])
+    refresher.reconcile({office.mac_address: "192.168.1.20", bedroom.mac_address: "192.168.1.11", kitchen.mac_address: "192.168.1.12"})
+    assert manager.probed == [{office.mac_address: "192.168.1.20", kitchen.mac_address: "192.168.1.12"}]
+    assert manager.inventory.get_by_ip_address("192.168.1.20") is moved
+    assert manager.inventory.get("Kitchen", "Lamp") is kitchen
+
+
+def test_bulb_is_removed_after_missed_sweeps():
+    manager = FakeManager([office, bedroom], {})
+    refresher = InventoryRefresher(manager, broadcast_addresses=[])
+    for _ in range(InventoryRefresher.MISSED_SWEEPS_BEFORE_REMOVAL - 1):
+        refresher.reconcile({office.mac_address: office.ip_address})
+        assert len(manager.inventory) == 2
+    refresher.reconcile({office.mac_address: office.ip_address})
+    assert manager.inventory.lights == (office,)
+    assert manager.probed == []
@@ -0,0 +1,155 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.journal import SessionJournal, SessionSpec, spec_from_json, spec_to_json
+from lifx_breathing.lifx import BreathingMode, TransitionCue
+from lifx_breathing.lifx_manager import LifxLightWrapper
+from lifx_breathing.pid import DEFAULT_PID_GAINS, PidGains
+from lifx_breathing.profiles import box_profile
+from lifx_breathing.supervisor import SessionState
+from tests.lifx_simulator import LifxSimulator
+
+LIGHT = LifxLightWrapper("Simulated", "Bulb", "127.0.0.1", "d0:73:d5:00:00:01")
+WHITE = ((0, 0, 65535, 3500), 65535)
+
+# Starts a session in a separate interpreter and waits to be killed, like a web app that supervisord restarts.
+CRASHING_APP = """
+import sys, time
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.journal import SessionJournal
+from lifx_breathing.lifx_manager import LifxLightWrapper
+from lifx_breathing.supervisor import SessionState
+
+journal = SessionJournal(sys.argv[1])
+engine = BreathingEngine(port=int(sys.argv[2]), journal=journal)
+light = LifxLightWrapper("Simulated", "Bulb", "127.0.0.1", sys.argv[3])
+engine.start(light, 300, 300)
+while engine.session_state(light) is not SessionState.RUNNING:
+    time.sleep(0.01)
+time.sleep(0.5)
+journal.flush()
+print("ready", flush=True)
+time.sleep(60)
+"""
+
+
+def wait_for(condition, timeout_seconds=10.0):
+    deadline = time.monotonic() + timeout_seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_spec_round_trips_through_json():
+    spec = SessionSpec((LIGHT,), 4000, 4000, BreathingMode.SCHEDULED, profile=box_profile(4000), cue=TransitionCue.DIP)
+    assert spec_from_json(json.loads(json.dumps(spec_to_json(spec)))) == spec
+    # Explicit default gains stay explicit, so a resumed session does not switch to the light's tuned gains.
+    for gains in (None, DEFAULT_PID_GAINS):
+        spec = SessionSpec((LIGHT,), 4000, 4000, BreathingMode.POLLING, gains)
+        assert spec_from_json(json.loads(json.dumps(spec_to_json(spec)))).gains == gains
+
+
+def test_replay_keeps_only_open_sessions_and_skips_torn_line(tmp_path):
+    path = str(tmp_path / "sessions.journal")
+    journal = SessionJournal(path)
+    stopped = journal.record_start(SessionSpec((LIGHT,), 1000, 1000))
+    still_open = journal.record_start(SessionSpec((LIGHT,), 2000, 2000))
+    journal.record_original_state(still_open, LIGHT.mac_address, WHITE)
+    journal.record_stop(stopped)
+    journal.close()
+    with open(path, "a") as f:
+        f.write('{"op":"stop","sess')
+
+    reopened = SessionJournal(path)
+    reopened.close()
+    assert [session.session_id for session in reopened.open_sessions] == [still_open]
+    assert reopened.open_sessions[0].spec.inhale_duration_ms == 2000
+    assert reopened.open_sessions[0].original_states == {LIGHT.mac_address: WHITE}
+    # Replay compacts the file down to one start record per open session.
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+
+
+def test_engine_restores_or_resumes_sessions_of_a_killed_process(tmp_path):
+    path = str(tmp_path / "sessions.journal")
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        bulb = simulator.bulbs[0]
+        original_color = bulb.color
+
+        def crash():
+            app = subprocess.Popen(
+                [sys.executable, "-c", CRASHING_APP, path, str(simulator.port), bulb.mac_address],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__)))},
+            )
+            try:
+                assert app.stdout.readline().strip() == b"ready"
+            finally:
+                app.send_signal(signal.SIGKILL)
+                app.wait()
+            assert bulb.color != original_color
+
+        crash()
+        journal = SessionJournal(path)
+        light = LifxLightWrapper("Simulated", "Bulb", "127.0.0.1", bulb.mac_address)
+        engine = BreathingEngine(port=simulator.port, journal=journal, resume_sessions=False)
+        engine.close()
+        journal.close()
+        assert bulb.color == original_color
+        assert bulb.power_level == 65535
+        assert not SessionJournal(path).open_sessions
+
+        crash()
+        journal = SessionJournal(path)
+        engine = BreathingEngine(port=simulator.port, journal=journal)
+        try:
+            wait_for(lambda: engine.session_state(light) is SessionState.RUNNING)
+            engine.stop(light)
+        finally:
+            engine.close()
+            journal.close()
+        assert bulb.color == original_color
+        assert not SessionJournal(path).open_sessions
+
+
+def test_resumed_session_keeps_the_gains_it_was_started_with(tmp_path):
+    class FixedGainStore:
+        def __init__(self, gains):
+            self.gains = gains
+
+        def get(self, mac_address):
+            return self.gains
+
+    def journaled_gains():
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        return [spec_from_json(record["spec"]).gains for record in records if record["op"] == "start"]
+
+    tuned = PidGains(k_p=0.5, k_i=0.01, k_d=0.0)
+    path = str(tmp_path / "sessions.journal")
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        light = LifxLightWrapper("Simulated", "Bulb", "127.0.0.1", simulator.bulbs[0].mac_address)
+        journal = SessionJournal(path)
+        engine = BreathingEngine(port=simulator.port, journal=journal, gain_store=FixedGainStore(tuned))
+        engine.start(light, 300, 300, BreathingMode.POLLING)
+        # Close the journal first so that the stop is never recorded, as if the process had been killed.
+        journal.close()
+        engine.close()
+        assert journaled_gains() == [tuned]
+
+        # The light has been retuned since, but the resumed session keeps the gains it was started with.
+        journal = SessionJournal(path)
+        engine = BreathingEngine(port=simulator.port, journal=journal, gain_store=FixedGainStore(DEFAULT_PID_GAINS))
+        try:
+            wait_for(lambda: engine.session_state(light) is SessionState.RUNNING)
+            journal.flush()
+            assert journaled_gains() == [tuned, tuned]
+        finally:
+            engine.close()
+            journal.close()
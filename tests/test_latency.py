@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import threading
+
+from lifx_breathing.latency import DEFAULT_RTT_MS, BulbLatency, LatencyStore
+from lifx_breathing.lifx import compensated_duration_ms, go_to_color
+from lifx_breathing.protocol import AsyncLight, LifxTransport
+from tests.lifx_simulator import LifxSimulator
+
+GREEN = (21845, 65535, 65535, 3500)
+
+
+def test_first_sample_replaces_default_then_averages():
+    latency = BulbLatency()
+    assert latency.rtt_ms == DEFAULT_RTT_MS
+    latency.observe_rtt(10.0)
+    assert latency.rtt_ms == 10.0
+    latency.observe_rtt(50.0)
+    assert latency.rtt_ms == 10.0 + BulbLatency.ALPHA * 40.0
+    latency.observe_fade_lag(-5.0)
+    assert latency.fade_lag_ms == 0.0
+
+
+def test_compensated_duration_never_drops_below_flash():
+    latency = BulbLatency(rtt_ms=10.0, fade_lag_ms=40.0)
+    assert latency.phase_overhead_ms(200) == 160
+    assert compensated_duration_ms(5000, 200, latency) == 4840
+    assert compensated_duration_ms(250, 200, latency) == 200
+
+
+def test_store_round_trip(tmp_path):
+    path = str(tmp_path / "latency.json")
+    store = LatencyStore(path)
+    store.get("D0:73:D5:00:00:01").observe_rtt(12.0)
+    store.get("d0:73:d5:00:00:02")
+    store.save()
+
+    with open(path) as f:
+        assert json.load(f) == {"version": 1, "bulbs": [["d0:73:d5:00:00:01", 12.0, 50.0]]}
+    reloaded = LatencyStore(path).get("d0:73:d5:00:00:01")
+    assert (reloaded.rtt_ms, reloaded.rtt_samples) == (12.0, 1)
+
+
+def test_concurrent_saves_keep_every_store(tmp_path):
+    path = str(tmp_path / "latency.json")
+    stores = [LatencyStore(path) for _ in range(4)]
+    for (number, store) in enumerate(stores):
+        store.get(f"d0:73:d5:00:00:{number:02x}").observe_rtt(10.0 + number)
+
+    def save(store):
+        for _ in range(25):
+            store.save()
+
+    threads = [threading.Thread(target=save, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reloaded = LatencyStore(path)
+    assert [reloaded.get(f"d0:73:d5:00:00:{number:02x}").rtt_ms for number in range(4)] == [10.0, 11.0, 12.0, 13.0]
+    assert sorted(os.listdir(str(tmp_path))) == ["latency.json", "latency.json.lock"]
+
+
+def test_go_to_color_learns_fade_lag():
+    async def main(simulator, latency):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            await go_to_color(light, GREEN, duration_ms=300, flash_duration_ms=50, latency=latency)
+        finally:
+            transport.close()
+
+    latency = BulbLatency()
+    with LifxSimulator(latency_seconds=0.005, fade_lag_seconds=0.2) as simulator:
+        asyncio.run(main(simulator, latency))
+    assert latency.rtt_samples >= 2
+    assert 5.0 <= latency.rtt_ms < 50.0
+    assert 100.0 <= latency.fade_lag_ms < 400.0
@@ -0,0 +1,23 @@
+from lifx_breathing.lifx_manager import LifxLightWrapper, LightInventory
+
+office = LifxLightWrapper(location="Office", label="Lamp", ip_address="192.168.1.10", mac_address="d0:73:d5:00:00:01")
+bedroom = LifxLightWrapper(location="Bedroom", label="Lamp", ip_address="192.168.1.11", mac_address="d0:73:d5:00:00:02")
+
+
+def test_lookups():
+    inventory = LightInventory([office, bedroom])
+    assert inventory.lights == (bedroom, office)
+    assert inventory.get("Office", "Lamp") is office
+    assert inventory.get("Kitchen", "Lamp") is None
+    assert inventory.get_by_mac_address("d0:73:d5:00:00:02") is bedroom
+    assert inventory.get_by_ip_address("192.168.1.10") is office
+
+
+def test_with_light_replaces_by_mac_and_leaves_original_untouched():
+    inventory = LightInventory([office])
+    renamed = LifxLightWrapper(location="Office", label="Desk", ip_address="192.168.1.12", mac_address=office.mac_address)
+    updated = inventory.with_light(renamed)
+    assert updated.lights == (renamed,)
+    assert updated.get("Office", "Lamp") is None
+    assert updated.get_by_ip_address("192.168.1.12") is renamed
+    assert inventory.lights == (office,)
@@ -0,0 +1,124 @@
+import io
+import json
+import logging
+import threading
+
+from lifx_breathing import metrics
+from lifx_breathing.log_queue import LogWriter, QueueLogHandler, get_logger
+
+
+class GatedStream(io.StringIO):
+    """A stream whose writes block until it is opened, like a supervisord pipe nobody is reading."""
+
+    def __init__(self):
+        super().__init__()
+        self.opened = threading.Event()
+        self.writes = 0
+
+    def write(self, text):
+        self.opened.wait()
+        self.writes += 1
+        return super().write(text)
+
+
+class Recorder:
+    def __init__(self):
+        self.threads = []
+
+    def __str__(self):
+        self.threads.append(threading.current_thread().name)
+        return "recorded"
+
+
+FORMATTER = logging.Formatter("%(levelname)s %(message)s")
+
+
+class GatedFormatter(logging.Formatter):
+    """Blocks the writer on the first record it takes, so the queue fills up deterministically behind it."""
+
+    def __init__(self, opened):
+        super().__init__("%(levelname)s %(message)s")
+        self.opened = opened
+
+    def format(self, record):
+        self.opened.wait()
+        return super().format(record)
+
+
+def make_logger(name, writer):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.handlers = [QueueLogHandler(writer)]
+    return logger
+
+
+def test_records_are_formatted_off_the_caller_thread_in_batches():
+    stream = GatedStream()
+    writer = LogWriter(stream, formatter=FORMATTER)
+    logger = make_logger("test_log_queue.batches", writer)
+    recorder = Recorder()
+    for i in range(100):
+        logger.info("cycle %d %s", i, recorder)
+    stream.opened.set()
+    writer.flush()
+    writer.close()
+    assert stream.getvalue().splitlines()[-1] == "INFO cycle 99 recorded"
+    assert len(stream.getvalue().splitlines()) == 100
+    assert stream.writes <= 3
+    assert set(recorder.threads) == {"log-writer"}
+
+
+def test_full_queue_drops_records_instead_of_blocking():
+    stream = GatedStream()
+    writer = LogWriter(stream, max_queued_records=10, formatter=GatedFormatter(stream.opened))
+    logger = make_logger("test_log_queue.drops", writer)
+    dropped_before = metrics.LOG_RECORDS_DROPPED.labels().value
+    for i in range(50):
+        logger.info("cycle %d", i)
+    stream.opened.set()
+    writer.flush()
+    logger.info("after")
+    writer.close()
+    lines = stream.getvalue().splitlines()
+    # The writer may have taken one record off the queue before blocking on the stream.
+    assert 10 <= len([line for line in lines if line.startswith("INFO cycle")]) <= 11
+    assert any(line.startswith("log queue was full, dropped") for line in lines)
+    assert metrics.LOG_RECORDS_DROPPED.labels().value - dropped_before >= 39
+
+
+def test_json_lines_carry_session_event_fields():
+    stream = io.StringIO()
+    writer = LogWriter(stream, json_lines=True)
+    logger = make_logger("test_log_queue.json", writer)
+    logger.info("cycle %d finished", 3, extra={"session_event": {"event": "scheduled_cycle", "lateness_ms": 2}})
+    writer.close()
+    record = json.loads(stream.getvalue())
+    assert record["message"] == "cycle 3 finished"
+    assert (record["event"], record["lateness_ms"], record["level"]) == ("scheduled_cycle", 2, "INFO")
+
+
+def test_drops_from_many_threads_are_all_counted():
+    stream = GatedStream()
+    writer = LogWriter(stream, max_queued_records=1, formatter=FORMATTER)
+    logger = make_logger("test_log_queue.threads", writer)
+    logger.info("blocks the writer")
+    threads = [threading.Thread(target=lambda: [logger.info("x") for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stream.opened.set()
+    writer.flush()
+    writer.close()
+    lines = stream.getvalue().splitlines()
+    dropped = sum(int(line.split()[-2]) for line in lines if line.startswith("log queue was full"))
+    assert dropped + len([line for line in lines if line.startswith("INFO")]) == 4001
+
+
+def test_get_logger_attaches_one_shared_handler():
+    logger = get_logger("test_log_queue.shared")
+    assert get_logger("test_log_queue.shared") is logger
+    other = get_logger("test_log_queue.other")
+    assert len(logger.handlers) == 1 and logger.handlers == other.handlers
+    assert isinstance(logger.handlers[0], QueueLogHandler)
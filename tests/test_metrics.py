@@ -0,0 +1,41 @@
+import timeit
+
+from lifx_breathing.metrics import Histogram, Registry
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    rtt = registry.histogram("rtt_ms", "Round trip.", buckets=(1, 10))
+    rtt.labels(message="LightGet").observe(0.5)
+    rtt.labels(message="LightGet").observe(5)
+    rtt.labels(message="LightGet").observe(50)
+    registry.counter("timeouts_total", "Timeouts.").inc()
+    registry.gauge("sessions", "Sessions.").set_function(lambda: 3)
+    assert registry.render().splitlines() == [
+        "# HELP rtt_ms Round trip.",
+        "# TYPE rtt_ms histogram",
+        'rtt_ms_bucket{message="LightGet",le="1"} 1',
+        'rtt_ms_bucket{message="LightGet",le="10"} 2',
+        'rtt_ms_bucket{message="LightGet",le="+Inf"} 3',
+        'rtt_ms_sum{message="LightGet"} 55.5',
+        'rtt_ms_count{message="LightGet"} 3',
+        "# HELP sessions Sessions.",
+        "# TYPE sessions gauge",
+        "sessions 3",
+        "# HELP timeouts_total Timeouts.",
+        "# TYPE timeouts_total counter",
+        "timeouts_total 1",
+    ]
+
+
+def test_labels_return_the_same_child():
+    registry = Registry()
+    family = registry.counter("retries_total", "Retries.")
+    assert family.labels(operation="get_color") is family.labels(operation="get_color")
+    assert registry.counter("retries_total", "Retries.") is family
+
+
+def test_observe_costs_microseconds():
+    histogram = Histogram((1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+    seconds = min(timeit.repeat(lambda: histogram.observe(42.0), number=10000, repeat=3)) / 10000
+    assert seconds < 20e-6
@@ -0,0 +1,35 @@
+from lifx_breathing.pid import PidController, PidGains
+
+
+def test_update_matches_windowed_sum():
+    gains = PidGains(k_p=1.0, k_i=0.5, k_d=0.0, history_window_size=3)
+    controller = PidController(gains)
+    errors = [100, -20, 40, 60, -80]
+    for i, error in enumerate(errors):
+        correction = controller.update(error)
+        window = errors[max(0, i - 2) : i + 1]
+        assert controller.cumulative_error_ms == sum(window)
+        assert correction == int(error) + int(0.5 * sum(window))
+
+
+def test_derivative_uses_previous_error():
+    controller = PidController(PidGains(k_p=0.0, k_i=0.0, k_d=1.0))
+    assert controller.update(10) == 0
+    assert controller.update(25) == 15
+    assert controller.derivative_error_ms == 15
+
+
+def test_integral_is_clamped():
+    controller = PidController(PidGains(k_p=0.0, k_i=1.0, k_d=0.0, integral_limit_ms=100))
+    for _ in range(10):
+        correction = controller.update(-500)
+    assert controller.cumulative_error_ms == -100
+    assert correction == -100
+
+
+def test_reset_clears_history():
+    controller = PidController()
+    controller.update(1000)
+    controller.reset()
+    assert controller.update(0) == 0
+    assert controller.cumulative_error_ms == 0
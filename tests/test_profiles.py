@@ -0,0 +1,34 @@
+import pytest
+
+from lifx_breathing.profiles import BLUE, RED, BreathingPhase, BreathingProfile, box_profile, compile_profile
+from lifx_breathing.profiles import four_seven_eight_profile, named_profile
+
+
+def test_box_profile_compiles_to_keyframes():
+    table = compile_profile(box_profile(count_ms=4000))
+    assert table.colors == (BLUE, BLUE, RED, RED)
+    assert list(table.durations_ms) == [4000] * 4
+    assert list(table.fade_durations_ms) == [3800, 0, 3800, 0]
+    assert list(table.send_color) == [1, 0, 1, 0]
+    assert table.cycle_duration_ms == 16000
+
+
+def test_equal_profiles_share_one_compiled_table():
+    compile_profile.cache_clear()
+    first = compile_profile(named_profile("4-7-8", 4000, 8000))
+    second = compile_profile(four_seven_eight_profile(count_ms=1000))
+    assert first is second
+    assert compile_profile.cache_info().misses == 1
+    assert list(first.durations_ms) == [4000, 7000, 8000]
+
+
+def test_custom_phases_are_validated_and_hashable():
+    profile = BreathingProfile("custom", [BreathingPhase("in", 2000, [1, 2, 3, 3500]), BreathingPhase("out", 100, RED)])
+    table = compile_profile(profile)
+    assert table.colors[0] == (1, 2, 3, 3500)
+    assert list(table.flash_durations_ms) == [200, 100]
+    assert list(table.fade_durations_ms) == [1800, 0]
+    with pytest.raises(ValueError):
+        BreathingPhase("in", 1000, (0, 0, 70000, 3500))
+    with pytest.raises(ValueError):
+        named_profile("triangle", 1000, 1000)
@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+import pytest
+from lifxlan.errors import WorkflowException
+from lifxlan.msgtypes import Acknowledgement, LightGet, LightState
+
+from lifx_breathing import metrics
+from lifx_breathing.lifx import flash
+from lifx_breathing.protocol import AsyncLight, LifxTransport, RetryBudget, RetryPolicy
+from tests.lifx_simulator import LifxSimulator
+
+FAST_RETRY_POLICY = RetryPolicy(attempt_timeout_seconds=0.05, initial_backoff_seconds=0.01, max_attempts=5)
+
+
+def test_retry_budget_caps_retries_at_ratio():
+    budget = RetryBudget(ratio=0.5, max_balance=2.0)
+    budget.withdraw()
+    budget.withdraw()
+    assert not budget.can_retry()
+    budget.record_request()
+    assert not budget.can_retry()
+    budget.record_request()
+    assert budget.can_retry()
+    for _ in range(10):
+        budget.record_request()
+    assert budget.balance == 2.0
+
+
+def test_requests_survive_packet_loss():
+    async def main(simulator):
+        transport = await LifxTransport.create(retry_policy=FAST_RETRY_POLICY)
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            for _ in range(10):
+                await light.get_color()
+        finally:
+            transport.close()
+
+    retries = metrics.REQUEST_RETRIES.labels(message="LightGet")
+    retries_before = retries.value
+    with LifxSimulator(latency_seconds=0.002, loss_rate=0.2, seed=1) as simulator:
+        asyncio.run(main(simulator))
+    assert retries.value > retries_before
+
+
+def test_unreachable_bulb_spends_bounded_budget():
+    async def main(simulator):
+        transport = await LifxTransport.create(retry_policy=FAST_RETRY_POLICY)
+        try:
+            mac_address = simulator.bulbs[0].mac_address
+            for _ in range(3):
+                with pytest.raises(WorkflowException):
+                    await transport.request(
+                        mac_address, ("127.0.0.1", simulator.port), LightGet, LightState, {}, timeout_seconds=0.6
+                    )
+            return transport.retry_budget(mac_address).balance
+        finally:
+            transport.close()
+
+    retries = metrics.REQUEST_RETRIES.labels(message="LightGet")
+    retries_before = retries.value
+    with LifxSimulator(loss_rate=1.0) as simulator:
+        balance = asyncio.run(main(simulator))
+    # 4 retries for each of the first two requests and 2 for the third use up the 10 token budget.
+    assert retries.value - retries_before == 10
+    assert balance < 1.0
+
+
+def test_flash_costs_one_round_trip():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            started_at = time.monotonic()
+            await flash(light, flash_duration_ms=200)
+            return time.monotonic() - started_at
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.1) as simulator:
+        elapsed = asyncio.run(main(simulator))
+        assert simulator.received["LightSetPower"] == 2
+        assert simulator.bulbs[0].power_level == 65535
+    assert 0.3 <= elapsed < 0.38
+
+
+def test_replies_are_matched_by_mac_address_and_sequence_number():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            lights = [AsyncLight(transport, bulb.mac_address, "127.0.0.1", simulator.port) for bulb in simulator.bulbs]
+            # Both requests use sequence number 0, one per bulb, so only the MAC address tells their replies apart.
+            return await asyncio.gather(*(light.get_color() for light in lights))
+        finally:
+            transport.close()
+
+    with LifxSimulator(bulb_count=2, latency_seconds=0.002) as simulator:
+        simulator.bulbs[0].color = (1, 2, 3, 3500)
+        simulator.bulbs[1].color = (4, 5, 6, 3500)
+        colors = asyncio.run(main(simulator))
+    assert [tuple(color) for color in colors] == [(1, 2, 3, 3500), (4, 5, 6, 3500)]
+
+
+def test_replies_for_another_request_are_ignored():
+    mac_address = "d0:73:d5:00:00:01"
+    state = {"color": (7, 7, 7, 3500), "reserved1": 0, "power_level": 0, "label": "", "reserved2": 0}
+
+    def deliver(transport, message):
+        transport.datagram_received(message.packed_message, ("127.0.0.1", 56700))
+
+    async def main(simulator):
+        # A single attempt, so sequence number 0 is the only one the request listens for.
+        transport = await LifxTransport.create(retry_policy=RetryPolicy(max_attempts=1))
+        try:
+            request = asyncio.ensure_future(
+                transport.request(mac_address, ("127.0.0.1", simulator.port), LightGet, LightState, {})
+            )
+            await asyncio.sleep(0.01)
+            source_id = transport.source_id
+            deliver(transport, LightState(mac_address, source_id, 1, state))
+            deliver(transport, LightState("d0:73:d5:00:00:02", source_id, 0, state))
+            deliver(transport, LightState(mac_address, source_id + 1, 0, state))
+            deliver(transport, Acknowledgement(mac_address, source_id, 0, {}))
+            await asyncio.sleep(0.01)
+            assert not request.done()
+            deliver(transport, LightState(mac_address, source_id, 0, state))
+            return await request
+        finally:
+            transport.close()
+
+    # The simulator drops every packet, so the only replies are the ones the test delivers.
+    with LifxSimulator(loss_rate=1.0) as simulator:
+        response = asyncio.run(main(simulator))
+    assert tuple(response.color) == (7, 7, 7, 3500)
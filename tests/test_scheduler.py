@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+
+from lifx_breathing import metrics
+from lifx_breathing.protocol import AsyncLight, LifxTransport
+from lifx_breathing.scheduler import CommandPriority, PacketScheduler
+from tests.lifx_simulator import LifxSimulator
+
+MAC_ADDRESS = "d0:73:d5:00:00:01"
+
+
+def test_bucket_limits_rate_after_burst():
+    async def main():
+        scheduler = PacketScheduler(rate_per_second=50.0, capacity=2.0)
+        started_at = time.monotonic()
+        for _ in range(7):
+            assert await scheduler.acquire(MAC_ADDRESS)
+        return time.monotonic() - started_at
+
+    assert 0.09 <= asyncio.run(main()) < 0.2
+
+
+def test_newer_command_replaces_waiting_one_in_its_place():
+    async def main():
+        scheduler = PacketScheduler(rate_per_second=20.0, capacity=1.0)
+        sent = []
+
+        async def command(name, coalesce_key):
+            if await scheduler.acquire(MAC_ADDRESS, coalesce_key=coalesce_key):
+                sent.append(name)
+
+        await command("first color", "color")
+        tasks = [asyncio.ensure_future(command("old color", "color"))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(command("power", "power")))
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(command("new color", "color")))
+        await asyncio.gather(*tasks)
+        return sent
+
+    coalesced_before = metrics.COMMANDS_COALESCED.labels().value
+    assert asyncio.run(main()) == ["first color", "new color", "power"]
+    assert metrics.COMMANDS_COALESCED.labels().value == coalesced_before + 1
+
+
+def test_discovery_waits_while_breathing_uses_the_budget():
+    async def main():
+        scheduler = PacketScheduler(rate_per_second=20.0, capacity=10.0)
+        discovered = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (scheduler.acquire_blocking(MAC_ADDRESS, CommandPriority.DISCOVERY), discovered.set())
+        )
+        for _ in range(10):
+            await scheduler.acquire(MAC_ADDRESS)
+        thread.start()
+        for _ in range(8):
+            await scheduler.acquire(MAC_ADDRESS)
+            assert not discovered.is_set()
+        await asyncio.get_running_loop().run_in_executor(None, thread.join)
+
+    asyncio.run(main())
+
+
+def test_rapid_colors_coalesce_on_the_wire():
+    async def main(simulator):
+        transport = await LifxTransport.create(scheduler=PacketScheduler(rate_per_second=10.0, capacity=1.0))
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            colors = [(hue, 65535, 65535, 3500) for hue in (1000, 2000, 3000)]
+            await asyncio.gather(*(light.set_color(color, rapid=True) for color in colors))
+            await light.get_power()
+            return colors[-1]
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        last_color = asyncio.run(main(simulator))
+        assert simulator.received["LightSetColor"] == 2
+        assert tuple(simulator.bulbs[0].color) == last_color
+
+
+def test_flash_and_cue_are_never_coalesced_away():
+    async def main(simulator):
+        transport = await LifxTransport.create(scheduler=PacketScheduler(rate_per_second=10.0, capacity=1.0))
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            color = (1000, 65535, 65535, 3500)
+            await asyncio.gather(
+                light.set_waveform(0, color, 1000, 0.5, 0, 3, rapid=True),
+                light.set_waveform(1, color, 200, 1.0, 0, 1, rapid=True),
+                light.set_power(False, rapid=True),
+                light.set_power(True, rapid=True),
+            )
+            await light.get_power()
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        asyncio.run(main(simulator))
+        assert simulator.received["LightSetWaveform"] == 2
+        assert simulator.received["LightSetPower"] == 2
+        assert simulator.bulbs[0].power_level == 65535
@@ -0,0 +1,72 @@
+import os
+import signal
+import time
+
+from lifx_breathing.lifx_manager import LifxLightWrapper
+from lifx_breathing.session_host import HashRing, ShardedSessionHost
+from lifx_breathing.status_stream import StatusUpdates
+from lifx_breathing.supervisor import SessionState
+from tests.lifx_simulator import LifxSimulator
+
+
+def wait_for(condition, timeout_seconds=20.0):
+    deadline = time.monotonic() + timeout_seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_hash_ring_only_moves_keys_of_removed_worker():
+    ring = HashRing([0, 1, 2, 3])
+    keys = [f"d0:73:d5:00:{i >> 8:02x}:{i & 0xFF:02x}" for i in range(1000)]
+    before = {key: ring.owner(key) for key in keys}
+    assert set(before.values()) == {0, 1, 2, 3}
+    assert min(list(before.values()).count(worker_id) for worker_id in range(4)) > 150
+
+    ring.remove(2)
+    after = {key: ring.owner(key) for key in keys}
+    assert all(after[key] == before[key] for key in keys if before[key] != 2)
+    assert 2 not in after.values()
+
+
+def test_sessions_move_when_a_worker_dies():
+    with LifxSimulator(bulb_count=4, latency_seconds=0.002) as simulator:
+        lights = [
+            LifxLightWrapper("Simulated", bulb.label, "127.0.0.1", bulb.mac_address) for bulb in simulator.bulbs
+        ]
+        original_colors = [tuple(bulb.color) for bulb in simulator.bulbs]
+        status = StatusUpdates()
+        host = ShardedSessionHost(worker_count=2, port=simulator.port, status=status)
+        try:
+            for light in lights:
+                host.start_nowait(light, 500, 500)
+            assert all(host.session_state(light) is SessionState.STARTING for light in lights)
+            wait_for(lambda: all(host.session_state(light) is SessionState.RUNNING for light in lights))
+            forwarded = {}
+
+            def forwarded_states():
+                for (mac_address, fields) in status.drain().items():
+                    forwarded.setdefault(mac_address, {}).update(fields)
+                return {fields.get("state") for fields in forwarded.values()}
+
+            wait_for(lambda: forwarded_states() == {"running"} and len(forwarded) == len(lights))
+
+            placement = {light: host.worker_for(light) for light in lights}
+            victim = placement[lights[0]]
+            os.kill(host.worker_pids[victim], signal.SIGKILL)
+            wait_for(lambda: victim not in host.worker_pids)
+            wait_for(lambda: all(host.session_state(light) is SessionState.RUNNING for light in lights))
+            for light in lights:
+                if placement[light] != victim:
+                    assert host.worker_for(light) == placement[light]
+                else:
+                    assert host.worker_for(light) != victim
+
+            for light in lights:
+                host.stop_nowait(light)
+            assert not host.running_lights
+            wait_for(lambda: all(host.session_state(light) is SessionState.STOPPED for light in lights))
+            # The moved sessions restore the colour from before their first start, not the one they were moved in.
+            assert [tuple(bulb.color) for bulb in simulator.bulbs] == original_colors
+        finally:
+            host.close()
@@ -0,0 +1,250 @@
+import asyncio
+import time
+
+from lifxlan import LifxLAN
+from lifxlan.msgtypes import LightGet, LightGetPower, LightSetColor, LightSetWaveform
+
+from benchmarks.simulated import find_regressions, summarize_phase_errors
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.lifx import (
+    BreathingMode,
+    TransitionCue,
+    go_to_color,
+    run_group_session,
+    run_scheduled_phase,
+    run_session,
+)
+from lifx_breathing.lifx_manager import LifxLightWrapper, LifxManager
+from lifx_breathing.pid import DEFAULT_PID_GAINS
+from lifx_breathing.protocol import AsyncLight, AsyncLightGroup, LifxTransport
+from lifx_breathing.supervisor import SessionState
+from tests.lifx_simulator import LifxSimulator
+
+GREEN = (21845, 65535, 65535, 3500)
+BLUE = (43690, 65535, 65535, 3500)
+
+
+def test_go_to_color_reaches_destination():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            started_at = time.monotonic()
+            await go_to_color(light, GREEN, duration_ms=300, flash_duration_ms=50)
+            return time.monotonic() - started_at
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        elapsed = asyncio.run(main(simulator))
+        assert simulator.bulbs[0].color == GREEN
+        assert simulator.bulbs[0].power_level == 65535
+    assert 0.3 <= elapsed < 1.0
+
+
+def test_scheduled_session_restores_original_color():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            task = asyncio.ensure_future(run_session(light, 500, 500, BreathingMode.SCHEDULED))
+            await asyncio.sleep(1.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        original = simulator.bulbs[0].color
+        asyncio.run(main(simulator))
+        assert simulator.bulbs[0].color == original
+        assert simulator.received["LightSetWaveform"] == 3
+        assert simulator.received["LightGet"] == 1
+
+
+def test_original_state_is_read_in_one_round_trip_before_the_first_change():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            task = asyncio.ensure_future(run_session(light, 500, 500, BreathingMode.SCHEDULED))
+            await asyncio.sleep(0.6)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.2, record_history=True) as simulator:
+        asyncio.run(main(simulator))
+        arrivals = [(arrived_at, type(message)) for (arrived_at, message) in simulator.history]
+    first_change = min(
+        arrived_at for (arrived_at, message_type) in arrivals if message_type in (LightSetColor, LightSetWaveform)
+    )
+    reads = [
+        arrived_at
+        for (arrived_at, message_type) in arrivals
+        if message_type in (LightGet, LightGetPower) and arrived_at < first_change
+    ]
+    assert len(reads) == 2
+    # The power read went out before the colour reply came back, and the bulb was only changed after both replies.
+    assert max(reads) - min(reads) < 0.1
+    assert first_change - max(reads) >= 0.2
+
+
+def test_dip_cue_replaces_power_flash():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            task = asyncio.ensure_future(run_session(light, 500, 500, BreathingMode.SCHEDULED, cue=TransitionCue.DIP))
+            await asyncio.sleep(1.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            transport.close()
+
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        asyncio.run(main(simulator))
+        # Three fades and the two cues that fell due, one packet each; the only set_power is the final restore.
+        assert simulator.received["LightSetWaveform"] == 5
+        assert simulator.received["LightSetPower"] == 1
+        assert simulator.bulbs[0].power_level == 65535
+
+
+def test_only_omitted_gains_are_looked_up_in_the_gain_store():
+    class RecordingGainStore:
+        def __init__(self):
+            self.requested = []
+
+        def get(self, mac_address):
+            self.requested.append(mac_address)
+            return DEFAULT_PID_GAINS
+
+    async def main(simulator, gains, gain_store):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            task = asyncio.ensure_future(
+                run_session(light, 500, 500, BreathingMode.POLLING, gains, gain_store=gain_store)
+            )
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            transport.close()
+
+    gain_store = RecordingGainStore()
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        asyncio.run(main(simulator, DEFAULT_PID_GAINS, gain_store))
+        assert gain_store.requested == []
+        asyncio.run(main(simulator, None, gain_store))
+        assert gain_store.requested == [simulator.bulbs[0].mac_address]
+
+
+def test_state_check_waits_for_the_fade_and_resends_only_drift():
+    async def main(simulator, cue):
+        transport = await LifxTransport.create()
+        try:
+            light = AsyncLight(transport, simulator.bulbs[0].mac_address, "127.0.0.1", simulator.port)
+            # A fading phase that the bulb follows, a little late, and a hold the bulb was never sent.
+            await run_scheduled_phase(light, GREEN, time.monotonic(), 600, 400, 200, True, True, cue)
+            await run_scheduled_phase(light, BLUE, time.monotonic(), 300, 0, 100, False, True, cue)
+        finally:
+            transport.close()
+
+    for cue in (TransitionCue.FLASH, TransitionCue.DIP):
+        with LifxSimulator(latency_seconds=0.002, fade_lag_seconds=0.03) as simulator:
+            asyncio.run(main(simulator, cue))
+            assert simulator.received["LightGet"] == 2
+            assert simulator.received["LightSetColor"] == 1
+            assert simulator.bulbs[0].color == BLUE
+
+
+def test_manager_discovers_simulated_bulbs():
+    with LifxSimulator(bulb_count=3, latency_seconds=0.002) as simulator, simulator.redirect_broadcasts():
+        manager = LifxManager(lan=LifxLAN(num_lights=3))
+        try:
+            deadline = time.monotonic() + 10
+            while len(manager.lights) < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert [light.label for light in manager.lights] == ["Bulb 0", "Bulb 1", "Bulb 2"]
+            assert manager.get_light("Simulated", "Bulb 1").mac_address == simulator.bulbs[1].mac_address
+        finally:
+            manager.close()
+
+
+def test_regressions_are_reported_against_baseline():
+    assert summarize_phase_errors([0.0, 1.01, 1.99], 1000)["phase_error_ms_max"] == 20.0
+    baseline = {"breathing": {"scheduled": {"packets_per_cycle": 6.0, "phases": 7}}}
+    assert find_regressions({"breathing": {"scheduled": {"packets_per_cycle": 8.0, "phases": 99}}}, baseline, 0.1)
+    assert not find_regressions({"breathing": {"scheduled": {"packets_per_cycle": 7.5, "phases": 99}}}, baseline, 0.1)
+
+
+def test_group_phases_go_out_in_one_burst_and_restore_every_member():
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            lights = [AsyncLight(transport, bulb.mac_address, "127.0.0.1", simulator.port) for bulb in simulator.bulbs]
+            group = AsyncLightGroup(transport, lights)
+            task = asyncio.ensure_future(run_group_session(group, 400, 400))
+            await asyncio.sleep(1.0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            transport.close()
+
+    with LifxSimulator(bulb_count=3, latency_seconds=0.002, record_history=True) as simulator:
+        simulator.bulbs[1].color = GREEN
+        originals = [bulb.color for bulb in simulator.bulbs]
+        asyncio.run(main(simulator))
+        fades = [
+            message.target_addr
+            for (_, message) in simulator.history
+            if isinstance(message, LightSetWaveform) and not message.transient
+        ]
+        members = sorted(bulb.mac_address for bulb in simulator.bulbs)
+        assert len(fades) >= 2 * len(members)
+        # Each phase's packets are written back to back, so nothing else reaches the bulbs in between.
+        waveform_indices = [
+            i
+            for (i, (_, message)) in enumerate(simulator.history)
+            if isinstance(message, LightSetWaveform) and not message.transient
+        ]
+        for start in range(0, len(fades) - len(members) + 1, len(members)):
+            assert sorted(fades[start : start + len(members)]) == members
+            assert waveform_indices[start + len(members) - 1] - waveform_indices[start] == len(members) - 1
+        assert [bulb.color for bulb in simulator.bulbs] == originals
+
+
+def test_group_member_that_does_not_acknowledge_is_skipped(caplog):
+    async def main(simulator):
+        transport = await LifxTransport.create()
+        try:
+            lights = [AsyncLight(transport, bulb.mac_address, "127.0.0.1", simulator.port) for bulb in simulator.bulbs]
+            # No simulated bulb has this MAC address, so nothing ever acknowledges it.
+            lights.append(AsyncLight(transport, "d0:73:d5:ff:ff:ff", "127.0.0.1", simulator.port))
+            await AsyncLightGroup(transport, lights).set_color(BLUE, rapid=False)
+        finally:
+            transport.close()
+
+    with LifxSimulator(bulb_count=2, latency_seconds=0.002) as simulator:
+        asyncio.run(main(simulator))
+        assert [bulb.color for bulb in simulator.bulbs] == [BLUE, BLUE]
+    assert "d0:73:d5:ff:ff:ff did not acknowledge LightSetColor" in caplog.text
+
+
+def test_stopping_one_member_stops_and_restores_the_group():
+    with LifxSimulator(bulb_count=3, latency_seconds=0.002) as simulator:
+        originals = [bulb.color for bulb in simulator.bulbs]
+        lights = [LifxLightWrapper("Simulated", bulb.label, "127.0.0.1", bulb.mac_address) for bulb in simulator.bulbs]
+        engine = BreathingEngine(port=simulator.port)
+        try:
+            engine.start_group(lights, 400, 400)
+            time.sleep(0.6)
+            assert engine.running_lights == lights
+            engine.stop(lights[1])
+            assert engine.running_lights == []
+            assert [engine.session_state(light) for light in lights] == [SessionState.STOPPED] * 3
+            assert [bulb.color for bulb in simulator.bulbs] == originals
+        finally:
+            engine.close()
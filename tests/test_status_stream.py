@@ -0,0 +1,64 @@
+import json
+import time
+
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.lifx import BreathingMode
+from lifx_breathing.lifx_manager import LifxLightWrapper
+from lifx_breathing.status_stream import StatusBroadcaster, StatusUpdates
+from tests.lifx_simulator import LifxSimulator
+
+
+def decode(frame):
+    (event, data) = frame.decode().strip().split("\n")
+    return (event[len("event: ") :], json.loads(data[len("data: ") :]))
+
+
+def test_updates_are_merged_into_one_frame_shared_by_every_client():
+    status = StatusBroadcaster(flush_interval_seconds=0.05)
+    try:
+        first = status.stream()
+        second = status.stream()
+        assert decode(next(first)) == ("snapshot", {})
+        assert decode(next(second)) == ("snapshot", {})
+
+        for cycle in range(10):
+            status.publish("d0:73:d5:00:00:01", {"phase": "inhale", "cycle": cycle})
+        status.publish("d0:73:d5:00:00:02", {"state": "running"})
+        frame = next(first)
+        assert next(second) is frame
+        assert decode(frame) == (
+            "status",
+            {"d0:73:d5:00:00:01": {"phase": "inhale", "cycle": 9}, "d0:73:d5:00:00:02": {"state": "running"}},
+        )
+
+        status.publish("d0:73:d5:00:00:01", {"phase": "exhale"})
+        late = status.stream()
+        time.sleep(0.2)
+        assert decode(next(late)) == (
+            "snapshot",
+            {"d0:73:d5:00:00:01": {"phase": "exhale", "cycle": 9}, "d0:73:d5:00:00:02": {"state": "running"}},
+        )
+    finally:
+        status.close()
+
+
+def test_engine_publishes_session_state_and_phases():
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        bulb = simulator.bulbs[0]
+        light = LifxLightWrapper("Simulated", bulb.label, "127.0.0.1", bulb.mac_address)
+        status = StatusUpdates()
+        engine = BreathingEngine(port=simulator.port, status=status)
+        try:
+            engine.start(light, 300, 300, BreathingMode.SCHEDULED)
+            seen = {}
+            deadline = time.monotonic() + 5.0
+            while "lateness_ms" not in seen:
+                assert time.monotonic() < deadline, "timed out"
+                time.sleep(0.05)
+                seen.update(status.drain().get(bulb.mac_address, {}))
+            assert seen["state"] == "running"
+            assert seen["phase"] in ("inhale", "exhale")
+            engine.stop(light)
+            assert status.drain()[bulb.mac_address]["state"] == "stopped"
+        finally:
+            engine.close()
@@ -0,0 +1,75 @@
+import asyncio
+
+from lifx_breathing.supervisor import RestartPolicy, SessionState, SupervisedSession
+
+FAST_POLICY = RestartPolicy(initial_backoff_seconds=0.01, max_backoff_seconds=0.01, jitter=0.0, max_restarts=2)
+
+
+def test_crashed_session_is_restarted_until_it_gives_up():
+    runs = []
+
+    async def crash():
+        runs.append(1)
+        raise RuntimeError("bulb went away")
+
+    async def main():
+        session = SupervisedSession((), crash, FAST_POLICY)
+        await session.start(asyncio.get_running_loop())
+        return session
+
+    session = asyncio.run(main())
+    assert len(runs) == 3
+    assert session.restarts == 2
+    assert session.state is SessionState.FAILED
+    assert isinstance(session.last_error, RuntimeError)
+
+
+def test_stop_waits_for_restore_and_reports_stopping():
+    restored = []
+
+    async def breathe():
+        try:
+            await asyncio.sleep(60)
+        finally:
+            await asyncio.sleep(0.01)
+            restored.append(True)
+
+    async def main():
+        session = SupervisedSession((), breathe, FAST_POLICY)
+        task = session.start(asyncio.get_running_loop())
+        await asyncio.sleep(0)
+        assert session.state is SessionState.RUNNING
+        session.stop()
+        session.stop()
+        assert session.state is SessionState.STOPPING
+        await asyncio.wait([task])
+        return session
+
+    session = asyncio.run(main())
+    assert restored == [True]
+    assert session.state is SessionState.STOPPED
+
+
+def test_failed_restore_while_stopping_does_not_restart():
+    runs = []
+
+    async def breathe():
+        runs.append(1)
+        try:
+            await asyncio.sleep(60)
+        finally:
+            raise RuntimeError("restore timed out")
+
+    async def main():
+        session = SupervisedSession((), breathe, FAST_POLICY)
+        task = session.start(asyncio.get_running_loop())
+        await asyncio.sleep(0)
+        session.stop()
+        await asyncio.wait([task])
+        await asyncio.sleep(0.05)
+        return session
+
+    session = asyncio.run(main())
+    assert runs == [1]
+    assert session.restarts == 0
+    assert session.state is SessionState.STOPPED
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from lifx_breathing.engine import BreathingEngine
+from lifx_breathing.lifx import BreathingMode
+from lifx_breathing.lifx_manager import LifxLightWrapper
+from lifx_breathing.pid import PidController, PidGains
+from lifx_breathing.trace import TRACE_MODES, TraceRecorder, int_to_mac_address, load_traces, replay, summarize
+from tests.lifx_simulator import LifxSimulator
+
+numpy = pytest.importorskip("numpy")
+
+MAC_ADDRESS = "d0:73:d5:00:00:01"
+
+
+def record_polling_session(recorder, gains, disturbances_ms, target_ms=5000):
+    """Trace a polling session against a bulb that adds disturbances_ms[i] to phase i."""
+    trace = recorder.session(MAC_ADDRESS, "polling")
+    controller = PidController(gains)
+    commanded_ms = target_ms
+    for (cycle, disturbance_ms) in enumerate(disturbances_ms):
+        actual_ms = commanded_ms + disturbance_ms
+        correction_ms = controller.update(target_ms - actual_ms)
+        trace.phase(0, cycle, target_ms, commanded_ms, commanded_ms - 160, actual_ms, correction_ms=correction_ms)
+        commanded_ms += correction_ms
+
+
+def test_records_survive_growth_and_load_before_close(tmp_path):
+    recorder = TraceRecorder(str(tmp_path / "a.lxtrace"), chunk_records=8)
+    record_polling_session(recorder, PidGains(), [100] * 20)
+    records = load_traces(str(tmp_path))
+    assert len(records) == 20
+    assert records.dtype.itemsize == 80
+    assert int_to_mac_address(int(records["bulb"][0])) == MAC_ADDRESS
+    assert records["cycle"].tolist() == list(range(20))
+    assert (records["requested_ms"] == records["commanded_ms"] - 160).all()
+    recorder.close()
+
+    TraceRecorder(str(tmp_path / "b.lxtrace")).close()
+    assert len(load_traces(str(tmp_path))) == 20
+    [(bulb, mode, phases, _, _, _)] = summarize(load_traces(str(tmp_path)))
+    assert (bulb, mode, phases) == (MAC_ADDRESS, "polling", 20)
+
+
+def test_replay_reproduces_recorded_gains_and_predicts_others(tmp_path):
+    recorder = TraceRecorder(str(tmp_path / "a.lxtrace"))
+    gains = PidGains(k_p=0.5, k_i=0.0, k_d=0.0)
+    record_polling_session(recorder, gains, [200] * 30)
+    recorder.close()
+    records = load_traces(str(tmp_path))
+
+    assert (replay(records, gains) == records["actual_ms"]).all()
+    # Without any correction the bulb's constant 200 ms lag is never taken out of the commanded duration.
+    assert (replay(records, PidGains(k_p=0.0, k_i=0.0, k_d=0.0)) - records["target_ms"] == 200).all()
+    assert abs(int(records["actual_ms"][-1]) - int(records["target_ms"][-1])) < 5
+
+
+def test_engine_traces_scheduled_phases(tmp_path):
+    with LifxSimulator(latency_seconds=0.002) as simulator:
+        bulb = simulator.bulbs[0]
+        light = LifxLightWrapper("Simulated", bulb.label, "127.0.0.1", bulb.mac_address)
+        recorder = TraceRecorder(str(tmp_path / "engine.lxtrace"))
+        engine = BreathingEngine(port=simulator.port, trace_recorder=recorder)
+        try:
+            engine.start(light, 300, 300, BreathingMode.SCHEDULED)
+            time.sleep(1.5)
+            engine.stop(light)
+        finally:
+            engine.close()
+            recorder.close()
+    records = load_traces(str(tmp_path))
+    assert len(records) >= 3
+    assert (records["mode"] == TRACE_MODES.index("scheduled")).all()
+    assert records["phase"].tolist()[:2] == [0, 1]
+    assert (numpy.abs(records["actual_ms"] - records["target_ms"]) < 50).all()
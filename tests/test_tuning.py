@@ -0,0 +1,53 @@
+import pytest
+
+from lifx_breathing.pid import DEFAULT_PID_GAINS, PidController, PidGains
+from lifx_breathing.trace import TraceRecorder, load_traces
+from lifx_breathing.tuning import GainStore, evaluate, gain_grid, simulate, simulated_episodes, tune, tune_traces
+
+numpy = pytest.importorskip("numpy")
+
+MAC_ADDRESS = "d0:73:d5:00:00:01"
+
+
+def test_simulate_matches_pid_controller():
+    disturbances_ms = simulated_episodes(150, 60, episodes=3, cycles=30, seed=1)
+    gains = numpy.array([[1.0, 0.05, 0.03], [0.4, 0.2, 0.1], [1.5, 0.3, 0.3]])
+    simulated_ms = simulate(disturbances_ms, gains)
+    for (row, (k_p, k_i, k_d)) in enumerate(gains.tolist()):
+        for (episode, disturbances) in enumerate(disturbances_ms.tolist()):
+            controller = PidController(PidGains(k_p=k_p, k_i=k_i, k_d=k_d))
+            (target_ms, commanded_ms) = (5000, 5000)
+            for (cycle, disturbance_ms) in enumerate(disturbances):
+                actual_ms = commanded_ms + disturbance_ms
+                assert simulated_ms[row, episode, cycle] == actual_ms - target_ms
+                commanded_ms += controller.update(target_ms - actual_ms)
+
+
+def test_tune_beats_default_gains_on_a_process_pool():
+    disturbances_ms = simulated_episodes(200, 20, episodes=16, cycles=20)
+    grid = gain_grid(numpy.linspace(0, 1.5, 8), numpy.linspace(0, 0.3, 8), numpy.linspace(0, 0.3, 16))
+    result = tune(disturbances_ms, grid, workers=2)
+    assert result == tune(disturbances_ms, grid, workers=1)
+    default_cost = evaluate(disturbances_ms, numpy.array([[DEFAULT_PID_GAINS.k_p, 0.05, 0.03]]))[0, 0]
+    assert result.cost <= default_cost
+    assert result.gains.k_p > 0
+
+
+def test_tuned_gains_are_saved_per_bulb_and_reloaded(tmp_path):
+    recorder = TraceRecorder(str(tmp_path / "traces" / "a.lxtrace"))
+    trace = recorder.session(MAC_ADDRESS, "polling")
+    for (cycle, disturbance_ms) in enumerate(simulated_episodes(180, 30, episodes=1, cycles=40)[0].tolist()):
+        trace.phase(0, cycle, 5000, 5000, 4820, 5000 + disturbance_ms)
+    recorder.session("d0:73:d5:00:00:02", "polling").phase(0, 0, 5000, 5000, 4820, 5100)
+    recorder.close()
+
+    results = tune_traces(load_traces(str(tmp_path / "traces")), workers=1)
+    assert list(results) == [MAC_ADDRESS]
+
+    running = GainStore(str(tmp_path / "gains.json"))
+    assert running.get(MAC_ADDRESS) is DEFAULT_PID_GAINS
+    tuner = GainStore(str(tmp_path / "gains.json"))
+    tuner.set(MAC_ADDRESS.upper(), results[MAC_ADDRESS].gains)
+    tuner.save()
+    assert running.get(MAC_ADDRESS) == results[MAC_ADDRESS].gains
+    assert running.get("d0:73:d5:00:00:02") is DEFAULT_PID_GAINS